@@ -0,0 +1,387 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Evaluate the pyconfig hooks of many repositories (clones using this
+# project's layout) for a set of event scenarios, e.g. to audit what every
+# repository would build and publish on a tag push:
+#
+#   python3 .pyconfig/batch.py -L ../actions/pyconfig -L ../actions/release-tracker \
+#     -s tag-push -s pr-opened -o results.jsonl ../repos/*
+#
+# For every (repository, scenario), settings() is evaluated, followed by the
+# configure() hook of the scenario's workflows, once for every element of
+# their build matrix (e.g. base image and platform). Results are written as
+# JSON Lines, as soon as they are available.
+#
+# Repositories are evaluated in a pool of processes, which import the shared
+# libraries (pyconfig, release_tracker, yaml) once. The hooks of a
+# repository are loaded from its own .pyconfig directory, but modules whose
+# source is identical to one already loaded by the process are reused, so
+# repositories with the same version of the layout share everything.
+###############################################################################
+import argparse
+import contextlib
+import hashlib
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterator, NamedTuple, Optional
+
+from snapshot import load_dict, sanitize, to_tuple
+
+SETTINGS_FILE = ".pyconfig/settings.yml"
+PR_WORKFLOWS = ("pull_request", "build_and_test_docker", "build_and_test_deb")
+PUSH_WORKFLOWS = ("build_and_test_docker", "build_and_test_deb", "release_test")
+
+
+class Scenario(NamedTuple):
+  event_name: str
+  ref_type: str
+  ref_name: str
+  workflows: tuple
+  event: dict = {}
+
+
+SCENARIOS = {
+  "tag-push": Scenario("push", "tag", "1.0.0", PUSH_WORKFLOWS),
+  "branch-push": Scenario("push", "branch", "master", PUSH_WORKFLOWS),
+  "pr-opened": Scenario(
+    "pull_request",
+    "branch",
+    "1/merge",
+    PR_WORKFLOWS,
+    {"action": "opened", "pull_request": {"draft": False, "number": 1}},
+  ),
+  "pr-approved": Scenario(
+    "pull_request_review",
+    "branch",
+    "1/merge",
+    PR_WORKFLOWS,
+    {
+      "action": "submitted",
+      "pull_request": {"draft": False, "number": 1},
+      "review": {"state": "approved"},
+    },
+  ),
+}
+
+
+###############################################################################
+# Repositories
+###############################################################################
+def repository_name(repo_dir: Path) -> str:
+  # owner/name of the `origin` remote (or of the parent directory)
+  try:
+    from gitmeta import find_git_dir
+
+    config = (find_git_dir(repo_dir) / "config").read_text()
+    m = re.search(
+      r'\[remote "origin"\][^\[]*?url\s*=\s*\S*?[:/]([^/:\s]+/[^/\s]+?)(?:\.git)?\s*$',
+      config,
+      re.MULTILINE,
+    )
+    if m:
+      return m.group(1)
+  except Exception:
+    pass
+  repo_dir = Path(repo_dir).resolve()
+  return f"{repo_dir.parent.name}/{repo_dir.name}"
+
+
+def head_sha(repo_dir: Path) -> str:
+  try:
+    from gitmeta import ref_info
+
+    return ref_info(repo_dir).sha
+  except Exception:
+    return "0" * 40
+
+
+def merge(base: dict, override: dict) -> dict:
+  result = dict(base)
+  for k, v in override.items():
+    if isinstance(v, dict) and isinstance(result.get(k), dict):
+      result[k] = merge(result[k], v)
+    else:
+      result[k] = v
+  return result
+
+
+def matrix(workflow: str, cfg: NamedTuple) -> list:
+  # The inputs of every job of a workflow's build matrix
+  if workflow == "build_and_test_docker":
+    return [
+      {"base_image": base_image, "build_platform": platform}
+      for base_image in json.loads(cfg.ci.images.tester.base_images_matrix)
+      for platform in cfg.release.build_platforms
+    ]
+  elif workflow == "build_and_test_deb":
+    if not cfg.debian.enabled:
+      return []
+    return [
+      {"base_image": base_image, "build_architecture": arch}
+      for base_image in cfg.debian.builder.base_images
+      for arch in cfg.debian.builder.architectures
+    ]
+  return [{}]
+
+
+###############################################################################
+# Hooks
+###############################################################################
+def _source_hash(path: Path) -> str:
+  return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+class HookLoader:
+  # Load the hooks of a repository, sharing modules with identical sources
+  def __init__(self) -> None:
+    self.module_hashes = {}
+    self.hooks = {}
+    self.pyconfig_dir = None
+
+  def _loaded_hash(self, name: str, module: object) -> Optional[str]:
+    # e.g. modules imported by this script, before loading any repository
+    if name not in self.module_hashes:
+      module_file = getattr(module, "__file__", None)
+      self.module_hashes[name] = _source_hash(Path(module_file)) if module_file else None
+    return self.module_hashes[name]
+
+  def _activate(self, pyconfig_dir: Path) -> str:
+    # Make the repository's helper modules importable, dropping the ones
+    # loaded from a different source. Returns the id of the repository's code.
+    code = hashlib.sha256()
+    for path in sorted([*pyconfig_dir.glob("*.py"), *pyconfig_dir.glob("workflows/*.py")]):
+      source_hash = _source_hash(path)
+      code.update(f"{path.relative_to(pyconfig_dir)} {source_hash}\0".encode())
+      if path.parent != pyconfig_dir:
+        continue
+      loaded = sys.modules.get(path.stem)
+      if loaded is not None and self._loaded_hash(path.stem, loaded) != source_hash:
+        del sys.modules[path.stem]
+      self.module_hashes[path.stem] = source_hash
+    if self.pyconfig_dir is not None and str(self.pyconfig_dir) in sys.path:
+      sys.path.remove(str(self.pyconfig_dir))
+    sys.path.insert(0, str(pyconfig_dir))
+    self.pyconfig_dir = pyconfig_dir
+    return code.hexdigest()
+
+  def _load_module(self, path: Path, code_id: str) -> object:
+    spec = importlib.util.spec_from_file_location(f"batch_{code_id[:12]}_{path.stem}", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+  def load(self, repo_dir: Path) -> tuple:
+    # (settings module, {workflow: module})
+    pyconfig_dir = (repo_dir / ".pyconfig").resolve()
+    code_id = self._activate(pyconfig_dir)
+    hooks = self.hooks.get(code_id)
+    if hooks is None:
+      settings_mod = self._load_module(pyconfig_dir / "settings.py", code_id)
+      workflows = {
+        path.stem: self._load_module(path, code_id)
+        for path in sorted((pyconfig_dir / "workflows").glob("*.py"))
+        if path.stem != "release_notes"
+      }
+      hooks = self.hooks[code_id] = (settings_mod, workflows)
+    return hooks
+
+
+_loader = None
+
+
+def _init_worker(lib_dirs: list) -> None:
+  global _loader
+  sys.path[:0] = lib_dirs
+  # The hooks must not write to the outputs of a workflow run
+  for var in ("GITHUB_OUTPUT", "GITHUB_STEP_SUMMARY", "PYCONFIG_TRACE"):
+    os.environ.pop(var, None)
+  # Shared by all repositories
+  import pyconfig  # noqa: F401
+  import yaml  # noqa: F401
+
+  _loader = HookLoader()
+
+
+###############################################################################
+# Evaluation
+###############################################################################
+def _make_github(repository: str, sha: str, workspace: Path, scenario: Scenario) -> NamedTuple:
+  return to_tuple(
+    sanitize(
+      {
+        "repository": repository,
+        "workspace": str(workspace),
+        "ref": f"refs/{'tags' if scenario.ref_type == 'tag' else 'heads'}/{scenario.ref_name}",
+        "ref_type": scenario.ref_type,
+        "ref_name": scenario.ref_name,
+        "sha": sha,
+        "event_name": scenario.event_name,
+        "run_id": "1",
+        "run_attempt": "1",
+        "event": merge(
+          {"action": "", "pull_request": {"draft": False, "number": 0}, "review": {"state": ""}},
+          scenario.event,
+        ),
+      }
+    )
+  )
+
+
+def _call(errors: dict, key: str, fn: object, *args: object) -> Optional[object]:
+  # Run a hook, capturing its output, and record any failure
+  try:
+    with contextlib.redirect_stdout(io.StringIO()):
+      return fn(*args)
+  except Exception:
+    errors[key] = traceback.format_exc(limit=-3)
+  return None
+
+
+def evaluate_repository(repo_dir: str, scenarios: list) -> list:
+  repo_dir = Path(repo_dir)
+  results = []
+  start = time.monotonic()
+  try:
+    settings_mod, workflows = _loader.load(repo_dir)
+    settings_yml = load_dict(repo_dir / SETTINGS_FILE, validate=False)
+  except Exception:
+    error = traceback.format_exc(limit=-3)
+    return [{"repo": str(repo_dir), "scenario": s, "errors": {"load": error}} for s in scenarios]
+  repository = repository_name(repo_dir)
+  sha = head_sha(repo_dir)
+  load_time = time.monotonic() - start
+
+  with tempfile.TemporaryDirectory(prefix="pyconfig-batch-") as workspace:
+    for name in scenarios:
+      start = time.monotonic()
+      scenario = SCENARIOS[name]
+      github = _make_github(repository, sha, Path(workspace), scenario)
+      errors = {}
+      record = {
+        "repo": str(repo_dir),
+        "repository": repository,
+        "scenario": name,
+        "settings": None,
+        "workflows": {},
+        "errors": errors,
+      }
+      generated = _call(
+        errors, "settings", settings_mod.settings, repo_dir, to_tuple(settings_yml), github
+      )
+      if generated is not None:
+        generated = json.loads(json.dumps(generated, default=list))
+        record["settings"] = generated
+        generated = merge(generated, {"build": {"settings_file": SETTINGS_FILE}})
+        cfg = to_tuple(merge(settings_yml, sanitize(generated)))
+        for workflow in scenario.workflows:
+          module = workflows.get(workflow)
+          if module is None:
+            continue
+          jobs = []
+          for inputs in _call(errors, f"{workflow}:matrix", matrix, workflow, cfg) or []:
+            outputs = _call(
+              errors,
+              f"{workflow}{json.dumps(inputs) if inputs else ''}",
+              module.configure,
+              repo_dir,
+              cfg,
+              github,
+              to_tuple({"skip_unchanged": False, **inputs}),
+            )
+            if outputs is not None:
+              jobs.append({"inputs": inputs, "outputs": outputs})
+          record["workflows"][workflow] = jobs
+      record["elapsed"] = round(time.monotonic() - start + load_time, 6)
+      load_time = 0
+      results.append(record)
+  return results
+
+
+def run(
+  repos: list, scenarios: list, jobs: Optional[int] = None, lib_dirs: Optional[list] = None
+) -> Iterator[dict]:
+  # Yield the results as they are produced (in no particular order)
+  lib_dirs = [str(Path(d).resolve()) for d in lib_dirs or []]
+  with ProcessPoolExecutor(
+    max_workers=jobs, initializer=_init_worker, initargs=(lib_dirs,)
+  ) as pool:
+    futures = [pool.submit(evaluate_repository, str(repo), scenarios) for repo in repos]
+    for future in as_completed(futures):
+      yield from future.result()
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Evaluate the hooks of many repositories")
+  parser.add_argument("repos", nargs="+", type=Path, help="repository clones")
+  parser.add_argument(
+    "-s",
+    "--scenario",
+    action="append",
+    choices=sorted(SCENARIOS),
+    default=None,
+    help="event scenario (repeatable, default: all)",
+  )
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="worker processes")
+  parser.add_argument(
+    "-o", "--output", type=Path, default=None, help="JSONL file (default: stdout)"
+  )
+  parser.add_argument(
+    "-L",
+    "--lib-dir",
+    type=Path,
+    action="append",
+    default=[],
+    help="Additional directory to search for modules (e.g. pyconfig, release_tracker)",
+  )
+  args = parser.parse_args()
+
+  repos = [r for r in args.repos if (r / SETTINGS_FILE).is_file()]
+  for r in sorted(set(args.repos) - set(repos)):
+    print(f"WARNING skipping {r}: no {SETTINGS_FILE}", file=sys.stderr)
+  scenarios = args.scenario or list(SCENARIOS)
+
+  start = time.monotonic()
+  count = failed = 0
+  with contextlib.ExitStack() as stack:
+    output = stack.enter_context(args.output.open("w")) if args.output else sys.stdout
+    for record in run(repos, scenarios, args.jobs, args.lib_dir):
+      output.write(json.dumps(record, default=list) + "\n")
+      output.flush()
+      count += 1
+      failed += bool(record["errors"])
+  print(
+    f"{count} results for {len(repos)} repositories ({failed} with errors)"
+    f" in {time.monotonic() - start:.1f}s",
+    file=sys.stderr,
+  )
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
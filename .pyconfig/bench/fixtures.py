@@ -0,0 +1,239 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Synthetic inputs for the pyconfig benchmarks.
+#
+# The factories build `cfg`, `github` and `inputs` objects shaped like the
+# ones passed to the hooks by the pyconfig action (nested NamedTuples, with
+# "-" and "/" in keys replaced by "_"), starting from the project's
+# settings.yml and scaling up the number of profiles, build platforms, final
+# repositories, images, and manifest layers.
+#
+# The release fixtures reproduce the workspace layout expected by
+# release_notes.summarize(): the release tracker's commit and summary files,
+# a docker-manifests.json, and some Debian packages in the artifacts dir.
+###############################################################################
+import json
+import random
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+PYCONFIG_DIR = Path(__file__).parent.parent
+SETTINGS_YML = PYCONFIG_DIR / "settings.yml"
+SETTINGS_FILE = str(SETTINGS_YML.relative_to(PYCONFIG_DIR.parent))
+
+REPOSITORY = "mentalsmash/ref-project-debdocker"
+
+TRACKER_STORAGE = "src/tracker/storage"
+TRACKER_CREATED_AT = "20240101-000000"
+
+
+###############################################################################
+# NamedTuple factories
+###############################################################################
+def field_name(key: str) -> str:
+  return key.replace("-", "_").replace("/", "_")
+
+
+def sanitize(value: object) -> object:
+  if isinstance(value, dict):
+    return {field_name(k): sanitize(v) for k, v in value.items()}
+  elif isinstance(value, list):
+    return [sanitize(v) for v in value]
+  return value
+
+
+@lru_cache(maxsize=None)
+def _tuple_type(name: str, fields: tuple) -> type:
+  return namedtuple(name, fields)
+
+
+def make_tuple(name: str, value: object) -> object:
+  if isinstance(value, dict):
+    value = sanitize(value)
+    return _tuple_type(field_name(name), tuple(value))(
+      *(make_tuple(k, v) for k, v in value.items())
+    )
+  elif isinstance(value, list):
+    return [make_tuple(name, v) for v in value]
+  return value
+
+
+def merge(base: dict, override: dict) -> dict:
+  result = dict(base)
+  for k, v in override.items():
+    if isinstance(v, dict) and isinstance(result.get(k), dict):
+      result[k] = merge(result[k], v)
+    else:
+      result[k] = v
+  return result
+
+
+def load_settings_yml(path: Path = SETTINGS_YML) -> dict:
+  # From the compiled snapshot, unless settings.yml changed since
+  import snapshot
+
+  return snapshot.load_dict(path)
+
+
+def platform_names(count: int) -> list:
+  return [f"linux/arch{i}" for i in range(count)]
+
+
+def scaled_settings(
+  base: dict,
+  profiles: int = 2,
+  build_platforms: int = 2,
+  final_repos: int = 2,
+) -> dict:
+  # Grow the dimensions of settings.yml which the hooks iterate over.
+  # The "nightly" and "stable" profiles are always kept, since settings()
+  # selects one of them based on the git ref.
+  result = json.loads(json.dumps(base))
+  platforms = platform_names(build_platforms)
+  release = result["release"]
+  release["final_repos"] = [
+    f"ghcr.io/mentalsmash/bench-{i}" if i % 2 == 0 else f"mentalsmash/bench-{i}"
+    for i in range(final_repos)
+  ]
+  template = release["profiles"]["nightly"]
+  for name in list(release["profiles"]):
+    release["profiles"][name]["build_platforms"] = platforms
+  for i in range(max(0, profiles - len(release["profiles"]))):
+    release["profiles"][f"extra{i}"] = merge(template, {"tag": f"extra{i}"})
+  for platform in platforms:
+    result["ci"]["runners"][platform] = ["ubuntu-latest"]
+  validation = result["pull_request"]["validation"]
+  for level in ("basic", "full"):
+    validation[level]["build_platforms"] = platforms
+  validation["deb"]["build_architectures"] = [p.split("/")[-1] for p in platforms]
+  result["debian"]["builder"]["architectures"] = [p.split("/")[-1] for p in platforms]
+  return result
+
+
+def make_cfg(settings: dict, generated: Optional[dict] = None) -> NamedTuple:
+  # `generated` is the result of settings(), which the pyconfig action
+  # merges on top of settings.yml (together with the path of the settings
+  # file) before invoking the workflow hooks.
+  if generated is not None:
+    generated = merge(generated, {"build": {"settings_file": SETTINGS_FILE}})
+    settings = merge(sanitize(settings), sanitize(generated))
+  return make_tuple("cfg", settings)
+
+
+def make_github(
+  workspace: Path,
+  ref_type: str = "branch",
+  ref_name: str = "master",
+  event_name: str = "push",
+  event: Optional[dict] = None,
+) -> NamedTuple:
+  return make_tuple(
+    "github",
+    {
+      "repository": REPOSITORY,
+      "workspace": str(workspace),
+      "ref_type": ref_type,
+      "ref_name": ref_name,
+      "sha": "0" * 40,
+      "event_name": event_name,
+      "run_id": "1",
+      "run_attempt": "1",
+      "event": event
+      or {
+        "action": "opened",
+        "pull_request": {"draft": False, "number": 1},
+        "review": {"state": "commented"},
+      },
+    },
+  )
+
+
+def make_inputs(**inputs: object) -> NamedTuple:
+  return make_tuple("inputs", inputs)
+
+
+###############################################################################
+# Release fixtures
+###############################################################################
+def _digest(rand: random.Random) -> str:
+  return f"sha256:{rand.getrandbits(256):064x}"
+
+
+def docker_manifests(images: int, layers: int, seed: int = 0) -> dict:
+  # Every image has `layers` platform manifests, each one with an
+  # attestation manifest referencing it.
+  rand = random.Random(seed)
+  result = {}
+  for i in range(images):
+    manifests = []
+    for p in range(layers):
+      digest = _digest(rand)
+      manifests.append({"digest": digest, "platform": {"os": "linux", "architecture": f"arch{p}"}})
+      manifests.append(
+        {
+          "digest": _digest(rand),
+          "platform": {"os": "unknown", "architecture": "unknown"},
+          "annotations": {
+            "vnd.docker.reference.digest": digest,
+            "vnd.docker.reference.type": "attestation-manifest",
+          },
+        }
+      )
+    registry = "ghcr.io/" if i % 2 == 0 else ""
+    result[f"{registry}mentalsmash/bench-{i}:nightly"] = {"manifests": manifests}
+  return {"images": result}
+
+
+def write_release_fixtures(
+  workspace: Path,
+  cfg: NamedTuple,
+  images: int,
+  layers: int,
+  deb_packages: int = 2,
+  deb_size: int = 64 * 1024,
+  version_id: Optional[str] = None,
+) -> Path:
+  # Returns the path of the generated docker-manifests.json.
+  # `version_id` must match ReleaseTracker.version_id() for the
+  # entry's creation date and version.
+  artifacts_dir = Path(cfg.build.artifacts_dir)
+  artifacts_dir.mkdir(parents=True, exist_ok=True)
+  track = cfg.build.profile
+  version = cfg.build.version
+  version_id = version_id or f"{TRACKER_CREATED_AT}__{version}"
+  (artifacts_dir / "release-tracker.commit").write_text("0000000\n")
+  (artifacts_dir / "release-tracker-summary.json").write_text(
+    json.dumps(
+      {
+        "entry": {"created_at": TRACKER_CREATED_AT, "version": version},
+        "storage": TRACKER_STORAGE,
+        "track": track,
+        "path": str(Path(TRACKER_STORAGE).parent),
+      }
+    )
+  )
+  manifests_f = workspace / TRACKER_STORAGE / track / version_id / "docker-manifests.json"
+  manifests_f.parent.mkdir(parents=True, exist_ok=True)
+  manifests_f.write_text(json.dumps(docker_manifests(images, layers)))
+  repo = cfg.build.repository.name
+  architectures = cfg.debian.builder.architectures
+  for i in range(deb_packages):
+    arch = architectures[i % len(architectures)]
+    deb = artifacts_dir / f"{repo}_1.0.{i}-1_{arch}.deb"
+    deb.write_bytes(random.Random(i).randbytes(deb_size))
+  return manifests_f
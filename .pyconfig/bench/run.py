@@ -0,0 +1,350 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Offline benchmarks for the pyconfig hooks.
+#
+# Time settings(), every workflow's configure(), and release_notes'
+# summarize() on synthetic inputs of growing scale, and write the results
+# as JSON. For every benchmark, the growth of the run time with the scale
+# is estimated as the slope of log(time) over log(scale) (~1.0 for linear
+# algorithms, ~2.0 for quadratic ones), and compared against a threshold.
+# Results can also be compared against a previous run (--baseline).
+#
+# The hooks import the `pyconfig` and `release_tracker` modules from the
+# mentalsmash/actions repository. Use --lib-dir (or PYTHONPATH) to point
+# the benchmarks to a local checkout, e.g.:
+#
+#   python3 .pyconfig/bench/run.py \
+#     --lib-dir ../actions/pyconfig --lib-dir ../actions/release-tracker \
+#     -o build/bench.json
+#
+# The script exits with a non-zero status if a regression is detected.
+###############################################################################
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import math
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+
+import fixtures
+
+PYCONFIG_DIR = fixtures.PYCONFIG_DIR
+CLONE_DIR = PYCONFIG_DIR.parent
+
+DEFAULT_SCALES = [1, 2, 4, 8, 16, 32, 64]
+# Run time growth allowed by default (slightly superlinear, to absorb noise)
+DEFAULT_MAX_SLOPE = 1.3
+# Slowdown (median run time) allowed when comparing against a baseline
+DEFAULT_TOLERANCE = 1.5
+# Minimum duration of a single timing sample
+MIN_SAMPLE_TIME = 0.05
+
+
+class Benchmark(NamedTuple):
+  name: str
+  # Prepare the inputs for the given scale, and return the function to time
+  setup: Callable[[int, Path], Callable[[], object]]
+  max_slope: float = DEFAULT_MAX_SLOPE
+
+
+###############################################################################
+# Hooks
+###############################################################################
+def load_module(path: Path) -> object:
+  spec = importlib.util.spec_from_file_location(f"bench_{path.stem}", path)
+  module = importlib.util.module_from_spec(spec)
+  spec.loader.exec_module(module)
+  return module
+
+
+def workflow_modules() -> dict:
+  return {
+    path.stem: load_module(path) for path in sorted((PYCONFIG_DIR / "workflows").glob("*.py"))
+  }
+
+
+def scaled_settings(scale: int) -> dict:
+  return fixtures.scaled_settings(
+    fixtures.load_settings_yml(),
+    profiles=scale,
+    build_platforms=scale,
+    final_repos=scale,
+  )
+
+
+def generate(settings_mod: object, settings: dict, github: NamedTuple) -> NamedTuple:
+  # Build the `cfg` object passed to the workflow hooks
+  generated = settings_mod.settings(CLONE_DIR, fixtures.make_cfg(settings), github)
+  return fixtures.make_cfg(settings, json.loads(json.dumps(generated, default=list)))
+
+
+###############################################################################
+# Benchmarks
+###############################################################################
+def bench_settings(settings_mod: object) -> Benchmark:
+  def setup(scale: int, workspace: Path) -> Callable[[], object]:
+    cfg = fixtures.make_cfg(scaled_settings(scale))
+    github = fixtures.make_github(workspace)
+    # settings() is lazy: serialize the result (like the pyconfig action
+    # does) to evaluate every value
+    return lambda: json.dumps(settings_mod.settings(CLONE_DIR, cfg, github), default=list)
+
+  return Benchmark("settings", setup)
+
+
+def bench_configure(settings_mod: object, name: str, workflow: object) -> Benchmark:
+  def setup(scale: int, workspace: Path) -> Callable[[], object]:
+    settings = scaled_settings(scale)
+    github = fixtures.make_github(workspace, event_name="pull_request")
+    cfg = generate(settings_mod, settings, github)
+    build_platform = fixtures.platform_names(scale)[-1]
+    inputs = fixtures.make_inputs(
+      base_image=cfg.pull_request.validation.basic.base_images[0],
+      build_platform=build_platform,
+      build_architecture=build_platform.split("/")[-1],
+      skip_unchanged=True,
+    )
+    return lambda: workflow.configure(CLONE_DIR, cfg, github, inputs)
+
+  return Benchmark(f"configure:{name}", setup)
+
+
+def bench_summarize(
+  settings_mod: object, release_notes: object, name: str, size: Callable[[int], tuple]
+) -> Benchmark:
+  # `size` returns the number of images, and of layers per image, for a scale
+  from release_tracker import ReleaseTracker
+
+  def setup(scale: int, workspace: Path) -> Callable[[], object]:
+    settings = scaled_settings(2)
+    github = fixtures.make_github(workspace)
+    cfg = generate(settings_mod, settings, github)
+    images, layers = size(scale)
+    fixtures.write_release_fixtures(
+      workspace,
+      cfg,
+      images=images,
+      layers=layers,
+      version_id=ReleaseTracker.version_id(fixtures.TRACKER_CREATED_AT, cfg.build.version),
+    )
+    inputs = fixtures.make_inputs()
+    return lambda: release_notes.summarize(CLONE_DIR, github, inputs, cfg)
+
+  return Benchmark(f"summarize:{name}", setup)
+
+
+def benchmarks() -> list:
+  settings_mod = load_module(PYCONFIG_DIR / "settings.py")
+  result = [bench_settings(settings_mod)]
+  workflows = workflow_modules()
+  for name, workflow in workflows.items():
+    if hasattr(workflow, "configure"):
+      result.append(bench_configure(settings_mod, name, workflow))
+  release_notes = workflows.get("release_notes")
+  if release_notes is not None:
+    for name, size in (
+      ("images", lambda scale: (16 * scale, 2)),
+      ("layers", lambda scale: (4, 4 * scale)),
+    ):
+      result.append(bench_summarize(settings_mod, release_notes, name, size))
+  return result
+
+
+###############################################################################
+# Measurements
+###############################################################################
+def measure(fn: Callable[[], object], repeat: int) -> dict:
+  # Calibrate the number of calls per sample (like timeit's autorange),
+  # then report per-call times. The hooks' console output is discarded.
+  with contextlib.redirect_stdout(io.StringIO()):
+    number = 1
+    while True:
+      start = time.perf_counter()
+      for _ in range(number):
+        fn()
+      elapsed = time.perf_counter() - start
+      if elapsed >= MIN_SAMPLE_TIME:
+        break
+      number *= 2
+    samples = [elapsed / number]
+    for _ in range(repeat - 1):
+      start = time.perf_counter()
+      for _ in range(number):
+        fn()
+      samples.append((time.perf_counter() - start) / number)
+  return {
+    "number": number,
+    "repeat": repeat,
+    "min": min(samples),
+    "median": statistics.median(samples),
+    "mean": statistics.mean(samples),
+  }
+
+
+def growth_slope(results: list) -> Optional[float]:
+  # Least-squares slope of log(median) over log(scale)
+  points = [(math.log(r["scale"]), math.log(r["median"])) for r in results if r["median"] > 0]
+  if len(points) < 2:
+    return None
+  mean_x = statistics.mean(x for x, _ in points)
+  mean_y = statistics.mean(y for _, y in points)
+  den = sum((x - mean_x) ** 2 for x, _ in points)
+  if den == 0:
+    return None
+  return sum((x - mean_x) * (y - mean_y) for x, y in points) / den
+
+
+def run_benchmark(bench: Benchmark, scales: list, repeat: int, baseline: dict, tolerance: float):
+  results = []
+  regressions = []
+  for scale in scales:
+    with tempfile.TemporaryDirectory(prefix="pyconfig-bench-") as tmp_dir:
+      fn = bench.setup(scale, Path(tmp_dir))
+      result = {"scale": scale, **measure(fn, repeat)}
+    results.append(result)
+    previous = baseline.get((bench.name, scale))
+    if previous is not None and result["median"] > previous["median"] * tolerance:
+      regressions.append(
+        f"{bench.name}[{scale}]: {result['median'] * 1000:.4g}ms"
+        f" > {tolerance} x {previous['median'] * 1000:.4g}ms (baseline)"
+      )
+    print(
+      f"{bench.name:<36} scale={scale:<5} median={result['median'] * 1000:10.3f}ms"
+      f" (x{result['number']})",
+      file=sys.stderr,
+    )
+  slope = growth_slope(results)
+  if slope is not None and slope > bench.max_slope:
+    regressions.append(f"{bench.name}: growth slope {slope:.2f} > {bench.max_slope}")
+  return {
+    "name": bench.name,
+    "max_slope": bench.max_slope,
+    "slope": slope,
+    "results": results,
+    "regressions": regressions,
+  }
+
+
+def load_baseline(path: Optional[Path]) -> dict:
+  if path is None:
+    return {}
+  data = json.loads(path.read_text())
+  return {
+    (bench["name"], result["scale"]): result
+    for bench in data["benchmarks"]
+    for result in bench["results"]
+  }
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Benchmark the pyconfig hooks.")
+  parser.add_argument(
+    "-o", "--output", type=Path, default=None, help="Write results to this file (default: stdout)"
+  )
+  parser.add_argument(
+    "-s",
+    "--scale",
+    type=int,
+    action="append",
+    default=None,
+    help=f"Scale factor to measure (repeatable, default: {DEFAULT_SCALES})",
+  )
+  parser.add_argument(
+    "-k", "--filter", default=None, help="Only run benchmarks whose name contains this string"
+  )
+  parser.add_argument("-r", "--repeat", type=int, default=5, help="Timing samples per scale")
+  parser.add_argument(
+    "-b", "--baseline", type=Path, default=None, help="Compare against a previous result file"
+  )
+  parser.add_argument(
+    "-t",
+    "--tolerance",
+    type=float,
+    default=DEFAULT_TOLERANCE,
+    help=f"Slowdown allowed against the baseline (default: {DEFAULT_TOLERANCE})",
+  )
+  parser.add_argument(
+    "--max-slope",
+    type=float,
+    default=None,
+    help=f"Override the growth threshold of all benchmarks (default: {DEFAULT_MAX_SLOPE})",
+  )
+  parser.add_argument(
+    "-L",
+    "--lib-dir",
+    type=Path,
+    action="append",
+    default=[],
+    help="Additional directory to search for modules (e.g. pyconfig, release_tracker)",
+  )
+  args = parser.parse_args()
+
+  if args.repeat < 1:
+    parser.error("--repeat must be at least 1")
+  scales = sorted(set(args.scale or DEFAULT_SCALES))
+  if scales[0] < 1:
+    parser.error("scales must be positive")
+
+  sys.path[:0] = [str(PYCONFIG_DIR), *(str(d.resolve()) for d in args.lib_dir)]
+  # summarize() appends to the step summary when it is available
+  os.environ.pop("GITHUB_STEP_SUMMARY", None)
+
+  try:
+    selected = [b for b in benchmarks() if not args.filter or args.filter in b.name]
+  except ImportError as e:
+    parser.error(f"failed to load hooks: {e} (use --lib-dir to locate it)")
+  if args.max_slope is not None:
+    selected = [b._replace(max_slope=args.max_slope) for b in selected]
+  baseline = load_baseline(args.baseline)
+
+  results = [run_benchmark(b, scales, args.repeat, baseline, args.tolerance) for b in selected]
+  regressions = [r for bench in results for r in bench["regressions"]]
+  report = {
+    "created_at": datetime.now().isoformat(timespec="seconds"),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "scales": scales,
+    "tolerance": args.tolerance,
+    "benchmarks": results,
+    "regressions": regressions,
+  }
+  output = json.dumps(report, indent=2)
+  if args.output is None:
+    print(output)
+  else:
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(output)
+
+  for regression in regressions:
+    print(f"REGRESSION {regression}", file=sys.stderr)
+  if regressions:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,145 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Generate BuildKit cache configurations (`cache-from`/`cache-to`) for the
+# Docker builds of the CI and release workflows.
+#
+# Every build has a cache key (e.g. "tester", base image and platform), and
+# stores its layers in the "scope" of the current ref. Builds import the
+# layers of their own scope first, then those of a list of fallback scopes,
+# e.g. a nightly build of branch `foo` uses the caches of `foo`, `master`,
+# and `stable`, in this order. Scope names are deterministic, so that every
+# run of the same build reuses (and updates) the same cache.
+#
+# Supported backends:
+#
+# - "registry": layers are stored as tags of an image repository.
+#   Exports don't fail the build (e.g. when the job's token can only read
+#   packages, like in PRs).
+# - "local": layers are stored in a directory on the runner (only useful on
+#   self-hosted runners). Builds export to a temporary directory, which must
+#   then replace the previous one (`build_cache.py rotate DIR`), so that the
+#   cache doesn't keep growing with every build.
+###############################################################################
+import argparse
+import hashlib
+import re
+import shutil
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from matrix_planner import unique
+
+# Docker tags may contain at most 128 characters
+MAX_TAG_LEN = 128
+
+
+class CacheConfig(NamedTuple):
+  cache_from: list
+  cache_to: str
+  # For local caches, the directory to rotate after the build
+  local_dir: str = ""
+
+  def outputs(self) -> dict:
+    return {
+      "cache_from": "\n".join(self.cache_from),
+      "cache_to": self.cache_to,
+      "local_dir": self.local_dir,
+    }
+
+
+def default_cache_dir() -> Path:
+  from cache_dir import default_cache_dir
+
+  return default_cache_dir() / "buildkit"
+
+
+def scope_name(*parts: str) -> str:
+  # A valid Docker tag (and directory name) for the given components
+  name = "-".join(re.sub(r"[^a-z0-9_.-]+", "-", p.lower()).strip("-.") for p in parts if p)
+  if len(name) > MAX_TAG_LEN:
+    digest = hashlib.sha256(name.encode()).hexdigest()[:12]
+    name = f"{name[: MAX_TAG_LEN - len(digest) - 1]}-{digest}"
+  return name
+
+
+def ref_scope(github: NamedTuple) -> str:
+  # Tagged builds share the "stable" cache, branches have one each
+  if github.ref_type == "tag":
+    return "stable"
+  return github.ref_name
+
+
+def cache_config(
+  cfg: NamedTuple,
+  key: str,
+  scope: str,
+  cache_dir: Optional[Path] = None,
+) -> CacheConfig:
+  # `cfg` is a `build_cache` section of settings.yml
+  if not cfg.backend:
+    return CacheConfig([], "")
+  scopes = [scope_name(key, s) for s in unique([scope, *cfg.fallback])]
+  if cfg.backend == "registry":
+    return CacheConfig(
+      cache_from=[f"type=registry,ref={cfg.repo}:{s}" for s in scopes],
+      cache_to=(
+        f"type=registry,ref={cfg.repo}:{scopes[0]},mode=max"
+        ",image-manifest=true,oci-mediatypes=true,ignore-error=true"
+      ),
+    )
+  elif cfg.backend == "local":
+    root = Path(cfg.dir) if cfg.dir else (cache_dir or default_cache_dir())
+    local_dir = root / scopes[0]
+    return CacheConfig(
+      # Missing directories would only cause warnings, but the build
+      # always runs on the host which generates the configuration.
+      cache_from=[f"type=local,src={root / s}" for s in scopes if (root / s).is_dir()],
+      cache_to=f"type=local,dest={local_dir}.new,mode=max",
+      local_dir=str(local_dir),
+    )
+  raise ValueError(f"unsupported build cache backend: {cfg.backend}")
+
+
+def rotate(local_dir: Path) -> bool:
+  # Replace a local cache with the one exported by the last build
+  new_dir = local_dir.with_name(f"{local_dir.name}.new")
+  if not new_dir.is_dir():
+    return False
+  old_dir = local_dir.with_name(f"{local_dir.name}.old")
+  shutil.rmtree(old_dir, ignore_errors=True)
+  if local_dir.exists():
+    local_dir.rename(old_dir)
+  new_dir.rename(local_dir)
+  shutil.rmtree(old_dir, ignore_errors=True)
+  return True
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Manage local BuildKit caches")
+  subparsers = parser.add_subparsers(dest="action", required=True)
+  rotate_parser = subparsers.add_parser(
+    "rotate", help="replace a local cache with the one exported by the last build"
+  )
+  rotate_parser.add_argument("local_dir", type=Path)
+  args = parser.parse_args()
+
+  if args.action == "rotate":
+    if not rotate(args.local_dir):
+      print(f"no new cache exported for {args.local_dir}")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,36 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Location of the caches kept by the CI tools on the runner's host (e.g. the
+# local BuildKit caches, the results of earlier runs, and GitHub API
+# responses). These caches are only useful on self-hosted runners, where they
+# survive between jobs.
+#
+# pyconfig.json is not cached: every job generates it on its own host, since
+# some of its values (e.g. local paths) depend on the runner.
+###############################################################################
+import os
+from pathlib import Path
+
+
+def default_cache_dir() -> Path:
+  cache_dir = os.environ.get("PYCONFIG_CACHE_DIR")
+  if cache_dir:
+    return Path(cache_dir)
+  # The tool cache survives between jobs on self-hosted runners
+  tool_cache = os.environ.get("RUNNER_TOOL_CACHE")
+  if tool_cache:
+    return Path(tool_cache) / "pyconfig"
+  return Path.home() / ".cache" / "pyconfig"
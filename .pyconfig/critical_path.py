@@ -0,0 +1,485 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Find which jobs and steps bound the duration of a workflow run (e.g. a
+# release).
+#
+# The jobs of a run, with their steps, are exported from the GitHub API
+# (`fetch`), and analyzed offline (`analyze`). The dependencies between
+# jobs are reconstructed from the workflow files: reusable workflows
+# (`uses: ./.github/workflows/...`) are expanded, so that the jobs they
+# contain depend on the jobs that their caller `needs`, and matrix jobs
+# (e.g. `deb / build (ubuntu:22.04, amd64) / build`) are grouped under the
+# same node of the graph.
+#
+# Every node's duration is measured from the time it could start (when all
+# of its dependencies completed) to the time its last job completed, so it
+# includes the time spent waiting for a runner. The critical path is the
+# chain of nodes without slack, i.e. whose delay would delay the whole run.
+# Queue and run times are also aggregated by runner, named after the
+# matching entry of `ci.runners` (e.g. linux_arm64), when there is one:
+#
+#   python3 .pyconfig/critical_path.py fetch <RUN_ID> -o run.json
+#   python3 .pyconfig/critical_path.py analyze run.json -r timing.jsonl
+#
+# The report is printed as Markdown (e.g. for the step summary), and every
+# job is appended as a JSON record to the file passed to -r (e.g. to track
+# the trends of multiple runs). An exported release run is kept in
+# .pyconfig/tests/fixtures/release-run.json, e.g. to try the analysis offline.
+###############################################################################
+import argparse
+import json
+import os
+import re
+import statistics
+import sys
+from datetime import datetime
+from pathlib import Path
+from typing import NamedTuple, Optional, TextIO
+
+import tracing
+from markdown_stream import MarkdownStream, Sink
+
+DEFAULT_WORKFLOW = ".github/workflows/release.yml"
+# Steps listed for every job of the critical path
+TOP_STEPS = 5
+# Nodes with less slack than this (seconds) are on the critical path
+SLACK_EPSILON = 1.0
+
+_MATRIX_SUFFIX_RE = re.compile(r" \(.*\)$")
+
+
+class Node(NamedTuple):
+  name: str
+  needs: tuple
+
+
+class JobRun(NamedTuple):
+  name: str
+  node: str
+  runner: str
+  created_at: datetime
+  started_at: datetime
+  completed_at: datetime
+  conclusion: str
+  steps: list
+
+  @property
+  def queue_time(self) -> float:
+    return max(0.0, (self.started_at - self.created_at).total_seconds())
+
+  @property
+  def run_time(self) -> float:
+    return max(0.0, (self.completed_at - self.started_at).total_seconds())
+
+
+###############################################################################
+# Job graph
+###############################################################################
+def _needs(job: dict) -> list:
+  needs = job.get("needs") or []
+  return [needs] if isinstance(needs, str) else list(needs)
+
+
+def _local_workflow(uses: Optional[str]) -> Optional[str]:
+  if uses and uses.startswith("./"):
+    return uses[2:].split("@")[0]
+  return None
+
+
+def workflow_graph(clone_dir: Path, workflow: str, prefix: str = "", stack: tuple = ()) -> dict:
+  # {node name: Node}, with reusable workflows expanded. Node names follow
+  # the job names displayed by GitHub: "<caller job> / <job>".
+  import yaml
+
+  if workflow in stack:
+    raise ValueError(f"recursive workflow call: {' -> '.join([*stack, workflow])}")
+  jobs = yaml.safe_load((clone_dir / workflow).read_text()).get("jobs") or {}
+  # The nodes of each job (one, or all the jobs of a reusable workflow),
+  # and those which complete it (the ones that no other job needs)
+  expanded = {}
+  for job_id, job in jobs.items():
+    name = f"{prefix}{job_id}"
+    called = _local_workflow(job.get("uses"))
+    if called is None:
+      expanded[job_id] = ({name: Node(name, ())}, [name])
+      continue
+    subgraph = workflow_graph(clone_dir, called, f"{name} / ", (*stack, workflow))
+    needed = {n for node in subgraph.values() for n in node.needs}
+    expanded[job_id] = (subgraph, [n for n in subgraph if n not in needed])
+  graph = {}
+  for job_id, job in jobs.items():
+    # Every node of a job waits for the completion of the jobs it needs
+    deps = tuple(n for need in _needs(job) for n in expanded[need][1])
+    for name, node in expanded[job_id][0].items():
+      inner = node.needs
+      graph[name] = Node(name, tuple(dict.fromkeys((*inner, *deps))) if deps else inner)
+  return graph
+
+
+def node_name(job_name: str) -> str:
+  # Strip the matrix values from every component of a job's name
+  return " / ".join(_MATRIX_SUFFIX_RE.sub("", part) for part in job_name.split(" / "))
+
+
+###############################################################################
+# Run exports
+###############################################################################
+def _timestamp(value: Optional[str]) -> Optional[datetime]:
+  return datetime.fromisoformat(value.replace("Z", "+00:00")) if value else None
+
+
+def runner_names(runners: dict) -> dict:
+  # {frozenset of labels: name} from `ci.runners`
+  result = {}
+  for name, labels in runners.items():
+    labels = [labels] if isinstance(labels, str) else labels
+    result[frozenset(labels)] = name
+  return result
+
+
+def load_jobs(export: dict, runners: dict) -> list:
+  # The completed jobs of an exported run
+  result = []
+  for job in export["jobs"]:
+    started_at = _timestamp(job.get("started_at"))
+    completed_at = _timestamp(job.get("completed_at"))
+    if job.get("status") != "completed" or not started_at or not completed_at:
+      continue
+    labels = job.get("labels") or []
+    runner = runners.get(frozenset(labels)) or ",".join(labels) or "unknown"
+    steps = [
+      (step["name"], (_timestamp(step["completed_at"]) - _timestamp(step["started_at"])))
+      for step in job.get("steps") or []
+      if step.get("started_at") and step.get("completed_at")
+    ]
+    result.append(
+      JobRun(
+        name=job["name"],
+        node=node_name(job["name"]),
+        runner=runner,
+        created_at=_timestamp(job.get("created_at")) or started_at,
+        started_at=started_at,
+        completed_at=completed_at,
+        conclusion=job.get("conclusion") or "",
+        steps=[(name, duration.total_seconds()) for name, duration in steps],
+      )
+    )
+  return result
+
+
+###############################################################################
+# Analysis
+###############################################################################
+@tracing.span("critical_path.analyze")
+def analyze(graph: dict, jobs: list) -> dict:
+  runs = {}
+  for job in jobs:
+    runs.setdefault(job.node, []).append(job)
+  # Jobs which aren't in the graph (e.g. the workflow changed) have no
+  # known dependencies
+  for name in runs:
+    if name not in graph:
+      graph = {**graph, name: Node(name, ())}
+  nodes = [name for name in _topological_order(graph) if name in runs]
+  if not nodes:
+    raise ValueError("no completed jobs to analyze")
+  run_start = min(job.created_at for job in jobs)
+  end = {name: max(job.completed_at for job in runs[name]) for name in nodes}
+
+  # Forward pass: every node becomes ready when its dependencies complete
+  ready = {}
+  for name in nodes:
+    deps = [d for d in graph[name].needs if d in end]
+    ready[name] = max((end[d] for d in deps), default=run_start)
+  duration = {name: (end[name] - ready[name]).total_seconds() for name in nodes}
+  finish = {name: (end[name] - run_start).total_seconds() for name in nodes}
+  total = max(finish.values())
+
+  # Backward pass: the latest time each node could complete without
+  # delaying the run
+  successors = {name: [] for name in nodes}
+  for name in nodes:
+    for dep in graph[name].needs:
+      if dep in successors:
+        successors[dep].append(name)
+  latest = {}
+  for name in reversed(nodes):
+    latest[name] = min(
+      (latest[s] - duration[s] for s in successors[name]),
+      default=total,
+    )
+  slack = {name: max(0.0, latest[name] - finish[name]) for name in nodes}
+
+  # The critical path, from the last node back to the first
+  path = []
+  current = max(nodes, key=lambda n: finish[n])
+  while current is not None:
+    path.append(current)
+    deps = [d for d in graph[current].needs if d in end and end[d] == ready[current]]
+    current = deps[0] if deps else None
+  path.reverse()
+
+  return {
+    "started_at": run_start.isoformat(),
+    "duration": total,
+    "critical_path": [
+      {
+        "node": name,
+        "start": (ready[name] - run_start).total_seconds(),
+        "duration": duration[name],
+        "queue_time": max(job.queue_time for job in runs[name]),
+        "steps": _top_steps(runs[name]),
+      }
+      for name in path
+    ],
+    "nodes": [
+      {
+        "node": name,
+        "needs": [d for d in graph[name].needs if d in end],
+        "jobs": len(runs[name]),
+        "ready": (ready[name] - run_start).total_seconds(),
+        "finish": finish[name],
+        "duration": duration[name],
+        "slack": slack[name],
+        "critical": slack[name] < SLACK_EPSILON,
+      }
+      for name in nodes
+    ],
+    "runners": _runner_stats(jobs),
+  }
+
+
+def _topological_order(graph: dict) -> list:
+  order = []
+  state = {}
+
+  def visit(name: str) -> None:
+    if state.get(name) == "done":
+      return
+    if state.get(name) == "visiting":
+      raise ValueError(f"circular job dependency: '{name}'")
+    state[name] = "visiting"
+    for dep in graph[name].needs:
+      if dep in graph:
+        visit(dep)
+    state[name] = "done"
+    order.append(name)
+
+  for name in graph:
+    visit(name)
+  return order
+
+
+def _top_steps(jobs: list) -> list:
+  # The longest steps of a node's slowest job
+  slowest = max(jobs, key=lambda job: job.run_time)
+  steps = sorted(slowest.steps, key=lambda s: s[1], reverse=True)[:TOP_STEPS]
+  return [{"job": slowest.name, "step": name, "duration": d} for name, d in steps]
+
+
+def _runner_stats(jobs: list) -> list:
+  by_runner = {}
+  for job in jobs:
+    by_runner.setdefault(job.runner, []).append(job)
+  return [
+    {
+      "runner": runner,
+      "jobs": len(runner_jobs),
+      "queue_total": sum(j.queue_time for j in runner_jobs),
+      "queue_median": statistics.median(j.queue_time for j in runner_jobs),
+      "queue_max": max(j.queue_time for j in runner_jobs),
+      "run_total": sum(j.run_time for j in runner_jobs),
+      "run_median": statistics.median(j.run_time for j in runner_jobs),
+    }
+    for runner, runner_jobs in sorted(by_runner.items())
+  ]
+
+
+def records(export: dict, report: dict, jobs: list) -> list:
+  # One time-series record per job, and one for the whole run
+  run = export.get("run") or {}
+  nodes = {node["node"]: node for node in report["nodes"]}
+  base = {
+    "run_id": run.get("id"),
+    "run_attempt": run.get("run_attempt"),
+    "workflow": run.get("name"),
+    "head_branch": run.get("head_branch"),
+    "started_at": report["started_at"],
+  }
+  result = [
+    {
+      **base,
+      "kind": "run",
+      "duration": report["duration"],
+      "critical_path": [n["node"] for n in report["critical_path"]],
+    }
+  ]
+  for job in jobs:
+    node = nodes[job.node]
+    result.append(
+      {
+        **base,
+        "kind": "job",
+        "job": job.name,
+        "node": job.node,
+        "runner": job.runner,
+        "conclusion": job.conclusion,
+        "queue_time": job.queue_time,
+        "run_time": job.run_time,
+        "slack": node["slack"],
+        "critical": node["critical"],
+      }
+    )
+  return result
+
+
+###############################################################################
+# Output
+###############################################################################
+def _duration(seconds: float) -> str:
+  minutes, seconds = divmod(int(round(seconds)), 60)
+  return f"{minutes}m{seconds:02d}s" if minutes else f"{seconds}s"
+
+
+def render(report: dict, output: TextIO) -> None:
+  out = MarkdownStream([Sink(output)])
+  out.write("## Critical Path", "", f"Total duration: **{_duration(report['duration'])}**", "")
+  out.table(
+    ["**Job**", "**Start**", "**Duration**", "**Queued**", "**Longest Steps**"],
+    (
+      [
+        f"`{node['node']}`",
+        _duration(node["start"]),
+        _duration(node["duration"]),
+        _duration(node["queue_time"]),
+        "<br>".join(f"{s['step']} ({_duration(s['duration'])})" for s in node["steps"]),
+      ]
+      for node in report["critical_path"]
+    ),
+  )
+  out.write("", "## Slack", "")
+  out.table(
+    ["**Job**", "**Jobs**", "**Ready**", "**Finish**", "**Slack**"],
+    (
+      [
+        f"`{node['node']}`" + (" :red_circle:" if node["critical"] else ""),
+        str(node["jobs"]),
+        _duration(node["ready"]),
+        _duration(node["finish"]),
+        _duration(node["slack"]),
+      ]
+      for node in sorted(report["nodes"], key=lambda n: n["slack"])
+    ),
+  )
+  out.write("", "## Runners", "")
+  out.table(
+    ["**Runner**", "**Jobs**", "**Queued (median/max)**", "**Queued (total)**", "**Run (total)**"],
+    (
+      [
+        f"`{r['runner']}`",
+        str(r["jobs"]),
+        f"{_duration(r['queue_median'])} / {_duration(r['queue_max'])}",
+        _duration(r["queue_total"]),
+        _duration(r["run_total"]),
+      ]
+      for r in report["runners"]
+    ),
+  )
+  out.write("")
+  out.close()
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def fetch(run_id: int, repository: str) -> dict:
+  from github_api import GitHubClient
+
+  with GitHubClient() as client:
+    run = client.get(f"repos/{repository}/actions/runs/{run_id}", cache=False)
+    jobs = []
+    page = 1
+    while True:
+      result = client.get(
+        f"repos/{repository}/actions/runs/{run_id}/jobs",
+        {"filter": "latest", "per_page": 100, "page": page},
+        cache=False,
+      )
+      jobs.extend(result["jobs"])
+      if len(jobs) >= result["total_count"] or not result["jobs"]:
+        break
+      page += 1
+  return {"run": run, "jobs": jobs}
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Analyze the critical path of a workflow run")
+  subparsers = parser.add_subparsers(dest="action", required=True)
+
+  fetch_parser = subparsers.add_parser("fetch", help="export a run's jobs from the GitHub API")
+  fetch_parser.add_argument("run_id", type=int)
+  fetch_parser.add_argument(
+    "-R", "--repository", default=os.environ.get("GITHUB_REPOSITORY"), help="OWNER/REPO"
+  )
+  fetch_parser.add_argument("-o", "--output", type=Path, required=True)
+
+  analyze_parser = subparsers.add_parser("analyze", help="analyze an exported run")
+  analyze_parser.add_argument("export", type=Path, help="file generated by `fetch`")
+  analyze_parser.add_argument("-C", "--clone-dir", type=Path, default=Path.cwd())
+  analyze_parser.add_argument("-w", "--workflow", default=DEFAULT_WORKFLOW, help="root workflow")
+  analyze_parser.add_argument(
+    "-s", "--settings", type=Path, default=None, help="settings.yml (for the runner names)"
+  )
+  analyze_parser.add_argument("-j", "--json", type=Path, default=None, help="write the report")
+  analyze_parser.add_argument("-r", "--records", type=Path, default=None, help="append records")
+  args = parser.parse_args()
+
+  if args.action == "fetch":
+    if not args.repository:
+      parser.error("--repository is required (or GITHUB_REPOSITORY)")
+    from github_api import GitHubAPIError
+
+    try:
+      export = fetch(args.run_id, args.repository)
+    except GitHubAPIError as e:
+      print(f"ERROR {e}", file=sys.stderr)
+      sys.exit(1)
+    args.output.write_text(json.dumps(export))
+    return
+
+  from snapshot import load_dict
+
+  settings_yml = args.settings or args.clone_dir / ".pyconfig" / "settings.yml"
+  runners = runner_names(load_dict(settings_yml, validate=False)["ci"]["runners"])
+  export = json.loads(args.export.read_text())
+  graph = workflow_graph(args.clone_dir, args.workflow)
+  jobs = load_jobs(export, runners)
+  try:
+    report = analyze(graph, jobs)
+  except ValueError as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+  render(report, sys.stdout)
+  if args.json is not None:
+    args.json.write_text(json.dumps(report, indent=2))
+  if args.records is not None:
+    with args.records.open("a") as output:
+      for record in records(export, report, jobs):
+        output.write(json.dumps(record) + "\n")
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,99 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Index of the Debian packages found in a directory of build artifacts.
+#
+# The directory is scanned once, and every `<name>_<version>_<arch>.deb`
+# file is indexed by (name, arch). SHA256 checksums are computed on demand,
+# in parallel, by hashing memory-mapped files (hashlib releases the GIL
+# while hashing large buffers, so threads scale with the available cores).
+###############################################################################
+import hashlib
+import mmap
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional
+
+
+class DebPackage:
+  __slots__ = ("path", "name", "version", "arch", "size", "sha256")
+
+  def __init__(self, path: Path, name: str, version: str, arch: str, size: int) -> None:
+    self.path = path
+    self.name = name
+    self.version = version
+    self.arch = arch
+    self.size = size
+    self.sha256 = None
+
+  def __repr__(self) -> str:
+    return f"DebPackage({self.name!r}, {self.version!r}, {self.arch!r})"
+
+
+def parse_deb_filename(filename: str) -> Optional[tuple]:
+  # Package names cannot contain "_", and neither can (mangled) versions
+  # nor architectures, so a valid file name has exactly three components.
+  if not filename.endswith(".deb"):
+    return None
+  parts = filename[: -len(".deb")].split("_")
+  if len(parts) != 3 or not all(parts):
+    return None
+  return tuple(parts)
+
+
+def sha256_file(path: Path) -> str:
+  with open(path, "rb") as f:
+    if os.fstat(f.fileno()).st_size == 0:
+      return hashlib.sha256().hexdigest()
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+      return hashlib.sha256(data).hexdigest()
+
+
+class ArtifactIndex:
+  def __init__(self, packages: Iterable[DebPackage]) -> None:
+    self.packages = sorted(packages, key=lambda pkg: pkg.path.name)
+    self._by_name_arch = {}
+    for pkg in self.packages:
+      self._by_name_arch.setdefault((pkg.name, pkg.arch), []).append(pkg)
+
+  @classmethod
+  def scan(cls, artifacts_dir: Path) -> "ArtifactIndex":
+    packages = []
+    try:
+      entries = list(os.scandir(artifacts_dir))
+    except FileNotFoundError:
+      entries = []
+    for entry in entries:
+      parsed = parse_deb_filename(entry.name)
+      if parsed is None or not entry.is_file():
+        continue
+      name, version, arch = parsed
+      packages.append(DebPackage(Path(entry.path), name, version, arch, entry.stat().st_size))
+    return cls(packages)
+
+  def find(self, name: str, arch: str) -> list:
+    return self._by_name_arch.get((name, arch), [])
+
+  def missing(self, name: str, architectures: Iterable[str]) -> list:
+    return [arch for arch in architectures if (name, arch) not in self._by_name_arch]
+
+  def compute_checksums(self, max_workers: Optional[int] = None) -> dict:
+    pending = [pkg for pkg in self.packages if pkg.sha256 is None]
+    if pending:
+      with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as pool:
+        for pkg, checksum in zip(pending, pool.map(sha256_file, (p.path for p in pending))):
+          pkg.sha256 = checksum
+    return {pkg.path.name: pkg.sha256 for pkg in self.packages}
@@ -0,0 +1,232 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Model for the docker-manifests.json files stored by the release tracker.
+#
+# Each file contains the manifest lists of the released images:
+#
+#   {"images": {"<image>": {"manifests": [{"digest": ..., "platform": {...},
+#                                           "annotations": {...}}, ...]}}}
+#
+# Attestation manifests have an "unknown" platform and reference the
+# manifest they describe through the "vnd.docker.reference.digest"
+# annotation. Layers are indexed by digest, so that these references are
+# resolved in constant time.
+###############################################################################
+import json
+from pathlib import Path
+from typing import Iterator, Optional, TextIO
+
+REFERENCE_ANNOTATION = "vnd.docker.reference.digest"
+
+# Files larger than this are parsed incrementally, one image at a time
+STREAM_THRESHOLD = 32 * 1024 * 1024
+
+
+class ManifestLayer:
+  __slots__ = ("image", "digest", "os", "architecture", "variant", "unknown", "reference")
+
+  def __init__(
+    self,
+    image: str,
+    digest: str,
+    os: str,
+    architecture: str,
+    variant: Optional[str] = None,
+    reference: Optional[str] = None,
+  ) -> None:
+    self.image = image
+    self.digest = digest
+    self.os = os
+    self.architecture = architecture
+    self.variant = variant
+    self.unknown = os == "unknown"
+    self.reference = reference
+
+  @classmethod
+  def from_dict(cls, image: str, manifest: dict) -> "ManifestLayer":
+    platform = manifest.get("platform") or {}
+    return cls(
+      image=image,
+      digest=manifest["digest"],
+      os=platform.get("os", "unknown"),
+      architecture=platform.get("architecture", "unknown"),
+      variant=platform.get("variant"),
+      reference=(manifest.get("annotations") or {}).get(REFERENCE_ANNOTATION),
+    )
+
+  @property
+  def platform(self) -> dict:
+    platform = {"os": self.os, "architecture": self.architecture}
+    if self.variant:
+      platform["variant"] = self.variant
+    return platform
+
+  def __repr__(self) -> str:
+    return f"ManifestLayer({self.image!r}, {self.digest!r}, {self.os}/{self.architecture})"
+
+
+class ImageManifest:
+  __slots__ = ("name", "layers")
+
+  def __init__(self, name: str, manifests: list) -> None:
+    self.name = name
+    # Index layers by digest (duplicate entries are collapsed)
+    self.layers = {}
+    for manifest in manifests:
+      layer = ManifestLayer.from_dict(name, manifest)
+      self.layers[layer.digest] = layer
+    # Attestation layers take the platform of the manifest they reference
+    for layer in self.layers.values():
+      if not layer.unknown or layer.reference is None:
+        continue
+      base = self.layers.get(layer.reference)
+      if base is not None:
+        layer.os, layer.architecture, layer.variant = base.os, base.architecture, base.variant
+
+  def __getitem__(self, digest: str) -> ManifestLayer:
+    return self.layers[digest]
+
+  def platform_layers(self) -> Iterator[ManifestLayer]:
+    # Platform manifests first, followed by attestations
+    yield from (layer for layer in self.layers.values() if not layer.unknown)
+    yield from (layer for layer in self.layers.values() if layer.unknown)
+
+
+class DockerManifests:
+  def __init__(self, images: Optional[dict] = None) -> None:
+    self.images = images or {}
+    self._by_digest = None
+
+  @classmethod
+  def from_dict(cls, data: dict) -> "DockerManifests":
+    return cls.from_images(data.get("images", {}).items())
+
+  @classmethod
+  def from_images(cls, images) -> "DockerManifests":
+    return cls({name: ImageManifest(name, m.get("manifests", [])) for name, m in images})
+
+  @classmethod
+  def load(cls, path: Path, stream: Optional[bool] = None) -> "DockerManifests":
+    path = Path(path)
+    if stream is None:
+      stream = path.stat().st_size > STREAM_THRESHOLD
+    with path.open() as input:
+      if stream:
+        return cls.from_images(iter_images(input))
+      return cls.from_dict(json.load(input))
+
+  @property
+  def by_digest(self) -> dict:
+    # Digest index across all images (a digest may be shared by several tags)
+    if self._by_digest is None:
+      self._by_digest = {}
+      for image in self.images.values():
+        for digest, layer in image.layers.items():
+          self._by_digest.setdefault(digest, []).append(layer)
+    return self._by_digest
+
+  def find(self, digest: str) -> list:
+    return self.by_digest.get(digest, [])
+
+  def layer_count(self) -> int:
+    return sum(len(image.layers) for image in self.images.values())
+
+  def layers(self) -> Iterator[ManifestLayer]:
+    for image in self.images.values():
+      yield from image.platform_layers()
+
+
+###############################################################################
+# Incremental parser
+###############################################################################
+class _StreamReader:
+  def __init__(self, input: TextIO, chunk_size: int) -> None:
+    self.input = input
+    self.chunk_size = chunk_size
+    self.buffer = ""
+    self.pos = 0
+    self.eof = False
+    self.decoder = json.JSONDecoder()
+
+  def _fill(self) -> bool:
+    if self.eof:
+      return False
+    chunk = self.input.read(self.chunk_size)
+    if not chunk:
+      self.eof = True
+      return False
+    # Drop consumed input so that memory use stays bounded
+    self.buffer = self.buffer[self.pos :] + chunk
+    self.pos = 0
+    return True
+
+  def peek(self) -> str:
+    while True:
+      while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+        self.pos += 1
+      if self.pos < len(self.buffer):
+        return self.buffer[self.pos]
+      if not self._fill():
+        raise ValueError("unexpected end of JSON input")
+
+  def expect(self, char: str) -> None:
+    if self.peek() != char:
+      raise ValueError(f"expected '{char}' at offset {self.pos}, found '{self.peek()}'")
+    self.pos += 1
+
+  def value(self) -> object:
+    self.peek()
+    while True:
+      try:
+        value, end = self.decoder.raw_decode(self.buffer, self.pos)
+      except json.JSONDecodeError:
+        if self._fill():
+          continue
+        raise
+      # A scalar ending exactly at the end of the buffer might be truncated
+      if end == len(self.buffer) and self._fill():
+        continue
+      self.pos = end
+      return value
+
+
+def iter_images(input: TextIO, chunk_size: int = 1024 * 1024) -> Iterator[tuple]:
+  # Yield (image, manifest) pairs from a docker-manifests.json file, without
+  # loading the whole document in memory.
+  reader = _StreamReader(input, chunk_size)
+  reader.expect("{")
+  if reader.peek() == "}":
+    return
+  while True:
+    key = reader.value()
+    reader.expect(":")
+    if key != "images":
+      reader.value()
+    else:
+      reader.expect("{")
+      if reader.peek() != "}":
+        while True:
+          name = reader.value()
+          reader.expect(":")
+          yield name, reader.value()
+          if reader.peek() != ",":
+            break
+          reader.expect(",")
+      reader.expect("}")
+    if reader.peek() != ",":
+      break
+    reader.expect(",")
+  reader.expect("}")
@@ -0,0 +1,328 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Minimal in-process client for GitHub's REST and GraphQL APIs, used by the
+# hooks instead of spawning the `gh` CLI.
+#
+# - Connections are kept alive and reused for every request to the same host.
+# - GET responses are cached on disk by URL, and revalidated with conditional
+#   requests (If-None-Match/If-Modified-Since). "304 Not Modified" replies
+#   don't count against the API rate limit.
+# - Requests failing with a server error, a connection error, or because of
+#   rate limiting are retried with exponential backoff, honoring the
+#   Retry-After and X-RateLimit-Reset headers.
+#
+# The endpoints are read from GITHUB_API_URL and GITHUB_GRAPHQL_URL (set by
+# GitHub Actions), so the client can be pointed to GitHub Enterprise, or to a
+# local server for testing. The token is read from GH_TOKEN or GITHUB_TOKEN.
+###############################################################################
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+from urllib.parse import urlencode, urlsplit
+
+import tracing
+
+DEFAULT_API_URL = "https://api.github.com"
+DEFAULT_TIMEOUT = 30
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF = 0.5
+MAX_RETRY_DELAY = 60
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+USER_AGENT = "pyconfig-github-api"
+
+REVIEW_DECISION_QUERY = """
+query($owner: String!, $name: String!, $number: Int!) {
+  repository(owner: $owner, name: $name) {
+    pullRequest(number: $number) {
+      reviewDecision
+    }
+  }
+}
+"""
+
+
+class GitHubAPIError(Exception):
+  def __init__(self, message: str, status: Optional[int] = None) -> None:
+    super().__init__(message)
+    self.status = status
+
+
+class Response(NamedTuple):
+  status: int
+  headers: dict
+  body: bytes
+
+  def json(self) -> object:
+    return json.loads(self.body) if self.body else None
+
+
+def default_cache_dir() -> Path:
+  from cache_dir import default_cache_dir
+
+  return default_cache_dir() / "github-api"
+
+
+class ConnectionPool:
+  # Idle keep-alive connections, by (scheme, host, port)
+  def __init__(self, timeout: float = DEFAULT_TIMEOUT) -> None:
+    self.timeout = timeout
+    self._idle = {}
+    self._lock = threading.Lock()
+
+  def acquire(self, scheme: str, host: str, port: Optional[int]) -> http.client.HTTPConnection:
+    key = (scheme, host, port)
+    with self._lock:
+      idle = self._idle.get(key)
+      if idle:
+        return idle.pop()
+    if scheme == "https":
+      return http.client.HTTPSConnection(host, port, timeout=self.timeout)
+    return http.client.HTTPConnection(host, port, timeout=self.timeout)
+
+  def release(self, scheme: str, conn: http.client.HTTPConnection) -> None:
+    with self._lock:
+      self._idle.setdefault((scheme, conn.host, conn.port), []).append(conn)
+
+  def close(self) -> None:
+    with self._lock:
+      idle, self._idle = self._idle, {}
+    for conns in idle.values():
+      for conn in conns:
+        conn.close()
+
+
+class GitHubClient:
+  def __init__(
+    self,
+    token: Optional[str] = None,
+    api_url: Optional[str] = None,
+    graphql_url: Optional[str] = None,
+    cache_dir: Optional[Path] = None,
+    max_retries: int = DEFAULT_MAX_RETRIES,
+    backoff: float = DEFAULT_BACKOFF,
+    timeout: float = DEFAULT_TIMEOUT,
+  ) -> None:
+    self.token = token or os.environ.get("GH_TOKEN") or os.environ.get("GITHUB_TOKEN")
+    self.api_url = (api_url or os.environ.get("GITHUB_API_URL") or DEFAULT_API_URL).rstrip("/")
+    self.graphql_url = (
+      graphql_url or os.environ.get("GITHUB_GRAPHQL_URL") or f"{self.api_url}/graphql"
+    )
+    self.cache_dir = Path(cache_dir) if cache_dir is not None else default_cache_dir()
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.pool = ConnectionPool(timeout)
+
+  def __enter__(self) -> "GitHubClient":
+    return self
+
+  def __exit__(self, *exc_info: object) -> None:
+    self.close()
+
+  def close(self) -> None:
+    self.pool.close()
+
+  def url(self, path: str, params: Optional[dict] = None) -> str:
+    url = path if "://" in path else f"{self.api_url}/{path.lstrip('/')}"
+    if params:
+      url = f"{url}{'&' if '?' in url else '?'}{urlencode(params)}"
+    return url
+
+  def _headers(self, headers: Optional[dict]) -> dict:
+    result = {
+      "Accept": "application/vnd.github+json",
+      "User-Agent": USER_AGENT,
+      "X-GitHub-Api-Version": "2022-11-28",
+    }
+    if self.token:
+      result["Authorization"] = f"Bearer {self.token}"
+    result.update(headers or {})
+    return result
+
+  def _send(self, method: str, url: str, body: Optional[bytes], headers: dict) -> Response:
+    parts = urlsplit(url)
+    target = parts.path or "/"
+    if parts.query:
+      target = f"{target}?{parts.query}"
+    conn = self.pool.acquire(parts.scheme, parts.hostname, parts.port)
+    try:
+      conn.request(method, target, body=body, headers=headers)
+      resp = conn.getresponse()
+      data = resp.read()
+    except Exception:
+      # The connection is in an unknown state (or was closed by the server)
+      conn.close()
+      raise
+    resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+    if resp.will_close:
+      conn.close()
+    else:
+      self.pool.release(parts.scheme, conn)
+    return Response(resp.status, resp_headers, data)
+
+  def _retry_delay(self, attempt: int, response: Optional[Response]) -> Optional[float]:
+    # Return how long to wait before retrying, or None if the request
+    # should not be retried
+    if attempt >= self.max_retries:
+      return None
+    delay = self.backoff * (2**attempt) * (1 + random.random())
+    if response is not None:
+      rate_limited = response.status == 403 and (
+        "retry-after" in response.headers or response.headers.get("x-ratelimit-remaining") == "0"
+      )
+      if response.status not in RETRY_STATUS and not rate_limited:
+        return None
+      retry_after = response.headers.get("retry-after")
+      reset = response.headers.get("x-ratelimit-reset")
+      if retry_after is not None and retry_after.isdigit():
+        delay = float(retry_after)
+      elif response.headers.get("x-ratelimit-remaining") == "0" and reset and reset.isdigit():
+        delay = max(0.0, int(reset) - time.time()) + 1
+    if delay > MAX_RETRY_DELAY:
+      return None
+    return delay
+
+  def request(
+    self,
+    method: str,
+    path: str,
+    params: Optional[dict] = None,
+    body: Optional[object] = None,
+    headers: Optional[dict] = None,
+  ) -> Response:
+    url = self.url(path, params)
+    headers = self._headers(headers)
+    data = None
+    if body is not None:
+      data = json.dumps(body).encode()
+      headers["Content-Type"] = "application/json"
+    attempt = 0
+    while True:
+      with tracing.span(f"{method} {urlsplit(url).path}", cat="github", attempt=attempt):
+        try:
+          response = self._send(method, url, data, headers)
+          error = None
+        except (OSError, http.client.HTTPException) as e:
+          response = None
+          error = e
+      delay = self._retry_delay(attempt, response)
+      if delay is None:
+        break
+      time.sleep(delay)
+      attempt += 1
+    if error is not None:
+      raise GitHubAPIError(f"{method} {url} failed: {error}") from error
+    if response.status >= 400 and response.status != 304:
+      message = response.body.decode(errors="replace").strip()
+      try:
+        message = json.loads(message).get("message", message)
+      except (ValueError, AttributeError):
+        pass
+      raise GitHubAPIError(f"{method} {url} failed ({response.status}): {message}", response.status)
+    return response
+
+  def _cache_entry(self, url: str) -> Path:
+    # Responses depend on the credentials used to request them
+    token_id = hashlib.sha256((self.token or "").encode()).hexdigest()
+    return self.cache_dir / f"{hashlib.sha256(f'{token_id} {url}'.encode()).hexdigest()}.json"
+
+  def get(self, path: str, params: Optional[dict] = None, cache: bool = True) -> object:
+    url = self.url(path, params)
+    entry = self._cache_entry(url) if cache else None
+    cached = None
+    headers = {}
+    if entry is not None and entry.exists():
+      try:
+        cached = json.loads(entry.read_text())
+      except ValueError:
+        cached = None
+    if cached is not None:
+      if cached.get("etag"):
+        headers["If-None-Match"] = cached["etag"]
+      if cached.get("last_modified"):
+        headers["If-Modified-Since"] = cached["last_modified"]
+    response = self.request("GET", url, headers=headers)
+    if response.status == 304 and cached is not None:
+      return cached["data"]
+    result = response.json()
+    etag = response.headers.get("etag")
+    last_modified = response.headers.get("last-modified")
+    if entry is not None and (etag or last_modified):
+      entry.parent.mkdir(parents=True, exist_ok=True)
+      tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+      tmp.write_text(
+        json.dumps({"url": url, "etag": etag, "last_modified": last_modified, "data": result})
+      )
+      tmp.replace(entry)
+    return result
+
+  def graphql(self, query: str, variables: Optional[dict] = None) -> dict:
+    response = self.request(
+      "POST", self.graphql_url, body={"query": query, "variables": variables or {}}
+    )
+    result = response.json()
+    errors = result.get("errors")
+    if errors:
+      raise GitHubAPIError(
+        "GraphQL query failed: " + "; ".join(e.get("message", str(e)) for e in errors)
+      )
+    return result["data"]
+
+
+def review_decision(client: GitHubClient, repository: str, number: int) -> str:
+  # Return the review decision of a PR (e.g. "approved", "changes_requested"),
+  # or an empty string if the PR doesn't require a review.
+  owner, name = repository.split("/")
+  data = client.graphql(
+    REVIEW_DECISION_QUERY, {"owner": owner, "name": name, "number": int(number)}
+  )
+  pull_request = (data.get("repository") or {}).get("pullRequest") or {}
+  return (pull_request.get("reviewDecision") or "").lower()
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Query the GitHub API")
+  subparsers = parser.add_subparsers(dest="command", required=True)
+  get_parser = subparsers.add_parser("get", help="GET a REST endpoint (with caching)")
+  get_parser.add_argument("path", help="endpoint path, e.g. repos/OWNER/REPO")
+  get_parser.add_argument("--no-cache", action="store_true", help="bypass the response cache")
+  review_parser = subparsers.add_parser("review-decision", help="print a PR's review decision")
+  review_parser.add_argument("repository", help="OWNER/REPO")
+  review_parser.add_argument("number", type=int, help="pull request number")
+  args = parser.parse_args()
+
+  try:
+    with GitHubClient() as client:
+      if args.command == "get":
+        print(json.dumps(client.get(args.path, cache=not args.no_cache), indent=2))
+      else:
+        print(review_decision(client, args.repository, args.number))
+  except GitHubAPIError as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,141 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Export a selection of values from pyconfig.json to GITHUB_OUTPUT in a
+# single pass, e.g.:
+#
+#   python3 .pyconfig/github_output.py pyconfig.json \
+#     BUILD_PROFILE=build.profile \
+#     DOCKER_TAGS_CONFIG=release.tags_config \
+#     CI_RUNNER
+#
+# Every argument has the form NAME=dotted.path (or just NAME, to export a
+# top-level key with the same name). Values are rendered like `jq -r` would,
+# and multiline values are written using a heredoc delimiter.
+###############################################################################
+import argparse
+import io
+import json
+import os
+import sys
+import uuid
+from pathlib import Path
+from typing import Iterable, Optional, TextIO
+
+import tracing
+
+
+def flatten(value: object, prefix: str = "", result: Optional[dict] = None) -> dict:
+  # Map every nested value to its dotted path. Intermediate dictionaries
+  # are kept too, so that whole sections can also be exported (as JSON).
+  if result is None:
+    result = {}
+  if prefix:
+    result[prefix] = value
+  if isinstance(value, dict):
+    for k, v in value.items():
+      flatten(v, f"{prefix}.{k}" if prefix else str(k), result)
+  return result
+
+
+def lookup(values: dict, key: str) -> object:
+  # Only read the values along the path, so that lazily evaluated settings
+  # (see lazy_settings.py) aren't computed unless they are exported.
+  value = values
+  for part in key.split("."):
+    if not isinstance(value, dict) or part not in value:
+      raise KeyError(key)
+    value = value[part]
+  return value
+
+
+def render(value: object) -> str:
+  # Mimic `jq -r`: strings are printed raw, everything else as JSON
+  if isinstance(value, str):
+    return value
+  return json.dumps(value)
+
+
+def format_output(name: str, value: object) -> str:
+  value = render(value)
+  if "\n" not in value:
+    return f"{name}={value}\n"
+  delimiter = "EOF"
+  lines = value.splitlines()
+  while delimiter in lines:
+    delimiter = f"EOF_{uuid.uuid4().hex}"
+  return f"{name}<<{delimiter}\n{value}\n{delimiter}\n"
+
+
+def parse_spec(spec: Iterable[str]) -> list[tuple[str, str]]:
+  result = []
+  for entry in spec:
+    name, sep, key = entry.partition("=")
+    name = name.strip()
+    key = key.strip() if sep else name
+    if not name or not key:
+      raise ValueError(f"invalid output specification: '{entry}'")
+    result.append((name, key))
+  return result
+
+
+@tracing.span("export")
+def export(values: dict, spec: Iterable[tuple[str, str]], output: TextIO) -> dict:
+  exported = {}
+  for name, key in spec:
+    try:
+      value = lookup(values, key)
+    except KeyError:
+      raise KeyError(f"key not found in configuration: '{key}' (for output {name})") from None
+    exported[name] = value
+  output.write("".join(format_output(name, value) for name, value in exported.items()))
+  return exported
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Export pyconfig values to GITHUB_OUTPUT")
+  parser.add_argument("config", type=Path, help="JSON file generated by pyconfig")
+  parser.add_argument("outputs", nargs="+", metavar="NAME[=KEY]", help="outputs to export")
+  parser.add_argument(
+    "-o",
+    "--output",
+    type=Path,
+    default=os.environ.get("GITHUB_OUTPUT"),
+    help="output file (default: $GITHUB_OUTPUT)",
+  )
+  parser.add_argument("-q", "--quiet", action="store_true", help="don't echo outputs to stdout")
+  args = parser.parse_args()
+
+  with tracing.span("load pyconfig.json"), args.config.open() as input:
+    values = json.load(input)
+  try:
+    spec = parse_spec(args.outputs)
+    if args.output is None:
+      export(values, spec, sys.stdout)
+      return
+    # Render everything before touching the output file, so that a
+    # missing key doesn't leave a partial set of outputs behind.
+    buffer = io.StringIO()
+    exported = export(values, spec, buffer)
+  except (KeyError, ValueError) as e:
+    parser.error(e.args[0])
+  with tracing.span("write GITHUB_OUTPUT", outputs=len(exported)), args.output.open("a") as output:
+    output.write(buffer.getvalue())
+  if not args.quiet:
+    sys.stdout.write("".join(format_output(name, value) for name, value in exported.items()))
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,587 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Read-only access to git metadata (HEAD, refs, short SHAs, tags, commit
+# timestamps) directly from the repository's `.git` directory, without
+# spawning any `git` process.
+#
+# Supported layouts: regular clones, submodules and worktrees (i.e. `.git`
+# files with a `gitdir:` pointer, and `commondir`), loose and packed refs,
+# loose and packed objects (including deltified ones), and alternates.
+# The index (i.e. the list of tracked files) can be read in versions 2 to 4,
+# except for split and sparse indexes.
+# Repositories using the reftable backend, or SHA-256 object names, raise
+# GitMetaError, and callers are expected to fall back to the `git` CLI.
+###############################################################################
+import argparse
+import functools
+import hashlib
+import json
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+SHA_HEX_LEN = 40
+MIN_ABBREV = 7
+
+OBJ_COMMIT = 1
+OBJ_TREE = 2
+OBJ_BLOB = 3
+OBJ_TAG = 4
+OBJ_OFS_DELTA = 6
+OBJ_REF_DELTA = 7
+OBJ_TYPES = {OBJ_COMMIT: "commit", OBJ_TREE: "tree", OBJ_BLOB: "blob", OBJ_TAG: "tag"}
+
+MODE_GITLINK = 0o160000
+MODE_DIRECTORY = 0o040000
+
+
+class GitMetaError(Exception):
+  pass
+
+
+class HeadState(NamedTuple):
+  sha: str
+  # Full name of the checked out ref (e.g. refs/heads/master), or None if detached
+  ref: Optional[str]
+
+
+class RefInfo(NamedTuple):
+  sha: str
+  sha_short: str
+  branch: Optional[str]
+  tags: list
+  timestamp: int
+
+  @property
+  def ref_type(self) -> str:
+    return "tag" if self.tags and self.branch is None else "branch"
+
+
+class IndexEntry(NamedTuple):
+  path: str
+  mode: int
+  sha: str
+  size: int
+  mtime_ns: int
+  # Merge stage (non-zero for unmerged paths)
+  stage: int = 0
+
+  @property
+  def gitlink(self) -> bool:
+    return self.mode == MODE_GITLINK
+
+
+def find_git_dir(path: Path) -> Path:
+  path = Path(path).resolve()
+  for candidate in (path, *path.parents):
+    dot_git = candidate / ".git"
+    if dot_git.is_dir():
+      return dot_git
+    if dot_git.is_file():
+      # Submodules and worktrees use a `.git` file pointing to the actual git dir
+      content = dot_git.read_text().strip()
+      if not content.startswith("gitdir:"):
+        raise GitMetaError(f"invalid .git file: {dot_git}")
+      return (candidate / content[len("gitdir:") :].strip()).resolve()
+  raise GitMetaError(f"not a git repository: {path}")
+
+
+class _PackIndex:
+  def __init__(self, idx_file: Path) -> None:
+    self.idx_file = idx_file
+    self.pack_file = idx_file.with_suffix(".pack")
+    with idx_file.open("rb") as f:
+      self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if self.data[:8] != b"\377tOc\0\0\0\2":
+      raise GitMetaError(f"unsupported pack index format: {idx_file}")
+    self.fanout = struct.unpack_from(">256I", self.data, 8)
+    self.count = self.fanout[255]
+    self.names_offset = 8 + 256 * 4
+    self.offsets_offset = self.names_offset + self.count * (20 + 4)
+    self.large_offsets_offset = self.offsets_offset + self.count * 4
+    self._pack = None
+
+  def name(self, i: int) -> bytes:
+    start = self.names_offset + i * 20
+    return self.data[start : start + 20]
+
+  def _range(self, first_byte: int) -> tuple:
+    lo = self.fanout[first_byte - 1] if first_byte > 0 else 0
+    return lo, self.fanout[first_byte]
+
+  def _bisect(self, key: bytes) -> int:
+    lo, hi = self._range(key[0])
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.name(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    return lo
+
+  def find(self, sha: bytes) -> Optional[int]:
+    i = self._bisect(sha)
+    if i < self.count and self.name(i) == sha:
+      return self.offset(i)
+    return None
+
+  def matches(self, prefix: str) -> set:
+    # Return the full names of all objects starting with a hex prefix
+    padded = bytes.fromhex(prefix[: len(prefix) & ~1].ljust(2, "0"))
+    result = set()
+    i = self._bisect(padded)
+    while i < self.count:
+      name = self.name(i).hex()
+      if not name.startswith(prefix[: len(prefix) & ~1]):
+        break
+      if name.startswith(prefix):
+        result.add(name)
+      i += 1
+    return result
+
+  def offset(self, i: int) -> int:
+    (offset,) = struct.unpack_from(">I", self.data, self.offsets_offset + i * 4)
+    if offset & 0x80000000:
+      (offset,) = struct.unpack_from(
+        ">Q", self.data, self.large_offsets_offset + (offset & 0x7FFFFFFF) * 8
+      )
+    return offset
+
+  @property
+  def pack(self) -> mmap.mmap:
+    if self._pack is None:
+      with self.pack_file.open("rb") as f:
+        self._pack = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return self._pack
+
+
+def _inflate(data: mmap.mmap, offset: int) -> bytes:
+  decompressor = zlib.decompressobj()
+  result = []
+  chunk = 4096
+  while not decompressor.eof:
+    buf = data[offset : offset + chunk]
+    if not buf:
+      raise GitMetaError("truncated pack entry")
+    result.append(decompressor.decompress(buf))
+    offset += chunk
+    chunk *= 2
+  return b"".join(result)
+
+
+def _delta_varint(delta: bytes, pos: int) -> tuple:
+  value = shift = 0
+  while True:
+    byte = delta[pos]
+    pos += 1
+    value |= (byte & 0x7F) << shift
+    shift += 7
+    if not byte & 0x80:
+      return value, pos
+
+
+def _apply_delta(base: bytes, delta: bytes) -> bytes:
+  _, pos = _delta_varint(delta, 0)
+  result_size, pos = _delta_varint(delta, pos)
+  result = bytearray()
+  while pos < len(delta):
+    op = delta[pos]
+    pos += 1
+    if op & 0x80:
+      copy_offset = copy_size = 0
+      for i in range(4):
+        if op & (1 << i):
+          copy_offset |= delta[pos] << (8 * i)
+          pos += 1
+      for i in range(3):
+        if op & (0x10 << i):
+          copy_size |= delta[pos] << (8 * i)
+          pos += 1
+      result += base[copy_offset : copy_offset + (copy_size or 0x10000)]
+    elif op:
+      result += delta[pos : pos + op]
+      pos += op
+    else:
+      raise GitMetaError("invalid delta opcode")
+  if len(result) != result_size:
+    raise GitMetaError("delta produced an object of unexpected size")
+  return bytes(result)
+
+
+def _offset_varint(data: bytes, pos: int) -> tuple:
+  # Variable-length integer, as used by OFS_DELTA offsets and index v4 paths
+  byte = data[pos]
+  pos += 1
+  value = byte & 0x7F
+  while byte & 0x80:
+    byte = data[pos]
+    pos += 1
+    value = ((value + 1) << 7) | (byte & 0x7F)
+  return value, pos
+
+
+def hash_blob(path: Path) -> str:
+  # The name of the blob object git would create for a file (or symlink)
+  if os.path.islink(path):
+    data = os.fsencode(os.readlink(path))
+  else:
+    data = Path(path).read_bytes()
+  return hashlib.sha1(b"blob %d\0" % len(data) + data).hexdigest()
+
+
+def _parse_index(data: bytes) -> list:
+  if len(data) < 32 or data[:4] != b"DIRC":
+    raise GitMetaError("invalid index file")
+  version, count = struct.unpack(">II", data[4:12])
+  if version not in (2, 3, 4):
+    raise GitMetaError(f"unsupported index version: {version}")
+  entries = []
+  pos = 12
+  prev_path = b""
+  for _ in range(count):
+    start = pos
+    (_, _, mtime_s, mtime_ns, _, _, mode, _, _, size) = struct.unpack(">10I", data[pos : pos + 40])
+    sha = data[pos + 40 : pos + 60].hex()
+    (flags,) = struct.unpack(">H", data[pos + 60 : pos + 62])
+    pos += 62
+    if flags & 0x4000:
+      if version < 3:
+        raise GitMetaError("extended index entry in a version 2 index")
+      pos += 2
+    if version == 4:
+      # Path prefix-compressed against the previous entry
+      strip, pos = _offset_varint(data, pos)
+      end = data.index(b"\0", pos)
+      path = prev_path[: len(prev_path) - strip] + data[pos:end]
+      pos = end + 1
+    else:
+      end = data.index(b"\0", pos)
+      path = data[pos:end]
+      # Entries are NUL-padded to a multiple of 8 bytes
+      pos = start + ((end - start + 8) & ~7)
+    prev_path = path
+    if mode == MODE_DIRECTORY:
+      raise GitMetaError("sparse indexes are not supported")
+    entries.append(
+      IndexEntry(
+        path=path.decode(),
+        mode=mode,
+        sha=sha,
+        size=size,
+        mtime_ns=mtime_s * 1_000_000_000 + mtime_ns,
+        stage=(flags >> 12) & 0x3,
+      )
+    )
+  # Extensions follow the entries, up to the trailing checksum
+  while pos + 8 <= len(data) - 20:
+    signature = data[pos : pos + 4]
+    (ext_size,) = struct.unpack(">I", data[pos + 4 : pos + 8])
+    if signature == b"link":
+      raise GitMetaError("split indexes are not supported")
+    pos += 8 + ext_size
+  return entries
+
+
+class Repository:
+  def __init__(self, git_dir: Path) -> None:
+    self.git_dir = git_dir
+    commondir = git_dir / "commondir"
+    if commondir.is_file():
+      self.common_dir = (git_dir / commondir.read_text().strip()).resolve()
+    else:
+      self.common_dir = git_dir
+    if (self.common_dir / "reftable").exists():
+      raise GitMetaError(f"reftable repositories are not supported: {self.common_dir}")
+    self._packed_refs = None
+    self._packs = None
+    self._objects = {}
+    self._index = None
+
+  #############################################################################
+  # References
+  #############################################################################
+  @property
+  def packed_refs(self) -> dict:
+    # Map each packed ref to a (sha, peeled sha) tuple
+    if self._packed_refs is None:
+      self._packed_refs = {}
+      packed_refs = self.common_dir / "packed-refs"
+      if packed_refs.is_file():
+        last = None
+        for line in packed_refs.read_text().splitlines():
+          if not line or line.startswith("#"):
+            continue
+          if line.startswith("^"):
+            if last is not None:
+              self._packed_refs[last] = (self._packed_refs[last][0], line[1:].strip())
+            continue
+          sha, _, name = line.partition(" ")
+          self._packed_refs[name] = (sha, None)
+          last = name
+    return self._packed_refs
+
+  def _read_loose_ref(self, name: str) -> Optional[str]:
+    # HEAD and other pseudo-refs are per-worktree, everything else is shared
+    base_dirs = [self.git_dir] if "/" not in name else [self.git_dir, self.common_dir]
+    for base_dir in dict.fromkeys(base_dirs):
+      ref_file = base_dir / name
+      if ref_file.is_file():
+        return ref_file.read_text().strip()
+    return None
+
+  def resolve_ref(self, name: str, depth: int = 0) -> Optional[str]:
+    if depth > 10:
+      raise GitMetaError(f"too many levels of symbolic refs: {name}")
+    value = self._read_loose_ref(name)
+    if value is None:
+      packed = self.packed_refs.get(name)
+      return packed[0] if packed else None
+    if value.startswith("ref:"):
+      return self.resolve_ref(value[4:].strip(), depth + 1)
+    return value
+
+  def head(self) -> HeadState:
+    value = self._read_loose_ref("HEAD")
+    if value is None:
+      raise GitMetaError(f"HEAD not found in {self.git_dir}")
+    if value.startswith("ref:"):
+      ref = value[4:].strip()
+      sha = self.resolve_ref(ref)
+      if sha is None:
+        raise GitMetaError(f"HEAD points to an unborn branch: {ref}")
+      return HeadState(sha=sha, ref=ref)
+    return HeadState(sha=value, ref=None)
+
+  def refs(self, prefix: str = "refs/") -> dict:
+    # Map every ref under `prefix` to the sha it points to, and (for annotated
+    # tags) to the sha of the object it peels to.
+    result = {name: sha for name, sha in self.packed_refs.items() if name.startswith(prefix)}
+    refs_dir = self.common_dir / prefix
+    if refs_dir.is_dir():
+      for ref_file in refs_dir.rglob("*"):
+        if ref_file.is_file():
+          name = ref_file.relative_to(self.common_dir).as_posix()
+          sha = self.resolve_ref(name)
+          if sha is not None:
+            result[name] = (sha, None)
+    return result
+
+  def tags_at(self, sha: str) -> list:
+    tags = []
+    for name, (tag_sha, peeled) in self.refs("refs/tags/").items():
+      if peeled is None and tag_sha != sha:
+        # Loose annotated tags are not peeled, check the tag object
+        try:
+          obj_type, data = self.read_object(tag_sha)
+        except GitMetaError:
+          continue
+        if obj_type == "tag":
+          peeled = data.split(b"\n", 1)[0].split(b" ", 1)[1].decode()
+      if sha in (tag_sha, peeled):
+        tags.append(name[len("refs/tags/") :])
+    return sorted(tags)
+
+  #############################################################################
+  # Objects
+  #############################################################################
+  def _object_dirs(self) -> list:
+    dirs = [self.common_dir / "objects"]
+    alternates = dirs[0] / "info" / "alternates"
+    if alternates.is_file():
+      for line in alternates.read_text().splitlines():
+        line = line.strip()
+        if line and not line.startswith("#"):
+          dirs.append((dirs[0] / line).resolve())
+    return dirs
+
+  @property
+  def packs(self) -> list:
+    if self._packs is None:
+      self._packs = [
+        _PackIndex(idx)
+        for objects_dir in self._object_dirs()
+        for idx in sorted((objects_dir / "pack").glob("*.idx"))
+        if idx.with_suffix(".pack").is_file()
+      ]
+    return self._packs
+
+  def _read_packed(self, pack: _PackIndex, offset: int) -> tuple:
+    data = pack.pack
+    byte = data[offset]
+    obj_type = (byte >> 4) & 0x7
+    pos = offset + 1
+    while byte & 0x80:
+      byte = data[pos]
+      pos += 1
+    if obj_type == OBJ_OFS_DELTA:
+      base_distance, pos = _offset_varint(data, pos)
+      base_type, base = self._read_packed(pack, offset - base_distance)
+      return base_type, _apply_delta(base, _inflate(data, pos))
+    if obj_type == OBJ_REF_DELTA:
+      base_type, base = self.read_object(data[pos : pos + 20].hex())
+      return base_type, _apply_delta(base, _inflate(data, pos + 20))
+    if obj_type not in OBJ_TYPES:
+      raise GitMetaError(f"invalid object type in {pack.pack_file}: {obj_type}")
+    return OBJ_TYPES[obj_type], _inflate(data, pos)
+
+  def read_object(self, sha: str) -> tuple:
+    cached = self._objects.get(sha)
+    if cached is not None:
+      return cached
+    if len(sha) != SHA_HEX_LEN:
+      raise GitMetaError(f"unsupported object name: {sha}")
+    result = None
+    for objects_dir in self._object_dirs():
+      loose = objects_dir / sha[:2] / sha[2:]
+      if loose.is_file():
+        raw = zlib.decompress(loose.read_bytes())
+        header, _, body = raw.partition(b"\0")
+        result = (header.split(b" ", 1)[0].decode(), body)
+        break
+    if result is None:
+      binsha = bytes.fromhex(sha)
+      for pack in self.packs:
+        offset = pack.find(binsha)
+        if offset is not None:
+          result = self._read_packed(pack, offset)
+          break
+    if result is None:
+      raise GitMetaError(f"object not found: {sha}")
+    self._objects[sha] = result
+    return result
+
+  def commit_timestamp(self, sha: str) -> int:
+    obj_type, data = self.read_object(sha)
+    if obj_type == "tag":
+      return self.commit_timestamp(data.split(b"\n", 1)[0].split(b" ", 1)[1].decode())
+    if obj_type != "commit":
+      raise GitMetaError(f"not a commit: {sha} ({obj_type})")
+    for line in data.split(b"\n"):
+      if not line:
+        break
+      if line.startswith(b"committer "):
+        return int(line.rsplit(b" ", 2)[1])
+    raise GitMetaError(f"commit without committer: {sha}")
+
+  def _matches(self, prefix: str) -> set:
+    result = set()
+    for objects_dir in self._object_dirs():
+      loose_dir = objects_dir / prefix[:2]
+      if loose_dir.is_dir():
+        result.update(prefix[:2] + f.name for f in loose_dir.glob(f"{prefix[2:]}*"))
+    for pack in self.packs:
+      result.update(pack.matches(prefix))
+    return result
+
+  def abbrev_len(self) -> int:
+    # Same heuristic used by git for core.abbrev=auto, based on the
+    # (approximate) number of packed objects.
+    count = sum(pack.count for pack in self.packs)
+    bits = count.bit_length()
+    return max(MIN_ABBREV, (bits + 1) // 2)
+
+  def abbrev(self, sha: str) -> str:
+    length = self.abbrev_len()
+    while length < SHA_HEX_LEN and len(self._matches(sha[:length])) > 1:
+      length += 1
+    return sha[:length]
+
+  #############################################################################
+  # Index
+  #############################################################################
+  def index(self) -> list:
+    # The entries of the index (per worktree), sorted by path
+    if self._index is None:
+      index_file = self.git_dir / "index"
+      if not index_file.is_file():
+        self._index = []
+      else:
+        self._index = _parse_index(index_file.read_bytes())
+    return self._index
+
+
+###############################################################################
+# Cached per-process accessors
+###############################################################################
+@functools.lru_cache(maxsize=None)
+def _open_repository(git_dir: Path) -> Repository:
+  return Repository(git_dir)
+
+
+def open_repository(path: Path) -> Repository:
+  return _open_repository(find_git_dir(Path(path)))
+
+
+@functools.lru_cache(maxsize=None)
+def _ref_info(git_dir: Path) -> RefInfo:
+  repo = _open_repository(git_dir)
+  head = repo.head()
+  branch = None
+  if head.ref is not None and head.ref.startswith("refs/heads/"):
+    branch = head.ref[len("refs/heads/") :]
+  return RefInfo(
+    sha=head.sha,
+    sha_short=repo.abbrev(head.sha),
+    branch=branch,
+    tags=repo.tags_at(head.sha),
+    timestamp=repo.commit_timestamp(head.sha),
+  )
+
+
+def ref_info(path: Path) -> RefInfo:
+  return _ref_info(find_git_dir(Path(path)))
+
+
+def index_entries(path: Path) -> list:
+  return open_repository(path).index()
+
+
+def sha_short(path: Path) -> str:
+  repo = open_repository(path)
+  return repo.abbrev(repo.head().sha)
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Read git metadata without invoking git")
+  parser.add_argument("-C", "--repo", type=Path, default=Path.cwd(), help="repository directory")
+  parser.add_argument(
+    "query",
+    choices=["sha", "sha-short", "branch", "tags", "timestamp", "ref-type", "json"],
+    nargs="?",
+    default="json",
+  )
+  args = parser.parse_args()
+  info = ref_info(args.repo)
+  if args.query == "json":
+    print(json.dumps({**info._asdict(), "ref_type": info.ref_type}))
+  elif args.query == "tags":
+    print("\n".join(info.tags))
+  else:
+    value = {
+      "sha": info.sha,
+      "sha-short": info.sha_short,
+      "branch": info.branch or "",
+      "timestamp": info.timestamp,
+      "ref-type": info.ref_type,
+    }[args.query]
+    print(value)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,161 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Parsed Docker image references.
+#
+# parse() splits a reference into its components (following the grammar of
+# `docker pull`), e.g.:
+#
+#   ghcr.io/mentalsmash/ref-project-debdocker:1.0.0@sha256:...
+#   <registry>/<namespace>/<repo>:<tag>@<digest>
+#
+# Components which are omitted are left empty (e.g. `ubuntu:22.04` has no
+# registry and no namespace), so that a reference can always be rendered
+# back as it was written. Results are cached, and the same ImageRef object
+# is returned for every occurrence of a reference, so that settings with
+# many (mostly repeated) images only parse each of them once.
+#
+# Every hook uses the same functions to classify the registries of a list
+# of images (registries()), and to derive Docker tags from an image name
+# (label(), e.g. `ubuntu:22.04` -> `ubuntu-22.04`).
+###############################################################################
+from functools import lru_cache
+from typing import Iterable, Optional
+
+DOCKER_HUB = "docker.io"
+GITHUB = "ghcr.io"
+# Alternative names of Docker Hub's registry
+DOCKER_HUB_ALIASES = {DOCKER_HUB, "index.docker.io", "registry-1.docker.io"}
+
+# Registry (as named by the pyconfig `login` settings) of each domain
+REGISTRY_NAMES = {
+  GITHUB: "github",
+  DOCKER_HUB: "dockerhub",
+}
+
+# Characters of a reference which are not allowed in a Docker tag
+_LABEL_TABLE = str.maketrans({"/": "-", ":": "-", "@": "-"})
+
+
+class ImageRef:
+  __slots__ = ("image", "registry", "namespace", "repo", "tag", "digest")
+
+  def __init__(
+    self, image: str, registry: str, namespace: str, repo: str, tag: str, digest: str
+  ) -> None:
+    self.image = image
+    self.registry = registry
+    self.namespace = namespace
+    self.repo = repo
+    self.tag = tag
+    self.digest = digest
+
+  @classmethod
+  def from_str(cls, image: str) -> "ImageRef":
+    name, _, digest = image.partition("@")
+    # A tag follows the last ":", unless it's a registry's port
+    sep = name.rfind(":")
+    if sep > name.rfind("/"):
+      name, tag = name[:sep], name[sep + 1 :]
+    else:
+      tag = ""
+    components = name.split("/")
+    # The first component is a registry if it looks like a host name
+    if len(components) > 1 and (
+      "." in components[0] or ":" in components[0] or components[0] == "localhost"
+    ):
+      registry = components.pop(0)
+    else:
+      registry = ""
+    repo = components.pop()
+    if not repo or not all(components):
+      raise ValueError(f"invalid image reference: '{image}'")
+    return cls(image, registry, "/".join(components), repo, tag, digest)
+
+  @property
+  def domain(self) -> str:
+    # The registry's host, with Docker Hub's default made explicit
+    return DOCKER_HUB if not self.registry or self.registry in DOCKER_HUB_ALIASES else self.registry
+
+  @property
+  def path(self) -> str:
+    # The repository, without the registry (e.g. `mentalsmash/ref-project`)
+    return f"{self.namespace}/{self.repo}" if self.namespace else self.repo
+
+  @property
+  def name(self) -> str:
+    # The repository, as written (without tag and digest)
+    return f"{self.registry}/{self.path}" if self.registry else self.path
+
+  @property
+  def org(self) -> str:
+    # The first component of the namespace (a user or an organization)
+    return self.namespace.split("/", 1)[0]
+
+  @property
+  def label(self) -> str:
+    return label(self.image)
+
+  def __eq__(self, other: object) -> bool:
+    if not isinstance(other, ImageRef):
+      return NotImplemented
+    return self.image == other.image
+
+  def __hash__(self) -> int:
+    return hash(self.image)
+
+  def __str__(self) -> str:
+    return self.image
+
+  def __repr__(self) -> str:
+    return f"ImageRef({self.image!r})"
+
+
+@lru_cache(maxsize=4096)
+def parse(image: str) -> ImageRef:
+  return ImageRef.from_str(image)
+
+
+@lru_cache(maxsize=4096)
+def label(image: str) -> str:
+  # A Docker tag derived from an image reference (e.g. for the images built
+  # on top of it), which is also a valid file and artifact name
+  return image.translate(_LABEL_TABLE)
+
+
+def tagged(repo: str, base_image: str) -> str:
+  # The image of `repo` tagged after `base_image`
+  return f"{repo}:{label(base_image)}"
+
+
+def registry(org: str, image: str) -> Optional[str]:
+  # The registry (by its pyconfig name) which requires a login to access
+  # the image: GitHub for any package, and Docker Hub for the repositories
+  # of `org`. None if the image doesn't require one (e.g. public images)
+  ref = parse(image)
+  domain = ref.domain
+  if domain == DOCKER_HUB and ref.org != org:
+    return None
+  return REGISTRY_NAMES.get(domain)
+
+
+def registries(org: str, images: Iterable[str]) -> set:
+  # The registries which require a login to access any of the images
+  result = set()
+  for image in dict.fromkeys(images):
+    reg = registry(org, image)
+    if reg is not None:
+      result.add(reg)
+  return result
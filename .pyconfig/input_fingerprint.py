@@ -0,0 +1,260 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Fingerprint the inputs of a build-and-test job, and remember which runs
+# passed with them, so that a job can be skipped when an identical one
+# already succeeded.
+#
+# The fingerprint covers every file tracked by git (except those matching
+# the `ci.fingerprint.exclude` patterns), identified by its mode and blob
+# id, and the job's parameters (e.g. base image, platform, builder tag).
+# Blob ids are read from the index, and files whose stat data differ from
+# the index (i.e. modified in the working tree) are hashed again.
+#
+# Results are kept in a "result store". The default store is a local
+# directory (under the pyconfig cache directory), which persists between
+# jobs on self-hosted runners, so results must be looked up by the job which
+# records them (not e.g. by a `config` job running on another host).
+# PYCONFIG_RESULT_STORE selects another store, as `<scheme>:<argument>` (or
+# just a path, for the local store). More schemes can be added with
+# register_store():
+#
+#   python3 .pyconfig/input_fingerprint.py lookup -f <fingerprint>
+#   # ... if not hit, run the job, then, if it passed:
+#   python3 .pyconfig/input_fingerprint.py record -f <fingerprint> test_artifact=<name>
+###############################################################################
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Callable, Iterable, Optional
+
+import tracing
+from gitmeta import GitMetaError, find_git_dir, hash_blob, index_entries
+
+FORMAT_VERSION = 1
+
+
+###############################################################################
+# Fingerprints
+###############################################################################
+def _git_ls_files(clone_dir: Path) -> list:
+  # Fallback for repositories which gitmeta can't read (e.g. split indexes)
+  output = subprocess.run(
+    ["git", "-C", str(clone_dir), "ls-files", "--stage", "-z"],
+    check=True,
+    stdout=subprocess.PIPE,
+  ).stdout.decode()
+  result = []
+  for line in output.split("\0"):
+    if not line:
+      continue
+    info, path = line.split("\t", 1)
+    mode, sha, _ = info.split(" ")
+    result.append((path, int(mode, 8), sha))
+  return result
+
+
+def _index_files(clone_dir: Path) -> list:
+  index_mtime_ns = (find_git_dir(clone_dir) / "index").stat().st_mtime_ns
+  result = []
+  for entry in index_entries(clone_dir):
+    if entry.stage != 0:
+      # Unmerged entries: the working tree is the only meaningful content
+      entry = entry._replace(size=-1)
+    sha = entry.sha
+    if not entry.gitlink:
+      try:
+        st = (clone_dir / entry.path).lstat()
+      except FileNotFoundError:
+        continue
+      # Like git, don't trust entries which are as recent as the index
+      # itself ("racily clean"), since they may have changed since.
+      if (
+        st.st_size != entry.size
+        or st.st_mtime_ns != entry.mtime_ns
+        or entry.mtime_ns >= index_mtime_ns
+      ):
+        sha = hash_blob(clone_dir / entry.path)
+    result.append((entry.path, entry.mode, sha))
+  return result
+
+
+@tracing.span("tracked files")
+def tracked_files(clone_dir: Path) -> list:
+  # (path, mode, blob id) of every tracked file, sorted by path
+  try:
+    files = _index_files(clone_dir)
+  except (GitMetaError, OSError):
+    files = _git_ls_files(clone_dir)
+  return sorted(set(files))
+
+
+def excluded(path: str, patterns: Iterable[str]) -> bool:
+  return any(fnmatch.fnmatchcase(path, pattern) for pattern in patterns)
+
+
+@tracing.span("input fingerprint")
+def fingerprint(
+  clone_dir: Path, job: str, exclude: Iterable[str] = (), **params: Optional[str]
+) -> str:
+  exclude = list(exclude or [])
+  h = hashlib.sha256()
+  h.update(f"input-fingerprint:{FORMAT_VERSION}\0{job}\0".encode())
+  h.update(json.dumps(params, sort_keys=True).encode())
+  h.update(b"\0")
+  for path, mode, sha in tracked_files(Path(clone_dir)):
+    if excluded(path, exclude):
+      continue
+    h.update(f"{mode:o} {sha} {path}\0".encode())
+  return h.hexdigest()
+
+
+###############################################################################
+# Result stores
+###############################################################################
+class ResultStore(ABC):
+  # Stores map a fingerprint to the result of the (successful) run
+  # which tested it.
+  @abstractmethod
+  def lookup(self, fingerprint: str) -> Optional[dict]:
+    pass
+
+  @abstractmethod
+  def record(self, fingerprint: str, result: dict) -> None:
+    pass
+
+
+class LocalResultStore(ResultStore):
+  def __init__(self, root: Path) -> None:
+    self.root = Path(root)
+
+  def entry(self, fingerprint: str) -> Path:
+    return self.root / fingerprint[:2] / f"{fingerprint}.json"
+
+  @tracing.span("result lookup")
+  def lookup(self, fingerprint: str) -> Optional[dict]:
+    try:
+      return json.loads(self.entry(fingerprint).read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+      return None
+
+  @tracing.span("result record")
+  def record(self, fingerprint: str, result: dict) -> None:
+    entry = self.entry(fingerprint)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps(result))
+    tmp.replace(entry)
+
+
+def default_store_dir() -> Path:
+  from cache_dir import default_cache_dir
+
+  return default_cache_dir() / "results"
+
+
+STORES = {
+  "local": lambda arg: LocalResultStore(Path(arg) if arg else default_store_dir()),
+}
+
+
+def register_store(scheme: str, factory: Callable[[str], ResultStore]) -> None:
+  STORES[scheme] = factory
+
+
+def open_store(spec: Optional[str] = None) -> ResultStore:
+  spec = spec if spec is not None else os.environ.get("PYCONFIG_RESULT_STORE", "")
+  scheme, sep, arg = spec.partition(":")
+  if not sep or scheme not in STORES:
+    scheme, arg = "local", spec
+  return STORES[scheme](arg)
+
+
+def lookup(fingerprint: str, store: Optional[ResultStore] = None) -> Optional[dict]:
+  return (store or open_store()).lookup(fingerprint)
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def _write_outputs(**outputs: str) -> None:
+  lines = "".join(f"{k}={v}\n" for k, v in outputs.items())
+  sys.stdout.write(lines)
+  github_output = os.environ.get("GITHUB_OUTPUT")
+  if github_output:
+    with open(github_output, "a") as output:
+      output.write(lines)
+
+
+def _key_value(arg: str) -> tuple:
+  key, sep, value = arg.partition("=")
+  if not sep:
+    raise argparse.ArgumentTypeError(f"expected KEY=VALUE: {arg}")
+  return key, value
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Fingerprint job inputs and record their results")
+  parser.add_argument(
+    "-s", "--store", default=None, help="result store (default: $PYCONFIG_RESULT_STORE or local)"
+  )
+  subparsers = parser.add_subparsers(dest="action", required=True)
+
+  compute = subparsers.add_parser("compute", help="print the fingerprint of a job's inputs")
+  compute.add_argument("-C", "--clone-dir", type=Path, default=Path.cwd())
+  compute.add_argument("-j", "--job", required=True)
+  compute.add_argument("-x", "--exclude", action="append", default=[], help="fnmatch pattern")
+  compute.add_argument("params", nargs="*", type=_key_value, help="KEY=VALUE job parameters")
+
+  lookup_parser = subparsers.add_parser("lookup", help="look up the result of a fingerprint")
+  lookup_parser.add_argument("-f", "--fingerprint", required=True)
+
+  record = subparsers.add_parser("record", help="record a successful result")
+  record.add_argument("-f", "--fingerprint", required=True)
+  record.add_argument("fields", nargs="*", type=_key_value, help="KEY=VALUE result fields")
+
+  args = parser.parse_args()
+  store = open_store(args.store)
+
+  if args.action == "compute":
+    print(fingerprint(args.clone_dir, args.job, args.exclude, **dict(args.params)))
+  elif args.action == "lookup":
+    result = store.lookup(args.fingerprint)
+    print(json.dumps(result), file=sys.stderr)
+    # The result's fields are exported as outputs too (e.g. run_id, test_artifact)
+    _write_outputs(hit=str(result is not None).lower(), **(result or {}))
+  elif args.action == "record":
+    store.record(
+      args.fingerprint,
+      {
+        "repository": os.environ.get("GITHUB_REPOSITORY", ""),
+        "sha": os.environ.get("GITHUB_SHA", ""),
+        "run_id": os.environ.get("GITHUB_RUN_ID", ""),
+        "run_attempt": os.environ.get("GITHUB_RUN_ATTEMPT", ""),
+        "recorded_at": int(time.time()),
+        **dict(args.fields),
+      },
+    )
+
+
+if __name__ == "__main__":
+  main()
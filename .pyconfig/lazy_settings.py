@@ -0,0 +1,152 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Lazily evaluated settings.
+#
+# Settings are declared as "fields": functions whose parameters name the
+# fields (or the inputs, e.g. `cfg` and `github`) that they depend on:
+#
+#   FIELDS = Fields()
+#
+#   @FIELDS
+#   def build_profile(github):
+#     return "stable" if github.ref_type == "tag" else "nightly"
+#
+#   @FIELDS
+#   def prerel_repo(cfg, build_profile):
+#     return f"{cfg.release.prerelease_repo}-{build_profile}"
+#
+# An evaluation computes a field (and its dependencies) the first time it
+# is read, and then memoizes it. A LazyDict is a regular dict, whose values
+# may be Lazy placeholders, which are only evaluated when read, so that
+# consumers only pay for the values which they use. Serializing the dict
+# (or calling to_dict()) evaluates everything, e.g. for debugging.
+###############################################################################
+import inspect
+from typing import Callable, Iterator
+
+import tracing
+
+_MISSING = object()
+
+
+class Lazy:
+  __slots__ = ("fn", "evaluated", "result")
+
+  def __init__(self, fn: Callable[[], object]) -> None:
+    self.fn = fn
+    self.evaluated = False
+    self.result = None
+
+  def value(self) -> object:
+    if not self.evaluated:
+      self.result = self.fn()
+      self.evaluated = True
+      self.fn = None
+    return self.result
+
+  def __repr__(self) -> str:
+    return repr(self.result) if self.evaluated else "<lazy>"
+
+
+class LazyDict(dict):
+  # Overriding __iter__ makes dict(), {**d}, and json use the methods
+  # below, instead of reading the (unevaluated) values directly.
+  def __getitem__(self, key: object) -> object:
+    value = super().__getitem__(key)
+    if isinstance(value, Lazy):
+      value = value.value()
+      super().__setitem__(key, value)
+    return value
+
+  def __iter__(self) -> Iterator:
+    return super().__iter__()
+
+  def get(self, key: object, default: object = None) -> object:
+    return self[key] if key in self else default
+
+  def items(self) -> list:
+    return [(k, self[k]) for k in self]
+
+  def values(self) -> list:
+    return [self[k] for k in self]
+
+  def copy(self) -> "LazyDict":
+    return LazyDict(super().items())
+
+  def pending(self) -> list:
+    # Keys whose value hasn't been evaluated yet
+    return [k for k, v in super().items() if isinstance(v, Lazy) and not v.evaluated]
+
+  def to_dict(self) -> dict:
+    return {k: v.to_dict() if isinstance(v, LazyDict) else v for k, v in self.items()}
+
+  def __eq__(self, other: object) -> bool:
+    return dict(self.items()) == other
+
+  def __ne__(self, other: object) -> bool:
+    return not self == other
+
+  def __repr__(self) -> str:
+    return f"LazyDict({dict.__repr__(self)})"
+
+
+class Fields:
+  # A registry of fields, which can be evaluated for different inputs
+  def __init__(self) -> None:
+    self.fields = {}
+
+  def __call__(self, fn: Callable) -> Callable:
+    deps = tuple(inspect.signature(fn).parameters)
+    self.fields[fn.__name__] = (tracing.traced(fn, f"settings.{fn.__name__}"), deps)
+    return fn
+
+  def dependencies(self, name: str) -> tuple:
+    return self.fields[name][1]
+
+  def evaluate(self, **inputs: object) -> "Evaluation":
+    return Evaluation(self, inputs)
+
+
+class Evaluation:
+  def __init__(self, fields: Fields, inputs: dict) -> None:
+    self.fields = fields
+    self.values = dict(inputs)
+    self._active = set()
+
+  def __getitem__(self, name: str) -> object:
+    value = self.values.get(name, _MISSING)
+    if value is not _MISSING:
+      return value
+    try:
+      fn, deps = self.fields.fields[name]
+    except KeyError:
+      raise KeyError(f"unknown settings field: '{name}'") from None
+    if name in self._active:
+      raise ValueError(f"circular dependency on settings field: '{name}'")
+    self._active.add(name)
+    try:
+      value = fn(*[self[dep] for dep in deps])
+    finally:
+      self._active.discard(name)
+    self.values[name] = value
+    return value
+
+  def lazy(self, name: str) -> Lazy:
+    return Lazy(lambda: self[name])
+
+  def evaluated(self) -> list:
+    # Fields computed so far (excluding the inputs)
+    return [name for name in self.fields.fields if name in self.values]
@@ -0,0 +1,118 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Incremental Markdown writer, which renders the same document to one or
+# more file-like sinks (e.g. a GitHub release body and the job's step summary),
+# each one with its own size budget.
+#
+# Content is written as soon as it is generated. When a sink runs out of
+# budget, the remaining rows of a table are replaced by a single "omitted"
+# row, other content is dropped, and a truncation notice is appended when
+# the stream is closed. A small amount of every budget is reserved for
+# these notices, so that the output never exceeds the limit.
+###############################################################################
+from typing import Iterable, Optional, TextIO
+
+# GitHub limits release bodies to 125000 characters
+RELEASE_BODY_MAX_SIZE = 125000
+# GitHub limits step summaries to 1 MiB
+STEP_SUMMARY_MAX_SIZE = 1024 * 1024
+
+RESERVED_SIZE = 512
+
+
+class Sink:
+  def __init__(self, output: TextIO, budget: Optional[int] = None, name: str = "") -> None:
+    self.output = output
+    self.budget = budget
+    self.name = name
+    self.written = 0
+    self.truncated = 0
+    self.omitted_rows = 0
+
+  def fits(self, size: int) -> bool:
+    return self.budget is None or self.written + size <= self.budget - RESERVED_SIZE
+
+  def write(self, text: str, size: Optional[int] = None, force: bool = False) -> bool:
+    if size is None:
+      size = len(text.encode())
+    if not force and not self.fits(size):
+      self.truncated += size
+      return False
+    self.output.write(text)
+    self.written += size
+    return True
+
+
+class MarkdownStream:
+  def __init__(self, sinks: Iterable[Sink]) -> None:
+    self.sinks = list(sinks)
+
+  def _targets(self, only: Optional[Iterable[str]]) -> list:
+    if only is None:
+      return self.sinks
+    return [sink for sink in self.sinks if sink.name in only]
+
+  def write(self, *lines: str, only: Optional[Iterable[str]] = None) -> None:
+    if not lines:
+      return
+    text = "".join(f"{line}\n" for line in lines)
+    size = len(text.encode())
+    for sink in self._targets(only):
+      sink.write(text, size)
+
+  def table(
+    self,
+    header: Iterable[str],
+    rows: Iterable[Iterable[str]],
+    row_count: Optional[int] = None,
+    collapse_rows: Optional[int] = None,
+    summary: str = "",
+  ) -> None:
+    # Tables with more than `collapse_rows` rows are wrapped in a <details> block
+    collapsed = collapse_rows is not None and row_count is not None and row_count > collapse_rows
+    header = list(header)
+    # Sinks which opened the <details> block must close it, even without budget
+    opened = []
+    if collapsed:
+      text = f"<details>\n<summary>{summary or f'{row_count} entries'}</summary>\n\n"
+      opened = [sink for sink in self.sinks if sink.write(text)]
+    self.write(
+      "| " + " | ".join(header) + " |",
+      "|" + "|".join("-" * (len(h) + 2) for h in header) + "|",
+    )
+    for sink in self.sinks:
+      sink.omitted_rows = 0
+    for row in rows:
+      text = "| " + " | ".join(row) + " |\n"
+      size = len(text.encode())
+      for sink in self.sinks:
+        if sink.omitted_rows or not sink.write(text, size):
+          sink.omitted_rows += 1
+    for sink in self.sinks:
+      if sink.omitted_rows:
+        note = f"| _{sink.omitted_rows} more rows omitted_ |" + " |" * (len(header) - 1) + "\n"
+        sink.write(note, force=True)
+    for sink in opened:
+      sink.write("\n</details>\n\n", force=True)
+
+  def close(self) -> None:
+    for sink in self.sinks:
+      if sink.truncated:
+        sink.write(
+          f"\n> [!NOTE]\n> Output truncated to fit the size limit ({sink.budget} bytes).\n",
+          force=True,
+        )
+      sink.output.flush()
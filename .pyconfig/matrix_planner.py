@@ -0,0 +1,146 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Plan the build matrices of multiple jobs, so that every distinct unit of
+# work (e.g. building and testing the tester image for a base image and a
+# platform) is only scheduled once.
+#
+# Jobs are added in order of priority: each unit is assigned to the first job
+# which requested it, and later jobs reuse it. For example, when an approved
+# PR triggers both the basic and the full validation, the full validation's
+# matrix only contains the (base image, platform) pairs not already covered
+# by the basic validation:
+#
+#   planner = MatrixPlanner(revision=github.sha)
+#   planner.add("basic-validation", "docker", ["ubuntu:22.04"], ["linux/amd64"])
+#   planner.add("full-validation", "docker", ["ubuntu:22.04"], ["linux/amd64", "linux/arm64"])
+#   planner.matrix("full-validation")
+#   # -> {"include": [{"base-image": "ubuntu:22.04", "build-platform": "linux/arm64", ...}]}
+#
+# Every unit has a cache key, derived from the unit and the source revision,
+# which jobs building the same unit can share.
+###############################################################################
+import hashlib
+import json
+from typing import Iterable, NamedTuple
+
+
+import image_ref
+
+
+def unique(values: Iterable) -> list:
+  # Remove duplicates, preserving the order of the first occurrences.
+  # Unhashable values (e.g. lists of runner labels) are compared as JSON.
+  seen = set()
+  result = []
+  for value in values:
+    try:
+      hash(value)
+      key = value
+    except TypeError:
+      key = ("json", json.dumps(value, sort_keys=True))
+    if key in seen:
+      continue
+    seen.add(key)
+    result.append(value)
+  return result
+
+
+class BuildUnit(NamedTuple):
+  kind: str
+  base_image: str
+  platform: str
+
+  def cache_key(self, revision: str = "") -> str:
+    digest = hashlib.sha256(
+      "\0".join([self.kind, self.base_image, self.platform, revision]).encode()
+    ).hexdigest()
+    label = f"{image_ref.label(self.base_image)}-{image_ref.label(self.platform)}"
+    return f"{self.kind}-{label}-{digest[:12]}"
+
+
+class MatrixPlanner:
+  # Matrix key used for the platform of each kind of unit
+  PLATFORM_KEYS = {
+    "docker": "build-platform",
+    "deb": "build-architecture",
+  }
+
+  def __init__(self, revision: str = "") -> None:
+    self.revision = revision
+    # unit -> job which builds it
+    self.owners = {}
+    # job -> units requested by the job
+    self.jobs = {}
+
+  def add(self, job: str, kind: str, base_images: Iterable[str], platforms: Iterable[str]) -> list:
+    platforms = unique(platforms)
+    requested = self.jobs.setdefault(job, [])
+    seen = set(requested)
+    for base_image in unique(base_images):
+      for platform in platforms:
+        unit = BuildUnit(kind, base_image, platform)
+        if unit in seen:
+          continue
+        seen.add(unit)
+        requested.append(unit)
+        self.owners.setdefault(unit, job)
+    return requested
+
+  def units(self, job: str) -> list:
+    # The units which a job must actually build
+    return [unit for unit in self.jobs.get(job, []) if self.owners[unit] == job]
+
+  def matrix(self, job: str) -> dict:
+    # A matrix with an `include` entry for every unit built by the job
+    return {
+      "include": [
+        {
+          "base-image": unit.base_image,
+          self.PLATFORM_KEYS.get(unit.kind, "platform"): unit.platform,
+          "cache-key": unit.cache_key(self.revision),
+        }
+        for unit in self.units(job)
+      ]
+    }
+
+  def plan(self) -> dict:
+    # The distinct units, and, for every requested (job, unit), the job
+    # which builds the unit.
+    return {
+      "units": [
+        {
+          "key": unit.cache_key(self.revision),
+          "kind": unit.kind,
+          "base-image": unit.base_image,
+          "platform": unit.platform,
+          "job": owner,
+        }
+        for unit, owner in self.owners.items()
+      ],
+      "jobs": {
+        job: [
+          {
+            "base-image": unit.base_image,
+            "platform": unit.platform,
+            "unit": unit.cache_key(self.revision),
+            "job": self.owners[unit],
+            "reused": self.owners[unit] != job,
+          }
+          for unit in units
+        ]
+        for job, units in self.jobs.items()
+      },
+    }
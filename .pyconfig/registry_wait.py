@@ -0,0 +1,299 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Wait until an image pushed to a registry can be pulled, and print the
+# digest of its top-level manifest (the manifest list of a multi-platform
+# image).
+#
+# The registry's manifest endpoint (Docker Registry HTTP API v2) is polled
+# with HEAD requests, until the tag resolves or a deadline expires. The
+# delay between attempts starts small and doubles after every attempt (up
+# to a maximum), so that a fast registry is detected right away, without
+# flooding a slow one. Registries requiring a token (e.g. ghcr.io and Docker
+# Hub) are authenticated through their token endpoint, with the credentials
+# in REGISTRY_USER and REGISTRY_TOKEN (if any). For example:
+#
+#   REGISTRY_USER=${{ github.actor }} REGISTRY_TOKEN=${{ secrets.GITHUB_TOKEN }} \
+#     python3 .pyconfig/registry_wait.py ghcr.io/mentalsmash/ref-project-debdocker:latest \
+#       -O GH_MANIFEST_HASH
+#
+# The result is printed as JSON, and the digest is also exported to
+# GITHUB_OUTPUT (when available) with the name passed to -O.
+###############################################################################
+import argparse
+import base64
+import hashlib
+import http.client
+import json
+import os
+import re
+import sys
+import time
+from typing import Callable, NamedTuple, Optional
+from urllib.parse import urlencode, urlsplit
+
+import image_ref
+import tracing
+from github_api import ConnectionPool
+
+DEFAULT_TIMEOUT = 300
+DEFAULT_INTERVAL = 1.0
+DEFAULT_MAX_INTERVAL = 15.0
+REQUEST_TIMEOUT = 30
+
+# Registry serving Docker Hub's repositories
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+
+# Top-level manifests first, so that the registry doesn't convert them
+MANIFEST_TYPES = (
+  "application/vnd.oci.image.index.v1+json",
+  "application/vnd.docker.distribution.manifest.list.v2+json",
+  "application/vnd.oci.image.manifest.v1+json",
+  "application/vnd.docker.distribution.manifest.v2+json",
+)
+
+# Statuses returned while an image is still being published (404), or
+# by an overloaded registry
+RETRY_STATUS = (404, 429, 500, 502, 503, 504)
+
+USER_AGENT = "pyconfig-registry-wait"
+
+
+class RegistryError(Exception):
+  def __init__(self, message: str, status: Optional[int] = None) -> None:
+    super().__init__(message)
+    self.status = status
+
+
+class Response(NamedTuple):
+  status: int
+  headers: dict
+  body: bytes
+
+
+class Manifest(NamedTuple):
+  image: str
+  digest: str
+  media_type: str
+  attempts: int
+  elapsed: float
+
+
+def manifest_url(ref: image_ref.ImageRef, insecure: bool = False) -> str:
+  if ref.domain == image_ref.DOCKER_HUB:
+    host = DOCKER_HUB_REGISTRY
+    # Official images are in the "library" namespace
+    path = ref.path if ref.namespace else f"library/{ref.repo}"
+  else:
+    host = ref.registry
+    path = ref.path
+  reference = ref.digest or ref.tag or "latest"
+  return f"{'http' if insecure else 'https'}://{host}/v2/{path}/manifests/{reference}"
+
+
+def parse_challenge(header: str) -> Optional[dict]:
+  # The parameters of a "Bearer" WWW-Authenticate header (realm, service, scope)
+  scheme, _, params = header.strip().partition(" ")
+  if scheme.lower() != "bearer":
+    return None
+  return dict(re.findall(r'(\w+)="([^"]*)"', params))
+
+
+class RegistryClient:
+  def __init__(
+    self,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+    insecure: bool = False,
+    timeout: float = REQUEST_TIMEOUT,
+  ) -> None:
+    self.username = username
+    self.password = password
+    self.insecure = insecure
+    self.pool = ConnectionPool(timeout)
+    # Bearer tokens, by realm, service, and scope
+    self._tokens = {}
+    # Token used for each repository (once challenged)
+    self._auth = {}
+
+  def __enter__(self) -> "RegistryClient":
+    return self
+
+  def __exit__(self, *exc_info: object) -> None:
+    self.close()
+
+  def close(self) -> None:
+    self.pool.close()
+
+  def _send(self, method: str, url: str, headers: dict) -> Response:
+    parts = urlsplit(url)
+    target = parts.path or "/"
+    if parts.query:
+      target = f"{target}?{parts.query}"
+    conn = self.pool.acquire(parts.scheme, parts.hostname, parts.port)
+    try:
+      conn.request(method, target, headers={"User-Agent": USER_AGENT, **headers})
+      resp = conn.getresponse()
+      data = resp.read()
+    except Exception:
+      conn.close()
+      raise
+    resp_headers = {k.lower(): v for k, v in resp.getheaders()}
+    if resp.will_close:
+      conn.close()
+    else:
+      self.pool.release(parts.scheme, conn)
+    return Response(resp.status, resp_headers, data)
+
+  def _token(self, challenge: dict) -> str:
+    key = (challenge.get("realm"), challenge.get("service"), challenge.get("scope"))
+    token = self._tokens.get(key)
+    if token is not None:
+      return token
+    if not key[0]:
+      raise RegistryError("authentication challenge without a realm")
+    params = {k: v for k, v in (("service", key[1]), ("scope", key[2])) if v}
+    url = f"{key[0]}{'&' if '?' in key[0] else '?'}{urlencode(params)}"
+    headers = {}
+    if self.username and self.password:
+      credentials = base64.b64encode(f"{self.username}:{self.password}".encode()).decode()
+      headers["Authorization"] = f"Basic {credentials}"
+    with tracing.span("registry token", cat="registry", service=key[1] or ""):
+      resp = self._send("GET", url, headers)
+    if resp.status != 200:
+      raise RegistryError(f"GET {key[0]} failed ({resp.status})", resp.status)
+    data = json.loads(resp.body)
+    token = data.get("token") or data.get("access_token")
+    if not token:
+      raise RegistryError(f"GET {key[0]} returned no token")
+    self._tokens[key] = token
+    return token
+
+  def manifest(
+    self, ref: image_ref.ImageRef, method: str = "HEAD", authenticate: bool = True
+  ) -> Response:
+    url = manifest_url(ref, self.insecure)
+    repo_url = url.rsplit("/manifests/", 1)[0]
+    headers = {"Accept": ", ".join(MANIFEST_TYPES)}
+    token = self._auth.get(repo_url)
+    if token:
+      headers["Authorization"] = f"Bearer {token}"
+    with tracing.span(f"{method} manifest", cat="registry", image=ref.image):
+      resp = self._send(method, url, headers)
+    challenge = parse_challenge(resp.headers.get("www-authenticate", ""))
+    if resp.status == 401 and challenge is not None and authenticate:
+      # Request a new token (e.g. if the previous one expired)
+      self._tokens = {k: v for k, v in self._tokens.items() if v != token}
+      self._auth[repo_url] = self._token(challenge)
+      return self.manifest(ref, method, authenticate=False)
+    return resp
+
+  def digest(self, ref: image_ref.ImageRef) -> Optional[tuple]:
+    # (digest, media type) of the image's manifest, or None if it doesn't
+    # exist (yet)
+    resp = self.manifest(ref)
+    if resp.status == 200 and "docker-content-digest" not in resp.headers:
+      # The digest header is optional: hash the manifest instead
+      resp = self.manifest(ref, "GET")
+    if resp.status in RETRY_STATUS:
+      return None
+    if resp.status != 200:
+      raise RegistryError(f"manifest of {ref.image} not available ({resp.status})", resp.status)
+    digest = resp.headers.get("docker-content-digest")
+    if not digest:
+      digest = f"sha256:{hashlib.sha256(resp.body).hexdigest()}"
+    return digest, resp.headers.get("content-type", "").split(";")[0]
+
+
+@tracing.span("registry_wait.wait_for_manifest")
+def wait_for_manifest(
+  client: RegistryClient,
+  image: str,
+  timeout: float = DEFAULT_TIMEOUT,
+  interval: float = DEFAULT_INTERVAL,
+  max_interval: float = DEFAULT_MAX_INTERVAL,
+  clock: Callable[[], float] = time.monotonic,
+  sleep: Callable[[float], None] = time.sleep,
+) -> Manifest:
+  ref = image_ref.parse(image)
+  start = clock()
+  deadline = start + timeout
+  delay = interval
+  attempts = 0
+  while True:
+    attempts += 1
+    try:
+      result = client.digest(ref)
+      error = "not found"
+    except (OSError, http.client.HTTPException) as e:
+      result = None
+      error = str(e) or type(e).__name__
+    now = clock()
+    if result is not None:
+      return Manifest(image, result[0], result[1], attempts, now - start)
+    if now >= deadline:
+      raise RegistryError(
+        f"{image} not available after {now - start:.1f}s ({attempts} attempts, last: {error})"
+      )
+    print(f"waiting for {image} ({error}), retry in {delay:.1f}s", file=sys.stderr)
+    sleep(min(delay, deadline - now))
+    delay = min(delay * 2, max_interval)
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Wait for an image to be published")
+  parser.add_argument("image", help="image reference (e.g. ghcr.io/ORG/REPO:TAG)")
+  parser.add_argument(
+    "-t", "--timeout", type=float, default=DEFAULT_TIMEOUT, help="deadline (seconds)"
+  )
+  parser.add_argument(
+    "-i", "--interval", type=float, default=DEFAULT_INTERVAL, help="initial polling interval"
+  )
+  parser.add_argument(
+    "-m", "--max-interval", type=float, default=DEFAULT_MAX_INTERVAL, help="maximum interval"
+  )
+  parser.add_argument(
+    "-O", "--output-name", default=None, help="export the digest to GITHUB_OUTPUT with this name"
+  )
+  parser.add_argument(
+    "--insecure", action="store_true", help="connect over plain HTTP (e.g. a local registry)"
+  )
+  args = parser.parse_args()
+
+  try:
+    with RegistryClient(
+      os.environ.get("REGISTRY_USER"), os.environ.get("REGISTRY_TOKEN"), insecure=args.insecure
+    ) as client:
+      manifest = wait_for_manifest(
+        client, args.image, args.timeout, args.interval, args.max_interval
+      )
+  except (RegistryError, ValueError) as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+
+  print(json.dumps(manifest._asdict(), indent=2))
+  github_output = os.environ.get("GITHUB_OUTPUT")
+  if args.output_name and github_output:
+    from github_output import format_output
+
+    with open(github_output, "a") as output:
+      output.write(format_output(args.output_name, manifest.digest))
+
+
+if __name__ == "__main__":
+  main()
@@ -14,63 +14,137 @@
 # limitations under the License.
 ###############################################################################
 import json
+import sys
 from pathlib import Path
-from typing import NamedTuple
+from typing import Callable, NamedTuple
 from datetime import datetime
 
-from pyconfig import sha_short, extract_registries, tuple_to_dict, merge_dicts
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from pyconfig import sha_short, tuple_to_dict, merge_dicts
+
+import build_cache
+import gitmeta
+import image_ref
+import tracing
+from lazy_settings import Evaluation, Fields, Lazy, LazyDict
+from matrix_planner import unique
+
+registries = tracing.traced(image_ref.registries, "image_ref.registries")
+tuple_to_dict = tracing.traced(tuple_to_dict)
+merge_dicts = tracing.traced(merge_dicts)
+
+# Every generated setting is a field, computed (from its parameters) only
+# when it is read. See lazy_settings.py.
+FIELDS = Fields()
 
 
 ###############################################################################
-#
+# Current workflow run settings
 ###############################################################################
-def settings(clone_dir: Path, cfg: NamedTuple, github: NamedTuple) -> dict:
-  repo_org, repo = github.repository.split("/")
-  repo_url = f"https://github.com/{github.repository}"
-  artifacts_dir = Path(github.workspace) / "artifacts"
-  #############################################################################
-  # Current workflow run settings
-  #############################################################################
-  ref_sha = sha_short(clone_dir)
+@FIELDS
+def repo_org(github: NamedTuple) -> str:
+  return github.repository.split("/")[0]
+
+
+@FIELDS
+def repo(github: NamedTuple) -> str:
+  return github.repository.split("/")[1]
+
+
+@FIELDS
+def repo_url(github: NamedTuple) -> str:
+  return f"https://github.com/{github.repository}"
+
+
+@FIELDS
+def artifacts_dir(github: NamedTuple) -> Path:
+  return Path(github.workspace) / "artifacts"
 
+
+@FIELDS
+def ref_sha(clone_dir: Path) -> str:
+  with tracing.span("sha_short"):
+    try:
+      # Read the commit id straight from .git, instead of spawning a git process
+      return gitmeta.sha_short(clone_dir)
+    except gitmeta.GitMetaError:
+      return sha_short(clone_dir)
+
+
+@FIELDS
+def build_profile(github: NamedTuple) -> str:
+  return "stable" if github.ref_type == "tag" else "nightly"
+
+
+@FIELDS
+def build_version(github: NamedTuple, clone_dir: Path) -> str:
   if github.ref_type == "tag":
-    build_profile = "stable"
     build_version = github.ref_name
   else:
-    build_profile = "nightly"
-    build_version = f"{github.ref_name}@{ref_sha}"
-  build_version = build_version.replace("/", "-")
+    # Only read the commit id for nightly builds
+    build_version = f"{github.ref_name}@{ref_sha(clone_dir)}"
+  return build_version.replace("/", "-")
+
+
+@FIELDS
+def build_date() -> str:
+  return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+@FIELDS
+def build_settings_artifact(repo: str) -> str:
+  return f"{repo}-settings"
+
+
+###############################################################################
+# Container Release settings
+###############################################################################
+@FIELDS
+def release_cfg(cfg: NamedTuple, build_profile: str) -> NamedTuple:
+  return getattr(cfg.release.profiles, build_profile)
 
-  build_date = datetime.now().strftime("%Y%m%d-%H%M%S")
 
-  build_settings_artifact = f"{repo}-settings"
+@FIELDS
+def release_tag(release_cfg: NamedTuple) -> str:
+  return f"{release_cfg.tag}{release_cfg.tag_suffix}"
 
-  #############################################################################
-  # Container Release settings
-  #############################################################################
-  release_cfg = getattr(cfg.release.profiles, build_profile)
 
-  release_tag = f"{release_cfg.tag}{release_cfg.tag_suffix}"
+@FIELDS
+def docker_build_platforms(release_cfg: NamedTuple) -> str:
+  return ",".join(release_cfg.build_platforms)
 
-  docker_build_platforms = ",".join(release_cfg.build_platforms)
 
+@FIELDS
+def docker_flavor_config(release_cfg: NamedTuple) -> str:
   if release_cfg.tag_suffix is not None:
-    docker_flavor_config = f"suffix={release_cfg.tag_suffix},onlatest=true"
-  else:
-    docker_flavor_config = ""
-
-  prerel_repo = f"{cfg.release.prerelease_repo}-{build_profile}"
-  prerel_image = f"{prerel_repo}:{release_tag}"
-  prerel_package = (
-    ""
-    if not cfg.release.prerelease_package
-    else (f"{cfg.release.prerelease_package}-{build_profile}")
-  )
-  if prerel_package:
-    prerel_package_org, prerel_package = prerel_package.split("/")
-  else:
-    prerel_package_org, prerel_package = "", ""
-  prerel_registries = extract_registries(
+    return f"suffix={release_cfg.tag_suffix},onlatest=true"
+  return ""
+
+
+@FIELDS
+def prerel_repo(cfg: NamedTuple, build_profile: str) -> str:
+  return f"{cfg.release.prerelease_repo}-{build_profile}"
+
+
+@FIELDS
+def prerel_image(prerel_repo: str, release_tag: str) -> str:
+  return f"{prerel_repo}:{release_tag}"
+
+
+@FIELDS
+def prerel_package_ref(cfg: NamedTuple, build_profile: str) -> tuple:
+  # (org, package)
+  if not cfg.release.prerelease_package:
+    return "", ""
+  return tuple(f"{cfg.release.prerelease_package}-{build_profile}".split("/"))
+
+
+@FIELDS
+def prerel_registries(repo_org: str, release_cfg: NamedTuple, prerel_image: str) -> set:
+  return registries(
     repo_org,
     [
       release_cfg.base_image,
@@ -78,8 +152,15 @@ def settings(clone_dir: Path, cfg: NamedTuple, github: NamedTuple) -> dict:
     ],
   )
 
-  release_images = [f"{release_repo}:{release_tag}" for release_repo in cfg.release.final_repos]
-  release_registries = extract_registries(
+
+@FIELDS
+def release_images(cfg: NamedTuple, release_tag: str) -> list:
+  return [f"{release_repo}:{release_tag}" for release_repo in cfg.release.final_repos]
+
+
+@FIELDS
+def release_registries(repo_org: str, release_images: list, prerel_image: str) -> set:
+  return registries(
     repo_org,
     [
       *release_images,
@@ -87,75 +168,165 @@ def settings(clone_dir: Path, cfg: NamedTuple, github: NamedTuple) -> dict:
     ],
   )
 
-  final_repos_config = "\n".join(cfg.release.final_repos)
-  final_images_config = "\n".join(release_images)
 
-  if "github" in release_registries:
-    gh_release_repo = next(repo for repo in cfg.release.final_repos if repo.startswith("ghcr.io/"))
-    gh_package_image = next(img for img in release_images if img.startswith("ghcr.io/"))
-    gh_org_package = gh_release_repo.split("ghcr.io/")[1]
-    gh_org, gh_package = gh_org_package.split("/")
-  else:
-    gh_org, gh_package = "", ""
-    gh_package_image = ""
+@FIELDS
+def release_build_cache(
+  cfg: NamedTuple, github: NamedTuple, release_cfg: NamedTuple
+) -> build_cache.CacheConfig:
+  # Layers are cached per base image and set of platforms, in the scope of
+  # the current branch (or of the "stable" profile, for tags)
+  return build_cache.cache_config(
+    cfg.release.build_cache,
+    key=build_cache.scope_name("release", release_cfg.base_image, *release_cfg.build_platforms),
+    scope=build_cache.ref_scope(github),
+  )
 
-  gh_release_url = f"{repo_url}/releases/tag/{github.ref_name}"
-  gh_release_create = github.ref_type == "tag"
 
-  release_test_runners_matrix = json.dumps(
-    [
+@FIELDS
+def final_repos_config(cfg: NamedTuple) -> str:
+  return "\n".join(cfg.release.final_repos)
+
+
+@FIELDS
+def final_images_config(release_images: list) -> str:
+  return "\n".join(release_images)
+
+
+@FIELDS
+def gh_package_ref(cfg: NamedTuple, release_registries: set, release_images: list) -> tuple:
+  # (org, package, image)
+  if "github" not in release_registries:
+    return "", "", ""
+  gh_release_repo = next(repo for repo in cfg.release.final_repos if repo.startswith("ghcr.io/"))
+  gh_package_image = next(img for img in release_images if img.startswith("ghcr.io/"))
+  gh_org_package = gh_release_repo.split("ghcr.io/")[1]
+  gh_org, gh_package = gh_org_package.split("/")
+  return gh_org, gh_package, gh_package_image
+
+
+@FIELDS
+def gh_release_url(repo_url: str, github: NamedTuple) -> str:
+  return f"{repo_url}/releases/tag/{github.ref_name}"
+
+
+@FIELDS
+def gh_release_create(github: NamedTuple) -> bool:
+  return github.ref_type == "tag"
+
+
+@FIELDS
+def release_test_runners_matrix(cfg: NamedTuple, release_cfg: NamedTuple) -> str:
+  # Platforms which share a runner are tested only once
+  return json.dumps(
+    unique(
       json.dumps(getattr(cfg.ci.runners, platform.replace("/", "_")))
       for platform in release_cfg.build_platforms
-    ]
+    )
   )
 
+
+@FIELDS
+def release_test_id(build_profile: str, build_version: str) -> str:
   # A prefix for files generated by the test
-  release_test_id = f"release-{build_profile}__{build_version}"
-  release_test_artifact = f"{repo}-test-{release_test_id}"
-  release_tracker_artifact_prefix = f"{repo}-tracker-{release_test_id}"
-  release_tracker_artifact = f"{release_tracker_artifact_prefix}"
+  return f"release-{build_profile}__{build_version}"
+
+
+@FIELDS
+def release_test_artifact(repo: str, release_test_id: str) -> str:
+  return f"{repo}-test-{release_test_id}"
+
+
+@FIELDS
+def release_tracker_artifact_prefix(repo: str, release_test_id: str) -> str:
+  return f"{repo}-tracker-{release_test_id}"
+
 
-  release_tracker_repo_url = f"https://github.com/{cfg.release.tracker.repository.name}"
+@FIELDS
+def release_tracker_repo_url(cfg: NamedTuple) -> str:
+  return f"https://github.com/{cfg.release.tracker.repository.name}"
 
-  release_notes_artifacts_prefix = f"{repo}-notes-{release_test_id}"
-  release_notes_artifact = f"{release_notes_artifacts_prefix}"
 
-  badge_filename = github.repository.replace("/", "-") + "-badge-" + build_profile
+@FIELDS
+def release_notes_artifacts_prefix(repo: str, release_test_id: str) -> str:
+  return f"{repo}-notes-{release_test_id}"
+
+
+@FIELDS
+def badge_filename(github: NamedTuple, build_profile: str) -> str:
+  return github.repository.replace("/", "-") + "-badge-" + build_profile
+
+
+@FIELDS
+def badge_base_image(release_cfg: NamedTuple, badge_filename: str) -> dict:
   badge_base_image = tuple_to_dict(release_cfg.badge.base_image)
   badge_base_image["message"] = release_cfg.base_image
   badge_base_image["filename"] = f"{badge_filename}-base-image.json"
+  return badge_base_image
+
+
+@FIELDS
+def badge_version(release_cfg: NamedTuple, build_version: str, badge_filename: str) -> dict:
   badge_version = tuple_to_dict(release_cfg.badge.version)
   badge_version["message"] = build_version
   badge_version["filename"] = f"{badge_filename}-version.json"
+  return badge_version
+
+
+###############################################################################
+# Debian packaging settings
+###############################################################################
+@FIELDS
+def debian_enabled(clone_dir: Path) -> bool:
+  return (clone_dir / "debian" / "control").is_file()
+
 
-  #############################################################################
-  # Debian packaging settings
-  #############################################################################
-  debian_enabled = (clone_dir / "debian" / "control").is_file()
-  debian_builder_base_images_matrix = json.dumps(cfg.debian.builder.base_images)
-  debian_builder_registries = extract_registries(
+@FIELDS
+def debian_builder_base_images_matrix(cfg: NamedTuple) -> str:
+  return json.dumps(cfg.debian.builder.base_images)
+
+
+@FIELDS
+def debian_builder_registries(repo_org: str, cfg: NamedTuple) -> set:
+  return registries(
     repo_org,
     [
       cfg.debian.builder.repo,
       *cfg.debian.builder.base_images,
     ],
   )
-  debian_builder_architectures_matrix = json.dumps(cfg.debian.builder.architectures)
 
-  #############################################################################
-  # CI infrastructure settings
-  #############################################################################
-  admin_registries = extract_registries(
+
+@FIELDS
+def debian_builder_architectures_matrix(cfg: NamedTuple) -> str:
+  return json.dumps(cfg.debian.builder.architectures)
+
+
+###############################################################################
+# CI infrastructure settings
+###############################################################################
+@FIELDS
+def admin_registries(repo_org: str, cfg: NamedTuple) -> set:
+  return registries(
     repo_org,
     [
       cfg.ci.images.admin.image,
     ],
   )
 
-  release_base_images = list({release_cfg.base_image for release_cfg in cfg.release.profiles})
 
-  tester_base_images_matrix = json.dumps(release_base_images)
-  tester_registries = extract_registries(
+@FIELDS
+def release_base_images(cfg: NamedTuple) -> list:
+  return unique(release_cfg.base_image for release_cfg in cfg.release.profiles)
+
+
+@FIELDS
+def tester_base_images_matrix(release_base_images: list) -> str:
+  return json.dumps(release_base_images)
+
+
+@FIELDS
+def tester_registries(repo_org: str, cfg: NamedTuple, release_base_images: list) -> set:
+  return registries(
     repo_org,
     [
       cfg.ci.images.tester.repo,
@@ -163,120 +334,166 @@ def settings(clone_dir: Path, cfg: NamedTuple, github: NamedTuple) -> dict:
     ],
   )
 
-  #############################################################################
-  # Output generated settings
-  #############################################################################
-  return {
-    ###########################################################################
-    # Build config
-    ###########################################################################
-    "build": {
-      "repository": {
-        "name": repo,
-        "org": repo_org,
-        "url": repo_url,
-      },
-      "date": build_date,
-      "profile": build_profile,
-      "settings": {
-        "artifact": build_settings_artifact,
-      },
-      "version": build_version,
-      "artifacts_dir": str(artifacts_dir),
-    },
-    ###########################################################################
-    # CI config
-    ###########################################################################
-    "ci": merge_dicts(
-      {
-        "images": {
-          "admin": {
-            "login": {
-              "dockerhub": "dockerhub" in admin_registries,
-              "github": "github" in admin_registries,
-            },
-          },
-          "tester": {
-            "base_images_matrix": tester_base_images_matrix,
-            "build_platforms_config": docker_build_platforms,
-            "login": {
-              "dockerhub": "dockerhub" in tester_registries,
-              "github": "github" in tester_registries,
-            },
-          },
-        },
-      },
-      tuple_to_dict(cfg.ci),
-    ),
-    ###########################################################################
-    # Debian config
-    ###########################################################################
-    "debian": merge_dicts(
-      {
-        "enabled": debian_enabled,
-        "builder": {
-          "base_images_matrix": debian_builder_base_images_matrix,
-          "architectures_matrix": debian_builder_architectures_matrix,
-          "login": {
-            "dockerhub": "dockerhub" in debian_builder_registries,
-            "github": "github" in debian_builder_registries,
-          },
-        },
-      },
-      tuple_to_dict(cfg.debian),
-    ),
-    ###########################################################################
-    # Release config
-    ###########################################################################
-    "release": merge_dicts(
-      {
-        "badge": {
-          "base_image": badge_base_image,
-          "version": badge_version,
-        },
-        "build_platforms_config": docker_build_platforms,
-        "flavor_config": docker_flavor_config,
-        "prerelease_image": prerel_image,
-        "prerelease_package": prerel_package,
-        "prerelease_package_org": prerel_package_org,
-        "prerelease_repo": prerel_repo,
-        "final_repos_config": final_repos_config,
-        "final_images": release_images,
-        "final_images_config": final_images_config,
-        "login": {
-          "dockerhub": "dockerhub" in release_registries,
-          "github": "github" in release_registries,
-        },
-        "login_prerel": {
-          "dockerhub": "dockerhub" in prerel_registries,
-          "github": "github" in prerel_registries,
-        },
-        "gh": {
-          "org": gh_org,
-          "package": gh_package,
-          "package_image": gh_package_image,
-          "release": {
-            "url": gh_release_url,
-            "create": gh_release_create,
-          },
-        },
-        "notes": {
-          "artifact": release_notes_artifact,
-          "artifacts_prefix": release_notes_artifacts_prefix,
-        },
-        "tag": release_tag,
-        "tags_config": release_cfg.tags_config,
-        "test_artifact": release_test_artifact,
-        "test_id": release_test_id,
-        "test_runners_matrix": release_test_runners_matrix,
-        "tracker": {
-          "artifact": release_tracker_artifact,
-          "artifact_prefix": release_tracker_artifact_prefix,
-          "repository": {
-            "url": release_tracker_repo_url,
-          },
-        },
-      },
-      tuple_to_dict(release_cfg),
-    ),
-  }
+
+###############################################################################
+# Output generated settings
+###############################################################################
+def _login(f: Evaluation, registries: str) -> LazyDict:
+  return LazyDict(
+    {
+      "dockerhub": Lazy(lambda: "dockerhub" in f[registries]),
+      "github": Lazy(lambda: "github" in f[registries]),
+    }
+  )
+
+
+def _item(f: Evaluation, name: str, i: int) -> Lazy:
+  return Lazy(lambda: f[name][i])
+
+
+def _merged(generated: LazyDict, base: Callable[[], NamedTuple]) -> Lazy:
+  # Sections of settings.yml are only copied (and merged with the generated
+  # values) if they are read
+  return Lazy(lambda: merge_dicts(generated, tuple_to_dict(base())))
+
+
+@tracing.span("settings")
+def settings(clone_dir: Path, cfg: NamedTuple, github: NamedTuple) -> dict:
+  # Values are computed on demand, when the returned dict is read
+  f = FIELDS.evaluate(clone_dir=clone_dir, cfg=cfg, github=github)
+  lazy = f.lazy
+  return LazyDict(
+    {
+      #########################################################################
+      # Build config
+      #########################################################################
+      "build": LazyDict(
+        {
+          "repository": LazyDict(
+            {
+              "name": lazy("repo"),
+              "org": lazy("repo_org"),
+              "url": lazy("repo_url"),
+            }
+          ),
+          "date": lazy("build_date"),
+          "profile": lazy("build_profile"),
+          "settings": LazyDict(
+            {
+              "artifact": lazy("build_settings_artifact"),
+            }
+          ),
+          "version": lazy("build_version"),
+          "artifacts_dir": Lazy(lambda: str(f["artifacts_dir"])),
+        }
+      ),
+      #########################################################################
+      # CI config
+      #########################################################################
+      "ci": _merged(
+        LazyDict(
+          {
+            "images": LazyDict(
+              {
+                "admin": LazyDict(
+                  {
+                    "login": _login(f, "admin_registries"),
+                  }
+                ),
+                "tester": LazyDict(
+                  {
+                    "base_images_matrix": lazy("tester_base_images_matrix"),
+                    "build_platforms_config": lazy("docker_build_platforms"),
+                    "login": _login(f, "tester_registries"),
+                  }
+                ),
+              }
+            ),
+          }
+        ),
+        lambda: cfg.ci,
+      ),
+      #########################################################################
+      # Debian config
+      #########################################################################
+      "debian": _merged(
+        LazyDict(
+          {
+            "enabled": lazy("debian_enabled"),
+            "builder": LazyDict(
+              {
+                "base_images_matrix": lazy("debian_builder_base_images_matrix"),
+                "architectures_matrix": lazy("debian_builder_architectures_matrix"),
+                "login": _login(f, "debian_builder_registries"),
+              }
+            ),
+          }
+        ),
+        lambda: cfg.debian,
+      ),
+      #########################################################################
+      # Release config
+      #########################################################################
+      "release": _merged(
+        LazyDict(
+          {
+            "badge": LazyDict(
+              {
+                "base_image": lazy("badge_base_image"),
+                "version": lazy("badge_version"),
+              }
+            ),
+            "build_cache": Lazy(lambda: f["release_build_cache"].outputs()),
+            "build_platforms_config": lazy("docker_build_platforms"),
+            "flavor_config": lazy("docker_flavor_config"),
+            "prerelease_image": lazy("prerel_image"),
+            "prerelease_package": _item(f, "prerel_package_ref", 1),
+            "prerelease_package_org": _item(f, "prerel_package_ref", 0),
+            "prerelease_repo": lazy("prerel_repo"),
+            "final_repos_config": lazy("final_repos_config"),
+            "final_images": lazy("release_images"),
+            "final_images_config": lazy("final_images_config"),
+            "login": _login(f, "release_registries"),
+            "login_prerel": _login(f, "prerel_registries"),
+            "gh": LazyDict(
+              {
+                "org": _item(f, "gh_package_ref", 0),
+                "package": _item(f, "gh_package_ref", 1),
+                "package_image": _item(f, "gh_package_ref", 2),
+                "release": LazyDict(
+                  {
+                    "url": lazy("gh_release_url"),
+                    "create": lazy("gh_release_create"),
+                  }
+                ),
+              }
+            ),
+            "notes": LazyDict(
+              {
+                "artifact": lazy("release_notes_artifacts_prefix"),
+                "artifacts_prefix": lazy("release_notes_artifacts_prefix"),
+                "max_size": Lazy(lambda: cfg.release.notes.max_size),
+              }
+            ),
+            "tag": lazy("release_tag"),
+            "tags_config": Lazy(lambda: f["release_cfg"].tags_config),
+            "test_artifact": lazy("release_test_artifact"),
+            "test_id": lazy("release_test_id"),
+            "test_runners_matrix": lazy("release_test_runners_matrix"),
+            "tracker": LazyDict(
+              {
+                "artifact": lazy("release_tracker_artifact_prefix"),
+                "artifact_prefix": lazy("release_tracker_artifact_prefix"),
+                "repository": LazyDict(
+                  {
+                    "url": lazy("release_tracker_repo_url"),
+                  }
+                ),
+              }
+            ),
+          }
+        ),
+        lambda: f["release_cfg"],
+      ),
+    }
+  )
@@ -0,0 +1,294 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Validate settings.yml against a schema, and compile it into a snapshot
+# which can be loaded without parsing YAML.
+#
+# The snapshot (settings.snapshot.json) is committed next to settings.yml,
+# and kept up to date by a pre-commit hook (`make settings-snapshot`). It
+# contains two lines: a header with the SHA-256 of the settings.yml it was
+# compiled from, and the settings as compact JSON, with keys already
+# sanitized like the pyconfig action does ("-" and "/" replaced by "_").
+#
+# load() reads the header, and, if settings.yml hasn't changed since, builds
+# the `cfg` object straight from the JSON parser (NamedTuple types are
+# cached by their fields, and shared by all objects with the same keys).
+# Otherwise it falls back to parsing (and validating) settings.yml:
+#
+#   python3 .pyconfig/snapshot.py check     # validate, and verify the snapshot
+#   python3 .pyconfig/snapshot.py compile   # regenerate the snapshot
+###############################################################################
+import argparse
+import difflib
+import hashlib
+import json
+import sys
+from collections import namedtuple
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+FORMAT_VERSION = 1
+SETTINGS_YML = Path(__file__).parent / "settings.yml"
+SNAPSHOT_FILE = SETTINGS_YML.with_name("settings.snapshot.json")
+
+
+###############################################################################
+# Schema
+###############################################################################
+class MapOf:
+  # A dictionary with arbitrary keys (e.g. platform names)
+  def __init__(self, value: object) -> None:
+    self.value = value
+
+
+# Dictionaries list the allowed keys (all required), lists contain the type
+# of their items, and tuples list alternative types.
+BADGE = {"color": str, "gist": str}
+BUILD_CACHE = {"backend": str, "repo": str, "dir": str, "fallback": [str]}
+VALIDATION = {"base_images": [str], "build_platforms": [str]}
+
+SCHEMA = {
+  "ci": {
+    "images": {
+      "admin": {"image": str},
+      "tester": {"repo": str},
+      "local_tester": {"image": str},
+    },
+    "runners": MapOf((str, [str])),
+    "test": {"results_dir": str},
+    "fingerprint": {"enabled": bool, "exclude": [str]},
+    "build_cache": BUILD_CACHE,
+  },
+  "debian": {
+    "artifacts": {"prefix": str, "dist_dir": str},
+    "builder": {"architectures": [str], "base_images": [str], "repo": str},
+  },
+  "pull_request": {
+    "validation": {
+      "basic": VALIDATION,
+      "full": VALIDATION,
+      "deb": {"base_images": [str], "build_architectures": [str]},
+    },
+  },
+  "release": {
+    "final_repos": [str],
+    "prerelease_repo": str,
+    "prerelease_package": str,
+    "tracker": {
+      "repository": {"name": str, "ref": str},
+      "user": {"name": str, "email": str},
+    },
+    "build_cache": BUILD_CACHE,
+    "publish": {"branch": str, "apt_dir": str, "history_dir": str, "keep_versions": int},
+    "notes": {"max_size": int},
+    "profiles": MapOf(
+      {
+        "badge": {"base_image": BADGE, "version": BADGE},
+        "base_image": str,
+        "build_platforms": [str],
+        "tag": str,
+        "tag_suffix": (str, type(None)),
+        "tags_config": str,
+      }
+    ),
+  },
+}
+
+
+class SchemaError(Exception):
+  def __init__(self, errors: list) -> None:
+    super().__init__("\n".join(errors))
+    self.errors = errors
+
+
+def _describe(schema: object) -> str:
+  if isinstance(schema, tuple):
+    return " or ".join(_describe(s) for s in schema)
+  elif isinstance(schema, (dict, MapOf)):
+    return "a mapping"
+  elif isinstance(schema, list):
+    return f"a list of {_describe(schema[0])}"
+  elif schema is type(None):
+    return "null"
+  return schema.__name__
+
+
+def _check(value: object, schema: object, path: str, errors: list) -> None:
+  if isinstance(schema, tuple):
+    for alternative in schema:
+      alt_errors = []
+      _check(value, alternative, path, alt_errors)
+      if not alt_errors:
+        return
+  elif isinstance(schema, MapOf):
+    if isinstance(value, dict):
+      for k, v in value.items():
+        _check(v, schema.value, f"{path}.{k}", errors)
+      return
+  elif isinstance(schema, dict):
+    if isinstance(value, dict):
+      for k in value:
+        if k not in schema:
+          hint = difflib.get_close_matches(field_name(str(k)), schema, n=1)
+          errors.append(
+            f"{path}.{k}: unknown key" + (f" (did you mean '{hint[0]}'?)" if hint else "")
+          )
+      for k, s in schema.items():
+        if k not in value:
+          errors.append(f"{path}.{k}: missing")
+        else:
+          _check(value[k], s, f"{path}.{k}", errors)
+      return
+  elif isinstance(schema, list):
+    if isinstance(value, list):
+      for i, v in enumerate(value):
+        _check(v, schema[0], f"{path}[{i}]", errors)
+      return
+  elif schema is int:
+    # bool is a subclass of int
+    if isinstance(value, int) and not isinstance(value, bool):
+      return
+  elif isinstance(value, schema):
+    return
+  found = "null" if value is None else type(value).__name__
+  errors.append(f"{path}: expected {_describe(schema)}, found {found}")
+
+
+def validate(settings: dict) -> None:
+  errors = []
+  _check(settings, SCHEMA, "settings", errors)
+  if errors:
+    raise SchemaError(errors)
+
+
+###############################################################################
+# Snapshots
+###############################################################################
+def field_name(key: str) -> str:
+  return key.replace("-", "_").replace("/", "_")
+
+
+def sanitize(value: object) -> object:
+  if isinstance(value, dict):
+    return {field_name(k): sanitize(v) for k, v in value.items()}
+  elif isinstance(value, list):
+    return [sanitize(v) for v in value]
+  return value
+
+
+def content_hash(data: bytes) -> str:
+  h = hashlib.sha256(f"settings-snapshot:{FORMAT_VERSION}\0".encode())
+  h.update(data)
+  return h.hexdigest()
+
+
+def _load_yaml(data: bytes, check: bool = True) -> dict:
+  import yaml
+
+  settings = yaml.safe_load(data)
+  if check:
+    validate(settings)
+  return sanitize(settings)
+
+
+def compile_snapshot(settings_yml: Path = SETTINGS_YML) -> str:
+  data = Path(settings_yml).read_bytes()
+  header = {"format": FORMAT_VERSION, "sha256": content_hash(data)}
+  settings = _load_yaml(data)
+  return "".join(f"{json.dumps(v, separators=(',', ':'))}\n" for v in (header, settings))
+
+
+def _read_snapshot(snapshot_file: Path, data: bytes, object_pairs_hook: object) -> Optional[object]:
+  # The snapshot's content, or None if it's missing or stale
+  try:
+    with Path(snapshot_file).open() as input:
+      header = json.loads(input.readline())
+      if header.get("format") != FORMAT_VERSION or header.get("sha256") != content_hash(data):
+        return None
+      return json.loads(input.readline(), object_pairs_hook=object_pairs_hook)
+  except (OSError, ValueError):
+    return None
+
+
+@lru_cache(maxsize=None)
+def _tuple_type(fields: tuple) -> type:
+  return namedtuple("cfg", fields)
+
+
+def _make_tuple(pairs: list) -> NamedTuple:
+  return _tuple_type(tuple(k for k, _ in pairs))(*(v for _, v in pairs))
+
+
+def to_tuple(value: object) -> object:
+  if isinstance(value, dict):
+    return _tuple_type(tuple(value))(*(to_tuple(v) for v in value.values()))
+  elif isinstance(value, list):
+    return [to_tuple(v) for v in value]
+  return value
+
+
+def load_dict(
+  settings_yml: Path = SETTINGS_YML, snapshot_file: Optional[Path] = None, validate: bool = True
+) -> dict:
+  # The (sanitized) settings, from the snapshot if it's up to date.
+  # Disable `validate` for files which may follow a different schema
+  # (e.g. of another repository).
+  data = Path(settings_yml).read_bytes()
+  snapshot_file = snapshot_file or Path(settings_yml).with_name(SNAPSHOT_FILE.name)
+  settings = _read_snapshot(snapshot_file, data, None)
+  return settings if settings is not None else _load_yaml(data, validate)
+
+
+def load(settings_yml: Path = SETTINGS_YML, snapshot_file: Optional[Path] = None) -> NamedTuple:
+  # The settings as nested NamedTuples, like the `cfg` passed to the hooks
+  data = Path(settings_yml).read_bytes()
+  snapshot_file = snapshot_file or Path(settings_yml).with_name(SNAPSHOT_FILE.name)
+  cfg = _read_snapshot(snapshot_file, data, _make_tuple)
+  return cfg if cfg is not None else to_tuple(_load_yaml(data))
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Validate and compile settings.yml")
+  parser.add_argument("-f", "--settings", type=Path, default=SETTINGS_YML)
+  parser.add_argument("-o", "--output", type=Path, default=None, help="snapshot file")
+  subparsers = parser.add_subparsers(dest="action", required=True)
+  subparsers.add_parser("compile", help="validate settings.yml and write the snapshot")
+  subparsers.add_parser("check", help="validate settings.yml and verify the snapshot")
+  args = parser.parse_args()
+
+  output = args.output or args.settings.with_name(SNAPSHOT_FILE.name)
+  try:
+    snapshot = compile_snapshot(args.settings)
+  except SchemaError as e:
+    for error in e.errors:
+      print(f"ERROR {args.settings}: {error}", file=sys.stderr)
+    sys.exit(1)
+
+  current = output.read_text() if output.is_file() else None
+  if args.action == "check":
+    if current != snapshot:
+      print(f"ERROR {output} is out of date, run `{Path(__file__).name} compile`", file=sys.stderr)
+      sys.exit(1)
+  elif current != snapshot:
+    output.write_text(snapshot)
+    print(f"updated {output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,390 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Merge the test results of every job of a run into a single report.
+#
+# Every test job uploads its results directory (`ci.test.results_dir`) as
+# an artifact, after describing itself in a small file (test-job.json):
+#
+#   python3 .pyconfig/test_report.py describe -d test-results \
+#     -k deb -t <TEST_ID> -b ubuntu:22.04 -p amd64
+#
+# `merge` reads the downloaded artifacts (one directory per job), parsing
+# the JUnit XML files incrementally, and the `{TEST_ID}.log` files, into a
+# JSON report with the duration of every test, keyed by job (kind, base
+# image, platform) and test name. Durations are compared against the runs
+# recorded in a history file, which is then updated:
+#
+#   python3 .pyconfig/test_report.py merge test-results/ \
+#     -H test-history.json -o artifacts/test-report.json
+#
+# The report lists the slowest tests, and those which got slower than
+# usual (the median of their recorded durations) by more than a tolerance.
+# release_notes.summarize() includes them in the release notes.
+###############################################################################
+import argparse
+import heapq
+import json
+import os
+import re
+import statistics
+import sys
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple, Optional
+
+import tracing
+
+FORMAT_VERSION = 1
+JOB_FILE = "test-job.json"
+# Runs kept in the history file
+DEFAULT_MAX_RUNS = 20
+# A test regressed if it got this much slower than its baseline...
+DEFAULT_TOLERANCE = 1.5
+# ...and by at least this many seconds
+DEFAULT_MIN_DELTA = 0.5
+# Entries of the "slowest" and "regressions" lists
+DEFAULT_TOP = 10
+
+# Artifact names generated by the configure() hooks: {repo}-test-{test_id}
+# (build_and_test_docker, release_test), and {repo}-debtest-{test_id}
+ARTIFACT_NAME_RE = re.compile(r"-(?P<kind>test|debtest)-(?P<test_id>.+)$")
+LOG_DATE_RE = re.compile(r"^Test run id (\S+)", re.MULTILINE)
+
+
+class Job(NamedTuple):
+  artifact: str
+  kind: str
+  test_id: str
+  base_image: str
+  platform: str
+
+  @property
+  def key(self) -> str:
+    # Stable across runs (unlike the test id, which includes the version)
+    return ":".join(p for p in (self.kind, self.base_image, self.platform) if p)
+
+
+class TestCase(NamedTuple):
+  job: Job
+  suite: str
+  name: str
+  status: str
+  duration: float
+
+  @property
+  def key(self) -> str:
+    return f"{self.job.key}::{self.suite}::{self.name}"
+
+
+###############################################################################
+# Job results
+###############################################################################
+def describe_job(results_dir: Path, **fields: str) -> Path:
+  # Written by each job next to its results, before they are uploaded
+  results_dir.mkdir(parents=True, exist_ok=True)
+  job_file = results_dir / JOB_FILE
+  job_file.write_text(json.dumps({"format": FORMAT_VERSION, **fields}))
+  return job_file
+
+
+def load_job(job_dir: Path) -> Job:
+  job_file = job_dir / JOB_FILE
+  fields = json.loads(job_file.read_text()) if job_file.is_file() else {}
+  # Fall back to the artifact's name (e.g. results uploaded by older runs)
+  m = ARTIFACT_NAME_RE.search(job_dir.name)
+  test_id = fields.get("test_id") or (m.group("test_id") if m else job_dir.name)
+  kind = fields.get("kind")
+  if not kind:
+    if m and m.group("kind") == "debtest":
+      kind = "deb"
+    else:
+      kind = "release" if test_id.startswith("release-") else "docker"
+  return Job(
+    artifact=job_dir.name,
+    kind=kind,
+    test_id=test_id,
+    base_image=fields.get("base_image", ""),
+    platform=fields.get("platform", ""),
+  )
+
+
+def _has_own_results(path: Path) -> bool:
+  # The job's description, its log, or JUnit XML files (not in subdirectories)
+  return (
+    (path / JOB_FILE).is_file()
+    or (path / f"{load_job(path).test_id}.log").is_file()
+    or next(path.glob("*.xml"), None) is not None
+  )
+
+
+def is_job_dir(path: Path) -> bool:
+  return _has_own_results(path) or next(path.rglob("*.xml"), None) is not None
+
+
+def job_dirs(paths: Iterable[Path]) -> list:
+  # Every path is either a job's directory, or a directory containing them
+  # (e.g. where `actions/download-artifact` extracted multiple artifacts).
+  # Directories without any results (e.g. when no artifact was downloaded)
+  # are not jobs.
+  result = []
+  for path in paths:
+    if not path.is_dir():
+      continue
+    if _has_own_results(path):
+      result.append(path)
+    else:
+      result.extend(p for p in sorted(path.iterdir()) if p.is_dir() and is_job_dir(p))
+  return result
+
+
+def _status(testcase: ET.Element) -> str:
+  for child in testcase:
+    if child.tag in ("failure", "error", "skipped"):
+      return child.tag
+  return "passed"
+
+
+def iter_junit(xml_file: Path, job: Job) -> Iterator[TestCase]:
+  # Parse incrementally, dropping every element once it's been read, so
+  # that large reports don't have to fit in memory
+  suites = []
+  for event, elem in ET.iterparse(xml_file, events=("start", "end")):
+    if elem.tag == "testsuite":
+      if event == "start":
+        suites.append(elem.get("name", ""))
+      else:
+        suites.pop()
+        elem.clear()
+    elif elem.tag == "testcase" and event == "end":
+      classname = elem.get("classname") or (suites[-1] if suites else "")
+      yield TestCase(
+        job=job,
+        suite=classname,
+        name=elem.get("name", ""),
+        status=_status(elem),
+        duration=float(elem.get("time") or 0),
+      )
+      elem.clear()
+
+
+def read_log_date(job_dir: Path, job: Job) -> str:
+  # The date of the run, from the job's log (`Test run id <date>`)
+  log = job_dir / f"{job.test_id}.log"
+  if not log.is_file():
+    return ""
+  with log.open(errors="replace") as input:
+    m = LOG_DATE_RE.search(input.read(4096))
+  return m.group(1) if m else ""
+
+
+###############################################################################
+# History
+###############################################################################
+class History:
+  def __init__(self, runs: Optional[list] = None) -> None:
+    # Oldest first: [{"run_id": ..., "created_at": ..., "durations": {key: seconds}}]
+    self.runs = runs or []
+
+  @classmethod
+  def load(cls, path: Optional[Path]) -> "History":
+    if path is None or not path.is_file():
+      return cls()
+    try:
+      data = json.loads(path.read_text())
+    except ValueError:
+      print(f"WARNING ignoring invalid history file: {path}", file=sys.stderr)
+      return cls()
+    if data.get("format") != FORMAT_VERSION:
+      return cls()
+    return cls(data.get("runs", []))
+
+  def baselines(self) -> dict:
+    # The median duration of every test across the recorded runs
+    durations = {}
+    for run in self.runs:
+      for key, duration in run["durations"].items():
+        durations.setdefault(key, []).append(duration)
+    return {key: statistics.median(values) for key, values in durations.items()}
+
+  def add(self, run_id: str, durations: dict, max_runs: int = DEFAULT_MAX_RUNS) -> None:
+    # A run is only recorded once (e.g. when a job is re-run)
+    self.runs = [run for run in self.runs if run["run_id"] != run_id]
+    self.runs.append(
+      {
+        "run_id": run_id,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "durations": durations,
+      }
+    )
+    del self.runs[: max(0, len(self.runs) - max_runs)]
+
+  def save(self, path: Path) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    tmp.write_text(json.dumps({"format": FORMAT_VERSION, "runs": self.runs}))
+    tmp.replace(path)
+
+
+###############################################################################
+# Report
+###############################################################################
+@tracing.span("test_report.merge")
+def merge(
+  paths: Iterable[Path],
+  history: History,
+  tolerance: float = DEFAULT_TOLERANCE,
+  min_delta: float = DEFAULT_MIN_DELTA,
+  top: int = DEFAULT_TOP,
+) -> dict:
+  baselines = history.baselines()
+  jobs = []
+  tests = []
+  slowest = []
+  regressions = []
+  for job_dir in job_dirs(paths):
+    job = load_job(job_dir)
+    counts = {"passed": 0, "failure": 0, "error": 0, "skipped": 0}
+    job_duration = 0.0
+    with tracing.span("merge job", job=job.artifact):
+      for xml_file in sorted(job_dir.rglob("*.xml")):
+        try:
+          testcases = list(iter_junit(xml_file, job))
+        except ET.ParseError as e:
+          print(f"WARNING ignoring invalid JUnit file: {xml_file}: {e}", file=sys.stderr)
+          continue
+        for test in testcases:
+          counts[test.status] += 1
+          job_duration += test.duration
+          baseline = baselines.get(test.key)
+          row = {
+            "key": test.key,
+            "job": job.key,
+            "suite": test.suite,
+            "name": test.name,
+            "status": test.status,
+            "duration": test.duration,
+            "baseline": baseline,
+          }
+          tests.append(row)
+          # (duration, tie-breaker, row)
+          heapq.heappush(slowest, (test.duration, len(tests), row))
+          if len(slowest) > top:
+            heapq.heappop(slowest)
+          if (
+            baseline is not None
+            and test.status != "skipped"
+            and test.duration > baseline * tolerance
+            and test.duration - baseline >= min_delta
+          ):
+            heapq.heappush(regressions, (test.duration - baseline, len(tests), row))
+            if len(regressions) > top:
+              heapq.heappop(regressions)
+    jobs.append(
+      {
+        **job._asdict(),
+        "key": job.key,
+        "date": read_log_date(job_dir, job),
+        "tests": sum(counts.values()),
+        "failures": counts["failure"],
+        "errors": counts["error"],
+        "skipped": counts["skipped"],
+        "duration": job_duration,
+      }
+    )
+  return {
+    "format": FORMAT_VERSION,
+    "created_at": datetime.now().isoformat(timespec="seconds"),
+    "history_runs": len(history.runs),
+    "tolerance": tolerance,
+    "jobs": jobs,
+    "tests": tests,
+    "slowest": [row for _, _, row in sorted(slowest, reverse=True)],
+    "regressions": [row for _, _, row in sorted(regressions, reverse=True)],
+  }
+
+
+def durations(report: dict) -> dict:
+  # The durations to record in the history (of tests which ran)
+  return {t["key"]: t["duration"] for t in report["tests"] if t["status"] != "skipped"}
+
+
+def load_report(path: Path) -> Optional[dict]:
+  if not path.is_file():
+    return None
+  report = json.loads(path.read_text())
+  return report if report.get("format") == FORMAT_VERSION else None
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Merge the test results of multiple jobs")
+  subparsers = parser.add_subparsers(dest="action", required=True)
+
+  describe = subparsers.add_parser("describe", help="describe a job's results")
+  describe.add_argument("-d", "--results-dir", type=Path, required=True)
+  describe.add_argument("-k", "--kind", required=True, help="e.g. docker, deb, release")
+  describe.add_argument("-t", "--test-id", required=True)
+  describe.add_argument("-b", "--base-image", default="")
+  describe.add_argument("-p", "--platform", default="")
+
+  merge_parser = subparsers.add_parser("merge", help="merge the results of multiple jobs")
+  merge_parser.add_argument("results", type=Path, nargs="+", help="job (or artifacts) directory")
+  merge_parser.add_argument("-o", "--output", type=Path, default=None, help="default: stdout")
+  merge_parser.add_argument("-H", "--history", type=Path, default=None, help="history file")
+  merge_parser.add_argument(
+    "-r", "--run-id", default=None, help="record the run in the history with this id"
+  )
+  merge_parser.add_argument("--max-runs", type=int, default=DEFAULT_MAX_RUNS)
+  merge_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+  merge_parser.add_argument("--min-delta", type=float, default=DEFAULT_MIN_DELTA)
+  merge_parser.add_argument("--top", type=int, default=DEFAULT_TOP)
+  args = parser.parse_args()
+
+  if args.action == "describe":
+    describe_job(
+      args.results_dir,
+      kind=args.kind,
+      test_id=args.test_id,
+      base_image=args.base_image,
+      platform=args.platform,
+    )
+    return
+
+  start = time.monotonic()
+  history = History.load(args.history)
+  report = merge(args.results, history, args.tolerance, args.min_delta, args.top)
+  output = json.dumps(report, indent=2)
+  if args.output is None:
+    print(output)
+  else:
+    args.output.parent.mkdir(parents=True, exist_ok=True)
+    args.output.write_text(output)
+  if args.history is not None and args.run_id and report["jobs"]:
+    history.add(args.run_id, durations(report), args.max_runs)
+    history.save(args.history)
+  print(
+    f"merged {len(report['tests'])} tests from {len(report['jobs'])} jobs"
+    f" ({len(report['regressions'])} regressions) in {time.monotonic() - start:.2f}s",
+    file=sys.stderr,
+  )
+
+
+if __name__ == "__main__":
+  main()
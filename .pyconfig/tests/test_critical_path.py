@@ -0,0 +1,125 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Tests of critical_path.py on an exported release run (fixtures/), analyzed
+# offline against the repository's workflows:
+#
+#   python3 -m unittest discover -s .pyconfig/tests
+###############################################################################
+import json
+import subprocess
+import sys
+import tempfile
+import unittest
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from critical_path import (  # noqa: E402
+  DEFAULT_WORKFLOW,
+  analyze,
+  load_jobs,
+  records,
+  runner_names,
+  workflow_graph,
+)
+
+PYCONFIG_DIR = Path(__file__).resolve().parents[1]
+CLONE_DIR = PYCONFIG_DIR.parent
+RELEASE_RUN = Path(__file__).resolve().parent / "fixtures" / "release-run.json"
+RUNNERS = {"linux_amd64": "ubuntu-latest", "linux_arm64": ["self-hosted", "linux", "arm64"]}
+
+
+class CriticalPathTest(unittest.TestCase):
+  def setUp(self) -> None:
+    self.export = json.loads(RELEASE_RUN.read_text())
+    self.jobs = load_jobs(self.export, runner_names(RUNNERS))
+    self.report = analyze(workflow_graph(CLONE_DIR, DEFAULT_WORKFLOW), self.jobs)
+    self.nodes = {node["node"]: node for node in self.report["nodes"]}
+
+  def test_jobs(self) -> None:
+    # The job running the analysis hasn't completed yet
+    self.assertNotIn("timing", [job.name for job in self.jobs])
+    # Matrix jobs are grouped under the same node
+    self.assertEqual(self.nodes["docker / test"]["jobs"], 2)
+    self.assertEqual(self.nodes["deb / build / build"]["jobs"], 2)
+
+  def test_critical_path(self) -> None:
+    self.assertEqual(self.report["duration"], 1200.0)
+    path = self.report["critical_path"]
+    self.assertEqual([n["node"] for n in path], ["docker / build", "docker / test", "push / push"])
+    # The slowest job of a node bounds its duration (the arm64 tests)
+    self.assertEqual(path[1]["duration"], 600.0)
+    self.assertEqual(path[1]["queue_time"], 120.0)
+    self.assertEqual(path[1]["steps"][0]["step"], "Run tests")
+
+  def test_slack(self) -> None:
+    for name in ("docker / build", "docker / test", "push / push"):
+      self.assertEqual(self.nodes[name]["slack"], 0.0)
+      self.assertTrue(self.nodes[name]["critical"])
+    # The Debian packages are ready 200s before the docker tests complete
+    for name in ("deb / config", "deb / build / config", "deb / build / build"):
+      self.assertEqual(self.nodes[name]["slack"], 200.0)
+      self.assertFalse(self.nodes[name]["critical"])
+    self.assertEqual(self.nodes["push / push"]["needs"], ["docker / test", "deb / build / build"])
+
+  def test_runners(self) -> None:
+    runners = {r["runner"]: r for r in self.report["runners"]}
+    self.assertEqual(sorted(runners), ["linux_amd64", "linux_arm64"])
+    self.assertEqual(runners["linux_arm64"]["jobs"], 2)
+    self.assertEqual(runners["linux_arm64"]["queue_max"], 150.0)
+    self.assertEqual(runners["linux_amd64"]["queue_max"], 6.0)
+
+  def test_records(self) -> None:
+    result = records(self.export, self.report, self.jobs)
+    self.assertEqual(len(result), len(self.jobs) + 1)
+    self.assertEqual(result[0]["kind"], "run")
+    self.assertEqual(result[0]["run_id"], self.export["run"]["id"])
+    self.assertEqual(
+      {r["job"] for r in result if r["kind"] == "job" and r["critical"]},
+      {
+        "docker / build",
+        "docker / test (ubuntu:22.04, linux/amd64)",
+        "docker / test (ubuntu:22.04, linux/arm64)",
+        "push / push",
+      },
+    )
+
+  def test_cli(self) -> None:
+    # As run by the `timing` job of release.yml, with the runners of settings.yml
+    with tempfile.TemporaryDirectory() as tmp:
+      records_f = Path(tmp) / "timing.jsonl"
+      result = subprocess.run(
+        [
+          sys.executable,
+          str(PYCONFIG_DIR / "critical_path.py"),
+          "analyze",
+          str(RELEASE_RUN),
+          "-C",
+          str(CLONE_DIR),
+          "-r",
+          str(records_f),
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+      )
+      self.assertIn("Total duration: **20m00s**", result.stdout)
+      self.assertIn("`linux_arm64`", result.stdout)
+      self.assertEqual(len(records_f.read_text().splitlines()), len(self.jobs) + 1)
+
+
+if __name__ == "__main__":
+  unittest.main()
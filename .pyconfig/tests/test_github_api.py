@@ -0,0 +1,269 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Tests of github_api.py against a local stand-in server (http.server), which
+# implements a REST endpoint with conditional requests, failing endpoints, and
+# the GraphQL query of a PR's review decision:
+#
+#   python3 -m unittest discover -s .pyconfig/tests
+###############################################################################
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from github_api import GitHubAPIError, GitHubClient, review_decision  # noqa: E402
+from snapshot import to_tuple  # noqa: E402
+
+PYCONFIG_DIR = Path(__file__).resolve().parents[1]
+TOKEN = "stand-in-token"
+REPO = {"full_name": "org/app", "default_branch": "master"}
+REPO_ETAG = '"repo-v1"'
+
+
+class StandInGitHub(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self) -> None:
+    super().__init__(("127.0.0.1", 0), GitHubHandler)
+    # Responses to configure before each test
+    self.failures = []
+    self.review_decision = "APPROVED"
+    self.graphql_errors = []
+    # Requests received: (method, path, headers, body)
+    self.requests = []
+
+  @property
+  def url(self) -> str:
+    return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class GitHubHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  server: StandInGitHub
+
+  def log_message(self, format: str, *args: object) -> None:
+    pass
+
+  def _reply(self, status: int, headers: dict, body: object = None) -> None:
+    data = json.dumps(body).encode() if body is not None else b""
+    self.send_response(status)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    if data:
+      self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def _handle(self) -> None:
+    length = int(self.headers.get("Content-Length") or 0)
+    body = json.loads(self.rfile.read(length)) if length else None
+    self.server.requests.append((self.command, self.path, dict(self.headers), body))
+    if self.headers.get("Authorization") != f"Bearer {TOKEN}":
+      self._reply(401, {}, {"message": "Bad credentials"})
+      return
+    if self.server.failures:
+      # (status, headers) of the next failed responses
+      status, headers = self.server.failures.pop(0)
+      self._reply(status, headers, {"message": "stand-in failure"})
+      return
+    if self.command == "GET" and self.path == "/repos/org/app":
+      if self.headers.get("If-None-Match") == REPO_ETAG:
+        self._reply(304, {"ETag": REPO_ETAG})
+      else:
+        self._reply(200, {"ETag": REPO_ETAG}, REPO)
+      return
+    if self.command == "POST" and self.path == "/graphql":
+      if self.server.graphql_errors:
+        self._reply(200, {}, {"data": None, "errors": self.server.graphql_errors})
+        return
+      pull_request = {"reviewDecision": self.server.review_decision}
+      self._reply(200, {}, {"data": {"repository": {"pullRequest": pull_request}}})
+      return
+    self._reply(404, {}, {"message": "Not Found"})
+
+  do_GET = _handle
+  do_POST = _handle
+
+
+class StandInTestCase(unittest.TestCase):
+  def setUp(self) -> None:
+    self.server = StandInGitHub()
+    thread = threading.Thread(
+      target=self.server.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(self.server.server_close)
+    self.addCleanup(self.server.shutdown)
+    tmp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(tmp_dir.cleanup)
+    self.cache_dir = Path(tmp_dir.name)
+    # Retries are not delayed, but their delays are recorded
+    self.sleeps = []
+    sleep = mock.patch("github_api.time.sleep", self.sleeps.append)
+    sleep.start()
+    self.addCleanup(sleep.stop)
+
+  def client(self, token: str = TOKEN, **kwargs: object) -> GitHubClient:
+    client = GitHubClient(
+      token=token,
+      api_url=self.server.url,
+      graphql_url=f"{self.server.url}/graphql",
+      cache_dir=self.cache_dir,
+      **kwargs,
+    )
+    self.addCleanup(client.close)
+    return client
+
+
+class GitHubAPITest(StandInTestCase):
+  def test_etag(self) -> None:
+    self.assertEqual(self.client().get("repos/org/app"), REPO)
+    # The cached response is revalidated by another client (e.g. of a later
+    # hook), and reused when the server replies "304 Not Modified"
+    self.assertEqual(self.client().get("/repos/org/app"), REPO)
+    conditional = [headers.get("If-None-Match") for _, _, headers, _ in self.server.requests]
+    self.assertEqual(conditional, [None, REPO_ETAG])
+
+  def test_etag_no_cache(self) -> None:
+    client = self.client()
+    client.get("repos/org/app", cache=False)
+    client.get("repos/org/app", cache=False)
+    self.assertFalse(any(self.cache_dir.iterdir()))
+    self.assertNotIn("If-None-Match", self.server.requests[-1][2])
+
+  def test_etag_per_token(self) -> None:
+    self.client().get("repos/org/app")
+    # Responses cached for another token are not reused
+    with self.assertRaises(GitHubAPIError) as e:
+      self.client(token="other").get("repos/org/app")
+    self.assertEqual(e.exception.status, 401)
+    self.assertNotIn("If-None-Match", self.server.requests[-1][2])
+
+  def test_retry_server_error(self) -> None:
+    self.server.failures = [(502, {}), (503, {})]
+    self.assertEqual(self.client().get("repos/org/app"), REPO)
+    self.assertEqual(len(self.server.requests), 3)
+    self.assertEqual(len(self.sleeps), 2)
+    # Exponential backoff (with jitter)
+    self.assertLess(self.sleeps[0], self.sleeps[1])
+
+  def test_retry_after(self) -> None:
+    self.server.failures = [(429, {"Retry-After": "2"}), (403, {"Retry-After": "3"})]
+    self.assertEqual(self.client().get("repos/org/app"), REPO)
+    self.assertEqual(self.sleeps, [2.0, 3.0])
+
+  def test_retries_exhausted(self) -> None:
+    self.server.failures = [(500, {})] * 3
+    with self.assertRaises(GitHubAPIError) as e:
+      self.client(max_retries=2).get("repos/org/app")
+    self.assertEqual(e.exception.status, 500)
+    self.assertIn("stand-in failure", str(e.exception))
+    self.assertEqual(len(self.server.requests), 3)
+
+  def test_no_retry(self) -> None:
+    # Client errors, and delays longer than the maximum, are not retried
+    with self.assertRaises(GitHubAPIError) as e:
+      self.client().get("repos/org/missing")
+    self.assertEqual(e.exception.status, 404)
+    self.assertIn("Not Found", str(e.exception))
+    self.server.failures = [(429, {"Retry-After": "3600"})]
+    with self.assertRaises(GitHubAPIError) as e:
+      self.client().get("repos/org/app")
+    self.assertEqual(e.exception.status, 429)
+    self.assertEqual(self.sleeps, [])
+
+  def test_graphql_errors(self) -> None:
+    self.server.graphql_errors = [{"message": "Could not resolve to a Repository"}]
+    with self.assertRaises(GitHubAPIError) as e:
+      review_decision(self.client(), "org/app", 1)
+    self.assertIn("Could not resolve to a Repository", str(e.exception))
+
+  def test_review_decision(self) -> None:
+    for decision, expected in (
+      ("APPROVED", "approved"),
+      ("CHANGES_REQUESTED", "changes_requested"),
+      ("REVIEW_REQUIRED", "review_required"),
+      (None, ""),
+    ):
+      with self.subTest(decision=decision):
+        self.server.review_decision = decision
+        self.assertEqual(review_decision(self.client(), "org/app", 7), expected)
+    variables = self.server.requests[-1][3]["variables"]
+    self.assertEqual(variables, {"owner": "org", "name": "app", "number": 7})
+
+
+class PullRequestConfigureTest(StandInTestCase):
+  def configure(self) -> dict:
+    spec = importlib.util.spec_from_file_location(
+      "test_pull_request", PYCONFIG_DIR / "workflows" / "pull_request.py"
+    )
+    pull_request = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(pull_request)
+    validation = {
+      "basic": {"base_images": ["ubuntu:22.04"], "build_platforms": ["linux/amd64"]},
+      "full": {"base_images": ["ubuntu:22.04"], "build_platforms": ["linux/arm64"]},
+      "deb": {"base_images": ["ubuntu:22.04"], "build_architectures": ["amd64"]},
+    }
+    cfg = to_tuple({"pull_request": {"validation": validation}})
+    github = to_tuple(
+      {
+        "repository": "org/app",
+        "sha": "0" * 40,
+        "event_name": "pull_request",
+        "event": {
+          "action": "ready_for_review",
+          "pull_request": {"draft": False, "number": 7},
+          "review": {"state": ""},
+        },
+      }
+    )
+    env = {
+      "GH_TOKEN": TOKEN,
+      "GITHUB_API_URL": self.server.url,
+      "GITHUB_GRAPHQL_URL": f"{self.server.url}/graphql",
+      "PYCONFIG_CACHE_DIR": str(self.cache_dir),
+    }
+    with mock.patch.dict(os.environ, env), contextlib.redirect_stdout(io.StringIO()):
+      return pull_request.configure(self.cache_dir, cfg, github, to_tuple({}))
+
+  def test_approved(self) -> None:
+    self.server.review_decision = "APPROVED"
+    result = self.configure()
+    self.assertTrue(result["VALIDATE_BASIC"])
+    self.assertTrue(result["VALIDATE_FULL"])
+    self.assertEqual(self.server.requests[-1][3]["variables"]["number"], 7)
+
+  def test_not_approved(self) -> None:
+    self.server.review_decision = "CHANGES_REQUESTED"
+    result = self.configure()
+    self.assertTrue(result["VALIDATE_BASIC"])
+    self.assertFalse(result["VALIDATE_FULL"])
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,76 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Tests of markdown_stream.py, with sinks which run out of budget at every
+# point of a document:
+#
+#   python3 -m unittest discover -s .pyconfig/tests
+###############################################################################
+import io
+import sys
+import unittest
+from pathlib import Path
+from typing import Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from markdown_stream import MarkdownStream, Sink  # noqa: E402
+
+ROWS = 100
+
+
+def render(budget: Optional[int]) -> str:
+  output = io.StringIO()
+  stream = MarkdownStream([Sink(output, budget)])
+  stream.write("# Release", "")
+  stream.table(
+    ["Package", "Version"],
+    ([f"package-{i}", f"1.0.{i}"] for i in range(ROWS)),
+    row_count=ROWS,
+    collapse_rows=10,
+  )
+  stream.write("## Tests", "")
+  stream.close()
+  return output.getvalue()
+
+
+class MarkdownStreamTest(unittest.TestCase):
+  def test_untruncated(self) -> None:
+    body = render(None)
+    self.assertEqual(body.count("| package-"), ROWS)
+    self.assertNotIn("omitted", body)
+    self.assertNotIn("Output truncated", body)
+
+  def test_budgets(self) -> None:
+    for budget in range(600, 3000, 13):
+      with self.subTest(budget=budget):
+        body = render(budget)
+        self.assertLessEqual(len(body.encode()), budget)
+        self.assertIn("Output truncated", body)
+        # A collapsed table is always closed, so that what follows it
+        # (e.g. the truncation notice) isn't hidden
+        self.assertEqual(body.count("<details>"), body.count("</details>"))
+        if "<details>" in body:
+          self.assertLess(body.index("</details>"), body.index("Output truncated"))
+
+  def test_912_bytes(self) -> None:
+    body = render(912)
+    self.assertEqual(body.count("<details>"), 1)
+    self.assertEqual(body.count("</details>"), 1)
+    self.assertIn("more rows omitted", body)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,202 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Tests of registry_wait.py against a local stand-in registry (http.server),
+# which implements the manifest and token endpoints of the Docker Registry
+# HTTP API v2:
+#
+#   python3 -m unittest discover -s .pyconfig/tests
+###############################################################################
+import base64
+import contextlib
+import hashlib
+import io
+import json
+import sys
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from registry_wait import RegistryClient, RegistryError, wait_for_manifest  # noqa: E402
+
+MANIFEST = json.dumps(
+  {
+    "schemaVersion": 2,
+    "mediaType": "application/vnd.oci.image.index.v1+json",
+    "manifests": [],
+  }
+).encode()
+MANIFEST_TYPE = "application/vnd.oci.image.index.v1+json"
+MANIFEST_DIGEST = f"sha256:{hashlib.sha256(MANIFEST).hexdigest()}"
+TOKEN = "stand-in-token"
+USER = "tester"
+PASSWORD = "secret"
+
+
+class StandInRegistry(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self) -> None:
+    super().__init__(("127.0.0.1", 0), RegistryHandler)
+    # Responses to configure before each test
+    self.require_token = False
+    self.not_found = 0
+    self.send_digest = True
+    # Requests received: (method, path, Authorization header)
+    self.requests = []
+
+  @property
+  def host(self) -> str:
+    return f"127.0.0.1:{self.server_address[1]}"
+
+
+class RegistryHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+  server: StandInRegistry
+
+  def log_message(self, format: str, *args: object) -> None:
+    pass
+
+  def _reply(self, status: int, headers: dict, body: bytes = b"") -> None:
+    self.send_response(status)
+    for k, v in headers.items():
+      self.send_header(k, v)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    if self.command != "HEAD":
+      self.wfile.write(body)
+
+  def _handle(self) -> None:
+    auth = self.headers.get("Authorization", "")
+    self.server.requests.append((self.command, self.path, auth))
+    if self.path.startswith("/token"):
+      credentials = base64.b64encode(f"{USER}:{PASSWORD}".encode()).decode()
+      if auth != f"Basic {credentials}":
+        self._reply(401, {})
+        return
+      self._reply(200, {"Content-Type": "application/json"}, json.dumps({"token": TOKEN}).encode())
+      return
+    if not self.path.startswith("/v2/org/app/manifests/"):
+      self._reply(404, {})
+      return
+    if self.server.require_token and auth != f"Bearer {TOKEN}":
+      challenge = (
+        f'Bearer realm="http://{self.server.host}/token",service="stand-in"'
+        ',scope="repository:org/app:pull"'
+      )
+      self._reply(401, {"WWW-Authenticate": challenge})
+      return
+    if self.server.not_found > 0:
+      self.server.not_found -= 1
+      self._reply(404, {})
+      return
+    headers = {"Content-Type": MANIFEST_TYPE}
+    if self.server.send_digest:
+      headers["Docker-Content-Digest"] = MANIFEST_DIGEST
+    self._reply(200, headers, MANIFEST)
+
+  do_GET = _handle
+  do_HEAD = _handle
+
+
+class FakeClock:
+  def __init__(self) -> None:
+    self.now = 0.0
+    self.sleeps = []
+
+  def __call__(self) -> float:
+    return self.now
+
+  def sleep(self, delay: float) -> None:
+    self.sleeps.append(delay)
+    self.now += delay
+
+
+class RegistryWaitTest(unittest.TestCase):
+  def setUp(self) -> None:
+    self.registry = StandInRegistry()
+    thread = threading.Thread(
+      target=self.registry.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    self.addCleanup(thread.join)
+    self.addCleanup(self.registry.server_close)
+    self.addCleanup(self.registry.shutdown)
+    self.image = f"{self.registry.host}/org/app:latest"
+    self.clock = FakeClock()
+
+  def wait(self, client: RegistryClient, **kwargs: float):
+    # Drop the progress messages
+    with contextlib.redirect_stderr(io.StringIO()):
+      return wait_for_manifest(
+        client, self.image, clock=self.clock, sleep=self.clock.sleep, **kwargs
+      )
+
+  def test_token_challenge(self) -> None:
+    self.registry.require_token = True
+    with RegistryClient(USER, PASSWORD, insecure=True) as client:
+      manifest = self.wait(client)
+      self.assertEqual(manifest.digest, MANIFEST_DIGEST)
+      self.assertEqual(manifest.media_type, MANIFEST_TYPE)
+      self.assertEqual(manifest.attempts, 1)
+      # The token is reused by later requests
+      self.wait(client)
+    token_requests = [r for r in self.registry.requests if r[1].startswith("/token")]
+    self.assertEqual(len(token_requests), 1)
+    self.assertIn("service=stand-in", token_requests[0][1])
+    self.assertIn("scope=repository%3Aorg%2Fapp%3Apull", token_requests[0][1])
+    self.assertEqual(self.registry.requests[-1][2], f"Bearer {TOKEN}")
+
+  def test_token_rejected(self) -> None:
+    self.registry.require_token = True
+    with RegistryClient(USER, "wrong", insecure=True) as client:
+      with self.assertRaises(RegistryError) as error:
+        self.wait(client)
+    self.assertEqual(error.exception.status, 401)
+
+  def test_not_found_then_available(self) -> None:
+    self.registry.not_found = 3
+    with RegistryClient(insecure=True) as client:
+      manifest = self.wait(client, interval=1.0, max_interval=3.0)
+    self.assertEqual(manifest.digest, MANIFEST_DIGEST)
+    self.assertEqual(manifest.attempts, 4)
+    # The delay doubles after every attempt, up to the maximum
+    self.assertEqual(self.clock.sleeps, [1.0, 2.0, 3.0])
+    self.assertEqual(manifest.elapsed, 6.0)
+
+  def test_missing_digest_header(self) -> None:
+    self.registry.send_digest = False
+    with RegistryClient(insecure=True) as client:
+      manifest = self.wait(client)
+    # The manifest is downloaded and hashed instead
+    self.assertEqual(manifest.digest, MANIFEST_DIGEST)
+    self.assertEqual([r[0] for r in self.registry.requests], ["HEAD", "GET"])
+
+  def test_deadline(self) -> None:
+    self.registry.not_found = 1000
+    with RegistryClient(insecure=True) as client:
+      with self.assertRaises(RegistryError) as error:
+        self.wait(client, timeout=10.0, interval=1.0, max_interval=4.0)
+    self.assertIn("not available after 10.0s", str(error.exception))
+    # The last delay is cut short by the deadline
+    self.assertEqual(self.clock.sleeps, [1.0, 2.0, 4.0, 3.0])
+    self.assertEqual(len(self.registry.requests), 5)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,203 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Opt-in tracing of the pyconfig hooks.
+#
+# Set PYCONFIG_TRACE=1 to record nested, timed spans around the phases of
+# settings(), configure() and summarize() (and of the helper scripts):
+#
+#   with tracing.span("gh pr view", pr=pr_no):
+#     ...
+#
+#   @tracing.span("settings")
+#   def settings(...):
+#     ...
+#
+# When the process exits, the spans are added to a Chrome trace-event file
+# (PYCONFIG_TRACE_FILE, default: pyconfig-trace.json), which can be opened
+# with chrome://tracing or https://ui.perfetto.dev. Multiple processes may
+# append to the same file. A table of the top PYCONFIG_TRACE_TOP spans (by
+# total time) is also printed to stderr.
+#
+# When tracing is disabled, spans don't record anything, and traced()
+# returns the wrapped function unchanged.
+###############################################################################
+import atexit
+import fcntl
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import ContextDecorator
+from pathlib import Path
+from typing import Callable, Optional
+
+DEFAULT_TRACE_FILE = "pyconfig-trace.json"
+DEFAULT_TOP = 15
+
+
+def _env_enabled() -> bool:
+  return os.environ.get("PYCONFIG_TRACE", "").strip().lower() not in ("", "0", "false", "no")
+
+
+class _Frame:
+  __slots__ = ("name", "start", "children")
+
+  def __init__(self, name: str, start: int) -> None:
+    self.name = name
+    self.start = start
+    self.children = 0
+
+
+class Tracer:
+  def __init__(self, trace_file: Path, top: int = DEFAULT_TOP) -> None:
+    self.trace_file = trace_file
+    self.top = top
+    self.pid = os.getpid()
+    self.events = []
+    # name -> [count, total, self, max] (in nanoseconds)
+    self.totals = {}
+    self._local = threading.local()
+    self._lock = threading.Lock()
+
+  @property
+  def _stack(self) -> list:
+    stack = getattr(self._local, "stack", None)
+    if stack is None:
+      stack = self._local.stack = []
+    return stack
+
+  def begin(self, name: str) -> None:
+    self._stack.append(_Frame(name, time.time_ns()))
+
+  def end(self, cat: str, args: dict) -> None:
+    end = time.time_ns()
+    stack = self._stack
+    frame = stack.pop()
+    duration = end - frame.start
+    if stack:
+      stack[-1].children += duration
+    event = {
+      "name": frame.name,
+      "cat": cat,
+      "ph": "X",
+      "ts": frame.start / 1000,
+      "dur": duration / 1000,
+      "pid": self.pid,
+      "tid": threading.get_native_id(),
+    }
+    if args:
+      event["args"] = {k: str(v) for k, v in args.items()}
+    with self._lock:
+      self.events.append(event)
+      totals = self.totals.setdefault(frame.name, [0, 0, 0, 0])
+      totals[0] += 1
+      totals[1] += duration
+      totals[2] += duration - frame.children
+      totals[3] = max(totals[3], duration)
+
+  def summary(self) -> str:
+    rows = sorted(self.totals.items(), key=lambda item: item[1][1], reverse=True)[: self.top]
+    width = max([len("Span"), *(len(name) for name, _ in rows)])
+    lines = [
+      f"{'Span':<{width}} {'Count':>7} {'Total (ms)':>12} {'Self (ms)':>12} {'Max (ms)':>12}",
+      f"{'-' * width} {'-' * 7} {'-' * 12} {'-' * 12} {'-' * 12}",
+    ]
+    for name, (count, total, self_time, max_time) in rows:
+      lines.append(
+        f"{name:<{width}} {count:>7} {total / 1e6:>12.3f} {self_time / 1e6:>12.3f}"
+        f" {max_time / 1e6:>12.3f}"
+      )
+    return "\n".join(lines)
+
+  def write(self) -> None:
+    # Merge with the events of other processes, under an exclusive lock
+    process = {
+      "name": "process_name",
+      "ph": "M",
+      "pid": self.pid,
+      "args": {"name": " ".join([Path(sys.argv[0]).name, *sys.argv[1:]]) or "python"},
+    }
+    self.trace_file.parent.mkdir(parents=True, exist_ok=True)
+    with self.trace_file.open("a+") as output:
+      fcntl.flock(output, fcntl.LOCK_EX)
+      output.seek(0)
+      content = output.read()
+      try:
+        trace = json.loads(content) if content.strip() else {}
+      except json.JSONDecodeError:
+        trace = {}
+      events = trace.get("traceEvents", [])
+      events.append(process)
+      events.extend(self.events)
+      output.seek(0)
+      output.truncate()
+      json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, output)
+
+  def flush(self) -> None:
+    if not self.events:
+      return
+    try:
+      self.write()
+    except OSError as e:
+      print(f"WARNING failed to write trace file {self.trace_file}: {e}", file=sys.stderr)
+    print("::group::pyconfig trace", file=sys.stderr)
+    print(self.summary(), file=sys.stderr)
+    print(f"trace: {self.trace_file}", file=sys.stderr)
+    print("::endgroup::", file=sys.stderr)
+
+
+def _create_tracer() -> Optional[Tracer]:
+  if not _env_enabled():
+    return None
+  tracer = Tracer(
+    trace_file=Path(os.environ.get("PYCONFIG_TRACE_FILE") or DEFAULT_TRACE_FILE).resolve(),
+    top=int(os.environ.get("PYCONFIG_TRACE_TOP") or DEFAULT_TOP),
+  )
+  atexit.register(tracer.flush)
+  return tracer
+
+
+_tracer = _create_tracer()
+
+
+def enabled() -> bool:
+  return _tracer is not None
+
+
+class span(ContextDecorator):
+  # Span state is kept on the tracer's (per-thread) stack, so the same
+  # instance can be reused as a decorator, including by recursive calls.
+  def __init__(self, name: str, cat: str = "pyconfig", **args: object) -> None:
+    self.name = name
+    self.cat = cat
+    self.args = args
+
+  def __enter__(self) -> "span":
+    if _tracer is not None:
+      _tracer.begin(self.name)
+    return self
+
+  def __exit__(self, *exc_info: object) -> None:
+    if _tracer is not None:
+      _tracer.end(self.cat, self.args)
+
+
+def traced(fn: Callable, name: Optional[str] = None) -> Callable:
+  # Wrap a function (e.g. one imported from another library) in a span
+  if _tracer is None:
+    return fn
+  return span(name or fn.__name__)(fn)
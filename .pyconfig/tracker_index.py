@@ -0,0 +1,399 @@
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# SQLite index of the entries of a release tracker checkout.
+#
+# The release tracker stores every release as
+# `<storage>/<track>/<version_id>/docker-manifests.json`. The index maps
+# each entry to the manifest digests it references, and keeps a reference
+# count for every digest, so that finding an entry, or the entries which
+# use a layer, doesn't require parsing the whole history.
+#
+# The index is stored in the checkout's git directory (so that it is never
+# committed to the tracker), and it is updated incrementally: entries are
+# identified by the blob id of their docker-manifests.json (read from git's
+# index, when possible), and only new or modified files are parsed.
+#
+# The storage directory is the one reported by the release tracker (e.g.
+# the `storage` of its summary), or else the only directory of the checkout
+# which contains entries.
+#
+# Prune planning is not an index query: the release tracker's policy is
+# implemented by release-tracker's find-prunable-docker, which still scans
+# the whole history, and it is not replicated here. The index only verifies
+# its result before any package version is deleted (a query on the index,
+# which is cheap next to the scan): the list of unprunable layers must
+# include every layer of the entries which are kept, e.g.:
+#
+#   python3 .pyconfig/tracker_index.py -C src/tracker check-prune -t nightly \
+#     -v prunable_versions.log -u unprunable_layers.log
+import argparse
+import os
+import sqlite3
+import sys
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+import tracing
+from docker_manifest import DockerManifests
+from gitmeta import GitMetaError, find_git_dir, hash_blob
+
+FORMAT_VERSION = 1
+INDEX_FILE = "tracker-index.sqlite"
+MANIFESTS_FILE = "docker-manifests.json"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+  track TEXT NOT NULL,
+  version_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  blob TEXT NOT NULL,
+  PRIMARY KEY (track, version_id)
+);
+CREATE TABLE IF NOT EXISTS entry_layers (
+  track TEXT NOT NULL,
+  version_id TEXT NOT NULL,
+  image TEXT NOT NULL,
+  digest TEXT NOT NULL,
+  PRIMARY KEY (track, version_id, image, digest)
+);
+CREATE INDEX IF NOT EXISTS entry_layers_digest ON entry_layers (digest);
+CREATE TABLE IF NOT EXISTS digests (
+  digest TEXT PRIMARY KEY,
+  refs INTEGER NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS entry_layers_ref AFTER INSERT ON entry_layers
+BEGIN
+  INSERT INTO digests (digest, refs) VALUES (NEW.digest, 1)
+    ON CONFLICT (digest) DO UPDATE SET refs = refs + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS entry_layers_unref AFTER DELETE ON entry_layers
+BEGIN
+  UPDATE digests SET refs = refs - 1 WHERE digest = OLD.digest;
+  DELETE FROM digests WHERE digest = OLD.digest AND refs <= 0;
+END;
+"""
+
+
+class Entry(NamedTuple):
+  track: str
+  version_id: str
+  # Path of docker-manifests.json, relative to the tracker checkout
+  path: str
+  blob: str
+
+
+class SyncStats(NamedTuple):
+  added: int
+  updated: int
+  removed: int
+  unchanged: int
+
+
+class PruneCheck(NamedTuple):
+  # Entries which are kept, and their layers missing from the unprunable list
+  kept: int
+  missing: list
+
+
+###############################################################################
+# Storage scan
+###############################################################################
+def _git_dir(tracker_dir: Path) -> Path:
+  # The git directory of the checkout (not of a repository containing it)
+  git_dir = find_git_dir(tracker_dir)
+  if git_dir.parent != Path(tracker_dir).resolve():
+    raise GitMetaError(f"not the root of a git repository: {tracker_dir}")
+  return git_dir
+
+
+def default_index_file(tracker_dir: Path) -> Path:
+  try:
+    return _git_dir(tracker_dir) / INDEX_FILE
+  except GitMetaError:
+    return Path(tracker_dir) / f".{INDEX_FILE}"
+
+
+def _entry_key(path: str) -> Optional[tuple]:
+  # (storage, track, version_id) for
+  # `<storage>/<track>/<version_id>/docker-manifests.json`
+  parts = path.split("/")
+  if len(parts) < 4 or parts[-1] != MANIFESTS_FILE:
+    return None
+  return "/".join(parts[:-3]), parts[-3], parts[-2]
+
+
+def _scan_git(tracker_dir: Path) -> dict:
+  from input_fingerprint import tracked_files
+
+  _git_dir(tracker_dir)
+  result = {}
+  for path, _, sha in tracked_files(Path(tracker_dir)):
+    key = _entry_key(path)
+    if key is not None:
+      result[key] = (path, sha)
+  return result
+
+
+def _scan_dir(tracker_dir: Path) -> dict:
+  # Fallback for checkouts which aren't git repositories: every file must
+  # be hashed, but only the changed ones are parsed.
+  result = {}
+  for root, dirs, files in os.walk(tracker_dir):
+    dirs[:] = [d for d in dirs if d != ".git"]
+    if MANIFESTS_FILE not in files:
+      continue
+    path = (Path(root) / MANIFESTS_FILE).relative_to(tracker_dir).as_posix()
+    key = _entry_key(path)
+    if key is not None:
+      result[key] = (path, hash_blob(Path(tracker_dir) / path))
+  return result
+
+
+@tracing.span("scan tracker storage")
+def scan(tracker_dir: Path, storage: Optional[str] = None) -> tuple:
+  # (storage, {(track, version_id): (path, blob id)}) for every entry in
+  # storage. Fails if no entry is found, so that an unexpected layout is
+  # never mistaken for an empty tracker.
+  try:
+    found = _scan_git(tracker_dir)
+  except (GitMetaError, OSError):
+    found = _scan_dir(tracker_dir)
+  if storage is None:
+    storages = sorted({key[0] for key in found})
+    if len(storages) > 1:
+      raise ValueError(f"entries found in multiple directories, use --storage: {storages}")
+    storage = storages[0] if storages else ""
+  storage = storage.strip("/")
+  entries = {key[1:]: value for key, value in found.items() if key[0] == storage}
+  if not entries:
+    raise ValueError(f"no release tracker entries found in {Path(tracker_dir) / storage}")
+  return storage, entries
+
+
+###############################################################################
+# Index
+###############################################################################
+class TrackerIndex:
+  def __init__(self, tracker_dir: Path, index_file: Optional[Path] = None) -> None:
+    self.tracker_dir = Path(tracker_dir)
+    self.index_file = Path(index_file or default_index_file(self.tracker_dir))
+    self.db = sqlite3.connect(self.index_file)
+    version = self.db.execute("PRAGMA user_version").fetchone()[0]
+    if version != FORMAT_VERSION:
+      # Created by another version of this module: rebuild it
+      with self.db:
+        for table in ("entries", "entry_layers", "digests"):
+          self.db.execute(f"DROP TABLE IF EXISTS {table}")
+    self.db.executescript(SCHEMA)
+    self.db.execute(f"PRAGMA user_version = {FORMAT_VERSION}")
+
+  @classmethod
+  def open_existing(cls, tracker_dir: Path) -> Optional["TrackerIndex"]:
+    index_file = default_index_file(tracker_dir)
+    if not index_file.is_file():
+      return None
+    return cls(tracker_dir, index_file)
+
+  def close(self) -> None:
+    self.db.close()
+
+  def __enter__(self) -> "TrackerIndex":
+    return self
+
+  def __exit__(self, *exc_info: object) -> None:
+    self.close()
+
+  def _remove(self, track: str, version_id: str) -> None:
+    key = (track, version_id)
+    self.db.execute("DELETE FROM entry_layers WHERE track = ? AND version_id = ?", key)
+    self.db.execute("DELETE FROM entries WHERE track = ? AND version_id = ?", key)
+
+  def _add(self, track: str, version_id: str, path: str, blob: str) -> None:
+    manifests = DockerManifests.load(self.tracker_dir / path)
+    self.db.execute("INSERT INTO entries VALUES (?, ?, ?, ?)", (track, version_id, path, blob))
+    self.db.executemany(
+      "INSERT OR IGNORE INTO entry_layers VALUES (?, ?, ?, ?)",
+      ((track, version_id, layer.image, layer.digest) for layer in manifests.layers()),
+    )
+
+  @tracing.span("sync tracker index")
+  def sync(self, storage: Optional[str] = None) -> SyncStats:
+    _, current = scan(self.tracker_dir, storage)
+    indexed = {
+      (track, version_id): blob
+      for track, version_id, blob in self.db.execute("SELECT track, version_id, blob FROM entries")
+    }
+    added = updated = removed = 0
+    with self.db:
+      for key in indexed.keys() - current.keys():
+        self._remove(*key)
+        removed += 1
+      for key, (path, blob) in current.items():
+        indexed_blob = indexed.get(key)
+        if indexed_blob == blob:
+          continue
+        if indexed_blob is None:
+          added += 1
+        else:
+          self._remove(*key)
+          updated += 1
+        self._add(*key, path, blob)
+    return SyncStats(added, updated, removed, len(current) - added - updated)
+
+  def entry(self, track: str, version_id: str) -> Optional[Entry]:
+    row = self.db.execute(
+      "SELECT * FROM entries WHERE track = ? AND version_id = ?", (track, version_id)
+    ).fetchone()
+    return Entry(*row) if row else None
+
+  def digests(self, track: str, version_id: str) -> list:
+    return [
+      digest
+      for (digest,) in self.db.execute(
+        "SELECT DISTINCT digest FROM entry_layers"
+        " WHERE track = ? AND version_id = ? ORDER BY digest",
+        (track, version_id),
+      )
+    ]
+
+  def refs(self, digest: str) -> int:
+    row = self.db.execute("SELECT refs FROM digests WHERE digest = ?", (digest,)).fetchone()
+    return row[0] if row else 0
+
+  @tracing.span("check prune")
+  def check_prune(self, track: str, prunable_versions: list, unprunable: list) -> PruneCheck:
+    # Every layer of an entry which isn't pruned (of any track) must be
+    # in the unprunable list
+    self.db.execute(
+      "CREATE TEMP TABLE IF NOT EXISTS pruned (track TEXT, version_id TEXT,"
+      " PRIMARY KEY (track, version_id))"
+    )
+    self.db.execute("CREATE TEMP TABLE IF NOT EXISTS unprunable (digest TEXT PRIMARY KEY)")
+    self.db.execute("DELETE FROM pruned")
+    self.db.execute("DELETE FROM unprunable")
+    self.db.executemany(
+      "INSERT OR IGNORE INTO pruned VALUES (?, ?)", ((track, v) for v in prunable_versions)
+    )
+    self.db.executemany("INSERT OR IGNORE INTO unprunable VALUES (?)", ((d,) for d in unprunable))
+    kept = self.db.execute(
+      "SELECT COUNT(*) FROM entries e"
+      " WHERE NOT EXISTS (SELECT 1 FROM pruned p"
+      "   WHERE p.track = e.track AND p.version_id = e.version_id)"
+    ).fetchone()[0]
+    missing = [
+      digest
+      for (digest,) in self.db.execute(
+        "SELECT DISTINCT l.digest FROM entry_layers l"
+        " WHERE NOT EXISTS (SELECT 1 FROM pruned p"
+        "   WHERE p.track = l.track AND p.version_id = l.version_id)"
+        " AND l.digest NOT IN (SELECT digest FROM unprunable)"
+        " ORDER BY l.digest"
+      )
+    ]
+    return PruneCheck(kept, missing)
+
+
+def find_entry(tracker_dir: Path, track: str, version_id: str, storage: str) -> Optional[Entry]:
+  # Look up an entry of `storage` in an existing index, without updating it
+  index = TrackerIndex.open_existing(tracker_dir)
+  if index is None:
+    return None
+  with index:
+    entry = index.entry(track, version_id)
+  if entry is None or not entry.path.startswith(f"{storage.strip('/')}/"):
+    return None
+  return entry
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def _read_list(path: Path) -> list:
+  return [line.strip() for line in path.read_text().splitlines() if line.strip()]
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Index the entries of a release tracker")
+  parser.add_argument("-C", "--tracker-dir", type=Path, default=Path.cwd())
+  parser.add_argument(
+    "-s",
+    "--storage",
+    default=None,
+    help="relative to --tracker-dir (default: the only directory with entries)",
+  )
+  parser.add_argument(
+    "-i", "--index", type=Path, default=None, help="index file (default: in the git directory)"
+  )
+  subparsers = parser.add_subparsers(dest="action", required=True)
+
+  subparsers.add_parser("sync", help="update the index")
+
+  check = subparsers.add_parser(
+    "check-prune", help="verify that the layers of the kept entries are unprunable"
+  )
+  check.add_argument("-t", "--track", required=True)
+  check.add_argument(
+    "-v", "--prunable-versions", type=Path, required=True, help="file with one version id per line"
+  )
+  check.add_argument(
+    "-u", "--unprunable-layers", type=Path, required=True, help="file with one digest per line"
+  )
+
+  lookup = subparsers.add_parser("lookup", help="print an entry and its digests")
+  lookup.add_argument("-t", "--track", required=True)
+  lookup.add_argument("-v", "--version-id", required=True)
+
+  args = parser.parse_args()
+
+  with TrackerIndex(args.tracker_dir, args.index) as index:
+    try:
+      stats = index.sync(args.storage)
+    except ValueError as e:
+      print(f"ERROR {e}", file=sys.stderr)
+      sys.exit(1)
+    print(
+      f"{index.index_file}: {stats.added} added, {stats.updated} updated,"
+      f" {stats.removed} removed, {stats.unchanged} unchanged",
+      file=sys.stderr,
+    )
+    if args.action == "check-prune":
+      unprunable = _read_list(args.unprunable_layers)
+      if not unprunable:
+        print("ERROR empty list of unprunable layers", file=sys.stderr)
+        sys.exit(1)
+      result = index.check_prune(args.track, _read_list(args.prunable_versions), unprunable)
+      print(
+        f"{result.kept} entries kept, {len(unprunable)} unprunable layers,"
+        f" {len(result.missing)} missing",
+        file=sys.stderr,
+      )
+      if result.missing:
+        print("ERROR layers of kept entries are not unprunable:", file=sys.stderr)
+        for digest in result.missing:
+          print(f"  {digest}", file=sys.stderr)
+        sys.exit(1)
+    elif args.action == "lookup":
+      entry = index.entry(args.track, args.version_id)
+      if entry is None:
+        print(f"ERROR entry not found: {args.track}/{args.version_id}", file=sys.stderr)
+        sys.exit(1)
+      print(entry.path)
+      for digest in index.digests(args.track, args.version_id):
+        print(f"{digest} {index.refs(digest)}")
+
+
+if __name__ == "__main__":
+  main()
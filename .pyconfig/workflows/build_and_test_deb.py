@@ -14,23 +14,59 @@
 # limitations under the License.
 ###############################################################################
 import json
+import sys
 from typing import NamedTuple
 from pathlib import Path
 
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
+import build_cache
+import image_ref
+import tracing
+from input_fingerprint import fingerprint
+
+
+@tracing.span("build_and_test_deb.configure")
 def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: NamedTuple) -> dict:
   runner = json.dumps(getattr(cfg.ci.runners, f"linux_{inputs.build_architecture}"))
 
-  deb_builder_tag = inputs.base_image.replace(":", "-").replace("/", "-")
+  deb_builder_tag = image_ref.label(inputs.base_image)
   repo = github.repository.split("/")[-1]
   test_id = f"deb-{deb_builder_tag}-{inputs.build_architecture}__{cfg.build.version}"
   test_artifact = f"{repo}-debtest-{test_id}"
+  deb_builder = image_ref.tagged(cfg.debian.builder.repo, inputs.base_image)
   deb_artifact = f"{repo}-deb-{deb_builder_tag}-{inputs.build_architecture}__{cfg.build.version}"
 
+  inputs_fingerprint = fingerprint(
+    clone_dir,
+    "build_and_test_deb",
+    cfg.ci.fingerprint.exclude,
+    base_image=inputs.base_image,
+    architecture=inputs.build_architecture,
+    builder=deb_builder,
+  )
+  # The build job looks up a previous run which passed with the same inputs
+  # on its own host, where results are recorded (only if the caller doesn't
+  # need the job's artifacts, e.g. a release)
+  skip_unchanged = cfg.ci.fingerprint.enabled and inputs.skip_unchanged
+
+  tester_cache = build_cache.cache_config(
+    cfg.ci.build_cache,
+    key=build_cache.scope_name("debtester", inputs.base_image, inputs.build_architecture),
+    scope=build_cache.ref_scope(github),
+  )
+
   return {
+    "CACHE_FROM": "\n".join(tester_cache.cache_from),
+    "CACHE_LOCAL_DIR": tester_cache.local_dir,
+    "CACHE_TO": tester_cache.cache_to,
     "DEB_ARTIFACT": deb_artifact,
-    "DEB_BUILDER": f"{cfg.debian.builder.repo}:{deb_builder_tag}",
+    "DEB_BUILDER": deb_builder,
     "DEB_RUNNER": runner,
+    "FINGERPRINT": inputs_fingerprint,
+    "SKIP_UNCHANGED": skip_unchanged,
     "TEST_ARTIFACT": test_artifact,
     "TEST_ID": test_id,
   }
@@ -14,24 +14,58 @@
 # limitations under the License.
 ###############################################################################
 import json
+import sys
 from typing import NamedTuple
 from pathlib import Path
 
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
+import build_cache
+import image_ref
+import tracing
+from input_fingerprint import fingerprint
+
+
+@tracing.span("build_and_test_docker.configure")
 def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: NamedTuple) -> dict:
   runner = json.dumps(getattr(cfg.ci.runners, inputs.build_platform.replace("/", "_")))
 
   repo = github.repository.split("/")[-1]
   build_platform_label = inputs.build_platform.replace("/", "-")
-  base_image_tag = inputs.base_image.replace(":", "-")
-  tester_image = f"{cfg.ci.images.tester.repo}:{base_image_tag}"
+  tester_image = image_ref.tagged(cfg.ci.images.tester.repo, inputs.base_image)
 
   test_id = f"ci-{build_platform_label}__{cfg.build.version}"
   test_artifact = f"{repo}-test-{test_id}"
 
+  inputs_fingerprint = fingerprint(
+    clone_dir,
+    "build_and_test_docker",
+    cfg.ci.fingerprint.exclude,
+    base_image=inputs.base_image,
+    platform=inputs.build_platform,
+    builder=tester_image,
+  )
+  # The build job looks up a previous run which passed with the same inputs
+  # on its own host, where results are recorded (only if the caller doesn't
+  # need the job's artifacts, e.g. a release)
+  skip_unchanged = cfg.ci.fingerprint.enabled and inputs.skip_unchanged
+
+  tester_cache = build_cache.cache_config(
+    cfg.ci.build_cache,
+    key=build_cache.scope_name("tester", inputs.base_image, inputs.build_platform),
+    scope=build_cache.ref_scope(github),
+  )
+
   return {
+    "CACHE_FROM": "\n".join(tester_cache.cache_from),
+    "CACHE_LOCAL_DIR": tester_cache.local_dir,
+    "CACHE_TO": tester_cache.cache_to,
     "CI_RUNNER": runner,
+    "FINGERPRINT": inputs_fingerprint,
     "LOCAL_TESTER_IMAGE_BASE_IMAGE": tester_image,
+    "SKIP_UNCHANGED": skip_unchanged,
     "TEST_ARTIFACT": test_artifact,
     "TEST_ID": test_id,
   }
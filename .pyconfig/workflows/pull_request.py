@@ -14,11 +14,20 @@
 # limitations under the License.
 ###############################################################################
 import json
-import subprocess
+import sys
 from typing import NamedTuple
 from pathlib import Path
 
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
+import tracing
+from github_api import GitHubClient, review_decision
+from matrix_planner import MatrixPlanner
+
+
+@tracing.span("pull_request.configure")
 def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: NamedTuple) -> dict:
   is_draft = bool(github.event.pull_request.draft)
   pr_no = github.event.pull_request.number
@@ -63,26 +72,9 @@ def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: Name
       # https://docs.github.com/en/webhooks/webhook-events-and-payloads#pull_request)
       # So we use the GitHub API to query the state,
       # see: https://stackoverflow.com/a/77647838
-      subprocess.run(["gh", "repo", "set-default", github.repository], cwd=clone_dir, check=True)
-      review_state = (
-        subprocess.run(
-          [
-            "gh",
-            "pr",
-            "view",
-            str(pr_no),
-            "--json",
-            "reviewDecision",
-            "--jq",
-            ".reviewDecision",
-          ],
-          cwd=clone_dir,
-          stdout=subprocess.PIPE,
-        )
-        .stdout.decode()
-        .strip()
-        .lower()
-      )
+      with tracing.span("review decision", cat="github", pr=pr_no):
+        with GitHubClient() as client:
+          review_state = review_decision(client, github.repository, pr_no)
       print(f"PR #{pr_no} detected review state: '{review_state}'")
       result_full = review_state == "approved"
     else:
@@ -93,12 +85,35 @@ def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: Name
   # Debian testing requires a debian package, and for now we tie it to the full validation
   result_deb = result_full and (clone_dir / "debian" / "control").is_file()
 
+  # Schedule every (base image, platform) only once across all validations:
+  # the full validation reuses the units already built by the basic one.
+  validation = cfg.pull_request.validation
+  planner = MatrixPlanner(revision=github.sha)
+  if result_basic:
+    planner.add(
+      "basic-validation", "docker", validation.basic.base_images, validation.basic.build_platforms
+    )
+  if result_full:
+    planner.add(
+      "full-validation", "docker", validation.full.base_images, validation.full.build_platforms
+    )
+  if result_deb:
+    planner.add(
+      "deb-validation", "deb", validation.deb.base_images, validation.deb.build_architectures
+    )
+  basic_matrix = planner.matrix("basic-validation")
+  full_matrix = planner.matrix("full-validation")
+  deb_matrix = planner.matrix("deb-validation")
+
   print(f"::group::PR #{pr_no} job configuration")
   print(f"- draft: {is_draft}")
   print(f"- event: {github.event_name}")
   print(f"- action: {github.event.action}")
   print(f"- review: {review_state}")
   print(f"- triggers: basic={result_basic}, full={result_full}, deb={result_deb}")
+  for job, units in planner.plan()["jobs"].items():
+    reused = sum(1 for unit in units if unit["reused"])
+    print(f"- {job}: {len(units)} units ({reused} reused)")
   print("::endgroup::")
 
   return {
@@ -112,7 +127,12 @@ def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: Name
     ),
     "FULL_VALIDATION_BASE_IMAGES": json.dumps(cfg.pull_request.validation.full.base_images),
     "FULL_VALIDATION_BUILD_PLATFORMS": json.dumps(cfg.pull_request.validation.full.build_platforms),
-    "VALIDATE_FULL": result_full,
-    "VALIDATE_DEB": result_deb,
-    "VALIDATE_BASIC": result_basic,
+    "BASIC_VALIDATION_MATRIX": json.dumps(basic_matrix),
+    "FULL_VALIDATION_MATRIX": json.dumps(full_matrix),
+    "DEB_VALIDATION_MATRIX": json.dumps(deb_matrix),
+    "VALIDATION_PLAN": json.dumps(planner.plan()),
+    # A validation is skipped when all of its units are built by another one
+    "VALIDATE_FULL": result_full and bool(full_matrix["include"]),
+    "VALIDATE_DEB": result_deb and bool(deb_matrix["include"]),
+    "VALIDATE_BASIC": result_basic and bool(basic_matrix["include"]),
   }
@@ -13,24 +13,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ###############################################################################
+import io
+import json
+import os
+import sys
+from contextlib import ExitStack
 from pathlib import Path
 from typing import NamedTuple
-import json
-from fnmatch import fnmatch
 
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import image_ref
+import tracing
+from deb_artifacts import ArtifactIndex
+from docker_manifest import DockerManifests
+from markdown_stream import STEP_SUMMARY_MAX_SIZE, MarkdownStream, Sink
 from release_tracker import ReleaseTracker
+from test_report import load_report
+from tracker_index import find_entry
+
+# Manifest tables longer than this are collapsed in a <details> block
+MANIFESTS_COLLAPSE_ROWS = 64
+# Test job tables longer than this are collapsed in a <details> block
+TEST_JOBS_COLLAPSE_ROWS = 16
 
 
 def _image_link(github: NamedTuple, cfg: NamedTuple, image: str) -> str:
-  image_repo = image.split(":")[0]
-  repo_name = image_repo.split("/")[-1]
-  if image.startswith("ghcr.io/"):
-    url = f"{cfg.build.repository.url}/pkgs/container/{repo_name}"
-  elif image.startswith(github.repository):
-    url = f"https://hub.docker.com/r/{image_repo}"
+  ref = image_ref.parse(image)
+  if ref.domain == image_ref.GITHUB:
+    url = f"{cfg.build.repository.url}/pkgs/container/{ref.repo}"
+  elif ref.domain == image_ref.DOCKER_HUB:
+    # Official images are listed under "_"
+    hub_path = ref.path if ref.namespace else f"_/{ref.repo}"
+    url = f"https://hub.docker.com/r/{hub_path}"
   else:
     # unknown registry
-    url = f"https://{image_repo}"
+    url = f"https://{ref.name}"
   return f"[`{image}`]({url})"
 
 
@@ -41,6 +61,7 @@ def _deb_pkg_link(github: NamedTuple, cfg: NamedTuple, pkg: Path) -> str:
   return f"[`{pkg.name}`]({url})"
 
 
+@tracing.span("release_notes.summarize")
 def summarize(clone_dir: Path, github: NamedTuple, inputs: NamedTuple, cfg: NamedTuple) -> str:
   workspace_dir = Path(f"{github.workspace}")
   # Read release-tracker commit id
@@ -52,149 +73,278 @@ def summarize(clone_dir: Path, github: NamedTuple, inputs: NamedTuple, cfg: Name
   reltracker_version_id = ReleaseTracker.version_id(
     reltracker_summary["entry"]["created_at"], reltracker_summary["entry"]["version"]
   )
-  release_docker_manifest_f_rel = Path(
-    f"{reltracker_summary['storage']}/{reltracker_summary['track']}/{reltracker_version_id}/docker-manifests.json"
+  reltracker_path = Path(reltracker_summary["path"])
+  # Use the tracker's index if available, otherwise rebuild the entry's path
+  reltracker_entry = find_entry(
+    workspace_dir / reltracker_path,
+    reltracker_summary["track"],
+    reltracker_version_id,
+    reltracker_summary["storage"],
   )
+  if reltracker_entry is not None:
+    release_docker_manifest_f_rel = reltracker_path / reltracker_entry.path
+  else:
+    release_docker_manifest_f_rel = Path(
+      f"{reltracker_summary['storage']}/{reltracker_summary['track']}/{reltracker_version_id}/docker-manifests.json"
+    )
   release_docker_manifest_f = workspace_dir / release_docker_manifest_f_rel
-  release_docker_manifest = json.loads(release_docker_manifest_f.read_text())
-
-  release_docker_layers = {}
-  for img, img_manifest in release_docker_manifest["images"].items():
-    img_layers = release_docker_layers[img] = release_docker_layers.get(img, {})
-    arch_layers = {
-      layer["digest"]: {
-        "image": img,
-        "platform": layer["platform"],
-        "unknown": False,
-      }
-      for layer in img_manifest["manifests"]
-      if layer["platform"]["os"] != "unknown"
-    }
-    unknown_layers = {
-      layer["digest"]: {"image": img, "platform": base_platform, "unknown": True}
-      for layer in img_manifest["manifests"]
-      if layer["platform"]["os"] == "unknown"
-      for base_platform in [
-        next(
-          base_layer_cfg["platform"]
-          for base_layer, base_layer_cfg in arch_layers.items()
-          if base_layer == layer["annotations"]["vnd.docker.reference.digest"]
-        )
-      ]
-    }
-    img_layers.update(arch_layers)
-    img_layers.update(unknown_layers)
+  with tracing.span("load docker manifests"):
+    release_docker_manifest = DockerManifests.load(release_docker_manifest_f)
 
-  reltracker_path = Path(reltracker_summary["path"])
   reltracker_log_url = f"{cfg.release.tracker.repository.url}/blob/{reltracker_commit}/{release_docker_manifest_f_rel.relative_to(reltracker_path)}"
 
-  generated_images = set(release_docker_manifest["images"].keys())
+  generated_images = set(release_docker_manifest.images.keys())
   # generated_images = reduce(lambda r, v: r | set(v), release_docker_manifest["layers"].values(), set())
   missing_images = set(cfg.release.final_images) - generated_images
 
   # Detect generated Debian packages
-  deb_packages = list(Path(cfg.build.artifacts_dir).glob("*.deb"))
-  expected_deb_packages_globs = [
-    f"{cfg.build.repository.name}_*_{arch}.deb" for arch in cfg.debian.builder.architectures
-  ]
-  missing_deb_packages = [
-    matched
-    for glob in expected_deb_packages_globs
-    for matched in [next((pkg for pkg in deb_packages if fnmatch(pkg, glob)), None)]
-    if matched
-  ]
+  with tracing.span("scan debian packages"):
+    deb_index = ArtifactIndex.scan(Path(cfg.build.artifacts_dir))
+  deb_packages = deb_index.packages
+  with tracing.span("compute checksums", packages=len(deb_packages)):
+    deb_checksums = deb_index.compute_checksums()
+  missing_deb_packages = (
+    [
+      f"{cfg.build.repository.name}_*_{arch}.deb"
+      for arch in deb_index.missing(cfg.build.repository.name, cfg.debian.builder.architectures)
+    ]
+    if cfg.debian.enabled
+    else []
+  )
 
   missing_section = bool(missing_images or missing_deb_packages)
 
-  result = [
+  # Merged results of the release's test jobs (see test_report.py)
+  with tracing.span("load test report"):
+    test_report = load_report(Path(cfg.build.artifacts_dir) / "test-report.json")
+
+  # Render the notes as the release body (returned to the caller), and
+  # to the job's step summary (when available) in a single pass.
+  release_body = io.StringIO()
+  sinks = [Sink(release_body, budget=cfg.release.notes.max_size, name="body")]
+  with ExitStack() as stack:
+    step_summary_f = os.environ.get("GITHUB_STEP_SUMMARY")
+    if step_summary_f:
+      step_summary = stack.enter_context(open(step_summary_f, "a"))
+      sinks.append(Sink(step_summary, budget=STEP_SUMMARY_MAX_SIZE, name="summary"))
+    out = MarkdownStream(sinks)
+    with tracing.span("render"):
+      _render(
+        out,
+        github,
+        cfg,
+        {
+          "reltracker_version_id": reltracker_version_id,
+          "reltracker_log_url": reltracker_log_url,
+          "generated_images": generated_images,
+          "missing_images": missing_images,
+          "missing_deb_packages": missing_deb_packages,
+          "missing_section": missing_section,
+          "deb_packages": deb_packages,
+          "deb_checksums": deb_checksums,
+          "release_docker_manifest": release_docker_manifest,
+          "test_report": test_report,
+        },
+      )
+    if cfg.release.gh.release.create:
+      out.write(
+        "",
+        "## GitHub Release",
+        "",
+        f"[{cfg.build.version}]({cfg.release.gh.release.url})",
+        only=["summary"],
+      )
+    out.close()
+
+  return release_body.getvalue()
+
+
+def _render(out: MarkdownStream, github: NamedTuple, cfg: NamedTuple, notes: dict) -> None:
+  out.write(
     f"# {cfg.build.repository.name} - {cfg.build.profile} release - {cfg.build.version}",
     "",
     "## Configuration",
     "",
-    "| Property | Value |",
-    "|----------|-------|",
-    "| **CI Settings** "
-    + f"| [settings.yml]({cfg.build.repository.url}/blob/{github.sha}/{cfg.build.settings_file})"
-    + " |",
-    "| **Source Commit** | "
-    + f"[`{github.sha}`]({cfg.build.repository.url}/tree/{github.sha})"
-    + " |",
-    # "| **GitHub Release** | "
-    # + (
-    #   f"[{github.ref_name}]({cfg.build.repository.url}/releases/tag/{github.ref_name})"
-    #   if github.ref_type == "branch"
-    #   else "N/A"
-    # )
-    # + " |",
-    "| **Release Log** | " f"[{reltracker_version_id}]({reltracker_log_url})" " |",
-    "",
-    "## Artifacts",
-    "",
-    "| Type | Artifacts |",
-    "|------|-----------|",
-    f"| **Pre-release Image** | {_image_link(github, cfg, cfg.release.prerelease_image)} |",
-    "| **Release Images** | "
-    + "".join(
+  )
+  out.table(
+    ["Property", "Value"],
+    [
       [
-        "<ul>",
-        *(f"<li>{_image_link(github, cfg, img)}</li>" for img in generated_images),
-        "</ul> |",
-      ]
-    )
-    + " |",
-    "| **Debian Packages** | "
-    + (
-      "".join(
-        [
-          "<ul>",
-          *(f"<li>{_deb_pkg_link(github, cfg, pkg)}</li>" for pkg in deb_packages),
-          "</ul>",
-        ]
-      )
-      if deb_packages
-      else "No packages were generated."
-    )
-    + " |",
-    "",
-    *(
+        "**CI Settings**",
+        f"[settings.yml]({cfg.build.repository.url}/blob/{github.sha}/{cfg.build.settings_file})",
+      ],
       [
-        "## Missing Artifacts",
-        "",
-        "| Type | Artifacts |",
-        "|------|-----------|",
-        "| **Release Images** | "
-        + "".join(
+        "**Source Commit**",
+        f"[`{github.sha}`]({cfg.build.repository.url}/tree/{github.sha})",
+      ],
+      # [
+      #   "**GitHub Release**",
+      #   f"[{github.ref_name}]({cfg.build.repository.url}/releases/tag/{github.ref_name})"
+      #   if github.ref_type == "branch"
+      #   else "N/A",
+      # ],
+      [
+        "**Release Log**",
+        f"[{notes['reltracker_version_id']}]({notes['reltracker_log_url']})",
+      ],
+    ],
+  )
+  out.write("", "## Artifacts", "")
+  deb_packages = notes["deb_packages"]
+  out.table(
+    ["Type", "Artifacts"],
+    [
+      ["**Pre-release Image**", _image_link(github, cfg, cfg.release.prerelease_image)],
+      [
+        "**Release Images**",
+        "".join(
           [
             "<ul>",
-            *(f"<li>{_image_link(github, cfg, img)}</li>" for img in missing_images),
+            *(f"<li>{_image_link(github, cfg, img)}</li>" for img in notes["generated_images"]),
             "</ul> |",
           ]
-        )
-        + " |",
-        "| **Debian Packages** | "
-        + "".join(
-          [
-            "<ul>",
-            *(f"<li>`{pkg}`</li>" for pkg in missing_deb_packages),
-            "</ul>",
-          ]
-        )
-        + " |",
-        "",
+        ),
+      ],
+      [
+        "**Debian Packages**",
+        (
+          "".join(
+            [
+              "<ul>",
+              *(f"<li>{_deb_pkg_link(github, cfg, pkg.path)}</li>" for pkg in deb_packages),
+              "</ul>",
+            ]
+          )
+          if deb_packages
+          else "No packages were generated."
+        ),
+      ],
+    ],
+  )
+  out.write("")
+
+  if notes["missing_section"]:
+    out.write("## Missing Artifacts", "")
+    out.table(
+      ["Type", "Artifacts"],
+      [
+        [
+          "**Release Images**",
+          "".join(
+            [
+              "<ul>",
+              *(f"<li>{_image_link(github, cfg, img)}</li>" for img in notes["missing_images"]),
+              "</ul> |",
+            ]
+          ),
+        ],
+        [
+          "**Debian Packages**",
+          "".join(
+            [
+              "<ul>",
+              *(f"<li>`{pkg}`</li>" for pkg in notes["missing_deb_packages"]),
+              "</ul>",
+            ]
+          ),
+        ],
+      ],
+    )
+    out.write("")
+
+  if deb_packages:
+    deb_checksums = notes["deb_checksums"]
+    out.write("## Debian Package Checksums", "")
+    out.table(
+      ["**Package**", "**Size**", "**SHA256**"],
+      (
+        [f"`{pkg.path.name}`", str(pkg.size), f"`{deb_checksums[pkg.path.name]}`"]
+        for pkg in deb_packages
+      ),
+    )
+    out.write("")
+
+  if notes["test_report"] is not None and notes["test_report"]["jobs"]:
+    _render_tests(out, notes["test_report"])
+
+  release_docker_manifest = notes["release_docker_manifest"]
+  layer_count = release_docker_manifest.layer_count()
+  out.write("## Docker Image Manifests ", "")
+  out.table(
+    ["**Image**", "**Manifest**", "**Platform**"],
+    (
+      [
+        f"`{layer.image}`",
+        f"`{layer.digest}`",
+        f"`{layer.os}`/`{layer.architecture}`{' (unknown)' if layer.unknown else ''}",
       ]
-      if missing_section
-      else []
-    ),
-    "## Docker Image Manifests ",
-    "",
-    "| **Image** | **Manifest** | **Platform** |",
-    "|-----------|--------------|--------------|",
-    *(
-      f"| `{layer['image']}` | `{digest}` | `{layer['platform']['os']}`/`{layer['platform']['architecture']}`{' (unknown)' if layer['unknown'] else ''} |"
-      for layers in release_docker_layers.values()
-      for digest, layer in layers.items()
+      for layer in release_docker_manifest.layers()
     ),
-    "",
-  ]
+    row_count=layer_count,
+    collapse_rows=MANIFESTS_COLLAPSE_ROWS,
+    summary=f"{layer_count} manifests for {len(release_docker_manifest.images)} images",
+  )
+
+
+def _seconds(value: float) -> str:
+  return f"{value:.2f}s"
 
-  return "\n".join(result)
+
+def _render_tests(out: MarkdownStream, report: dict) -> None:
+  jobs = report["jobs"]
+  out.write("## Tests", "")
+  out.table(
+    ["**Job**", "**Base Image**", "**Platform**", "**Tests**", "**Failed**", "**Duration**"],
+    (
+      [
+        f"`{job['test_id']}`",
+        f"`{job['base_image']}`" if job["base_image"] else "",
+        f"`{job['platform']}`" if job["platform"] else "",
+        str(job["tests"]),
+        str(job["failures"] + job["errors"]),
+        _seconds(job["duration"]),
+      ]
+      for job in jobs
+    ),
+    row_count=len(jobs),
+    collapse_rows=TEST_JOBS_COLLAPSE_ROWS,
+    summary=f"{len(jobs)} test jobs",
+  )
+  out.write("")
+  if report["slowest"]:
+    out.write("### Slowest Tests", "")
+    out.table(
+      ["**Test**", "**Job**", "**Duration**", "**Usual**"],
+      (
+        [
+          f"`{test['suite']}.{test['name']}`",
+          f"`{test['job']}`",
+          _seconds(test["duration"]),
+          _seconds(test["baseline"]) if test["baseline"] is not None else "",
+        ]
+        for test in report["slowest"]
+      ),
+    )
+    out.write("")
+  if report["regressions"]:
+    out.write(
+      "### Biggest Regressions",
+      "",
+      f"Tests slower than {report['tolerance']}x their usual duration"
+      f" (the median of the last {report['history_runs']} runs).",
+      "",
+    )
+    out.table(
+      ["**Test**", "**Job**", "**Duration**", "**Usual**", "**Change**"],
+      (
+        [
+          f"`{test['suite']}.{test['name']}`",
+          f"`{test['job']}`",
+          _seconds(test["duration"]),
+          _seconds(test["baseline"]),
+          f"+{_seconds(test['duration'] - test['baseline'])}",
+        ]
+        for test in report["regressions"]
+      ),
+    )
+    out.write("")
@@ -13,10 +13,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 ###############################################################################
+import sys
 from typing import NamedTuple
 from pathlib import Path
 
+# Hooks are loaded from their files by the pyconfig action, which doesn't
+# guarantee that .pyconfig/ is in sys.path: make its modules importable.
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
 
+import tracing
+
+
+@tracing.span("release_test.configure")
 def configure(clone_dir: Path, cfg: NamedTuple, github: NamedTuple, inputs: NamedTuple) -> dict:
   # A prefix for files generated by the test
   test_id = f"release-{cfg.build.profile}__{cfg.build.version}"
@@ -0,0 +1,634 @@
+#!/usr/bin/env python3
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Publish Debian packages to an apt repository tree, e.g.:
+#
+#   python3 scripts/debian/apt_publish.py -r build/apt -s stable debian-dist/
+#
+# generates:
+#
+#   pool/<component>/<prefix>/<source>/<package>_<version>_<arch>.deb
+#   dists/<suite>/<component>/binary-<arch>/Packages{,.gz}
+#   dists/<suite>/<component>/binary-<arch>/by-hash/SHA256/<sha256>
+#   dists/<suite>/Release (and InRelease/Release.gpg, with --sign)
+#
+# which can be served by any HTTP server, and used with:
+#
+#   deb [trusted=yes] https://<host>/<path> <suite> <component>
+#
+# The repository is updated incrementally: the entry of every published
+# package (its control fields, and the size and hashes of its file) is
+# recorded in a state file (.apt-publish/<suite>-<component>.json), so that
+# only the new (or changed) packages are read, and only the indexes of the
+# architectures which changed are rewritten. Indexes which didn't change
+# keep their timestamp, so that clients can skip them with conditional
+# requests. Every index is also published under its hash (by-hash), before
+# the Release file which refers to it, so that clients never download
+# mismatching files while the repository is being updated, and the last
+# --keep-by-hash versions are preserved for the clients which are still
+# using an older Release file.
+#
+# With --keep-versions, only the newest versions (in Debian's version order)
+# of every package and architecture are kept in a suite, and the files of the
+# older ones are deleted from the pool (unless another suite still lists
+# them), so that the repository doesn't grow without limit (e.g. with nightly
+# releases).
+#
+# The control file of a package is read directly from the .deb (an `ar`
+# archive), without dpkg's tools.
+###############################################################################
+import argparse
+import functools
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import time
+from pathlib import Path
+from typing import Iterable, NamedTuple, Optional
+
+FORMAT_VERSION = 1
+DEFAULT_SUITE = "stable"
+DEFAULT_COMPONENT = "main"
+DEFAULT_KEEP_BY_HASH = 3
+# Keep every version of a package
+DEFAULT_KEEP_VERSIONS = 0
+STATE_DIR = ".apt-publish"
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+HASH_CHUNK = 1 << 20
+
+# Fields of a Packages entry which are generated from the file
+FILE_FIELDS = ("Filename", "Size", "MD5sum", "SHA256")
+
+
+class DebFile(NamedTuple):
+  path: Path
+  size: int
+  md5: str
+  sha256: str
+  control: dict
+
+  @property
+  def package(self) -> str:
+    return self.control["Package"]
+
+  @property
+  def version(self) -> str:
+    return self.control["Version"]
+
+  @property
+  def architecture(self) -> str:
+    return self.control["Architecture"]
+
+  @property
+  def source(self) -> str:
+    # The Source field may include a version, e.g. `src (1.0-1)`
+    return self.control.get("Source", self.package).split(" ", 1)[0]
+
+
+###############################################################################
+# Package files
+###############################################################################
+def ar_members(data: io.BufferedReader) -> Iterable[tuple]:
+  # (name, content) of the members of an `ar` archive
+  if data.read(len(AR_MAGIC)) != AR_MAGIC:
+    raise ValueError("not an ar archive")
+  while True:
+    header = data.read(AR_HEADER_SIZE)
+    if not header:
+      return
+    if len(header) != AR_HEADER_SIZE or header[58:60] != b"`\n":
+      raise ValueError("invalid ar member header")
+    # GNU ar terminates names with "/"
+    name = header[0:16].decode().rstrip().rstrip("/")
+    size = int(header[48:58].decode().strip())
+    content = data.read(size)
+    if len(content) != size:
+      raise ValueError(f"truncated ar member: {name}")
+    # Members are aligned to 2 bytes
+    if size % 2:
+      data.read(1)
+    yield name, content
+
+
+def decompress_zstd(content: bytes) -> bytes:
+  return subprocess.run(["zstd", "-dc"], input=content, check=True, stdout=subprocess.PIPE).stdout
+
+
+def read_control(path: Path) -> str:
+  # The control file of a .deb
+  with path.open("rb") as data:
+    for name, content in ar_members(data):
+      if not name.startswith("control.tar"):
+        continue
+      if name.endswith(".zst"):
+        content = decompress_zstd(content)
+      with tarfile.open(fileobj=io.BytesIO(content), mode="r:*") as archive:
+        for member in archive:
+          if member.name in ("./control", "control") and member.isfile():
+            return archive.extractfile(member).read().decode()
+      raise ValueError(f"no control file in {path}")
+  raise ValueError(f"no control archive in {path}")
+
+
+def parse_control(text: str) -> dict:
+  # Fields of a control paragraph, preserving their order and continuation
+  # lines
+  fields = {}
+  name = None
+  for line in text.splitlines():
+    if not line.strip():
+      if fields:
+        break
+      continue
+    if line[0] in " \t" and name is not None:
+      fields[name] += f"\n{line}"
+      continue
+    name, sep, value = line.partition(":")
+    if not sep:
+      raise ValueError(f"invalid control field: {line}")
+    fields[name] = value.strip()
+  for required in ("Package", "Version", "Architecture"):
+    if required not in fields:
+      raise ValueError(f"missing control field: {required}")
+  return fields
+
+
+def hash_file(path: Path) -> tuple:
+  md5 = hashlib.md5()
+  sha256 = hashlib.sha256()
+  size = 0
+  with path.open("rb") as data:
+    for chunk in iter(lambda: data.read(HASH_CHUNK), b""):
+      md5.update(chunk)
+      sha256.update(chunk)
+      size += len(chunk)
+  return size, md5.hexdigest(), sha256.hexdigest()
+
+
+def load_deb(path: Path) -> DebFile:
+  try:
+    control = parse_control(read_control(path))
+  except (ValueError, tarfile.TarError) as e:
+    raise ValueError(f"{path}: {e}") from e
+  size, md5, sha256 = hash_file(path)
+  return DebFile(path, size, md5, sha256, control)
+
+
+def pool_path(deb: DebFile, component: str) -> str:
+  source = deb.source
+  prefix = source[:4] if source.startswith("lib") else source[0]
+  # The epoch is not part of the file name
+  version = deb.version.split(":", 1)[-1]
+  return f"pool/{component}/{prefix}/{source}/{deb.package}_{version}_{deb.architecture}.deb"
+
+
+def _order(c: str) -> int:
+  # Sort order of a non-digit character of a version ("" is the end)
+  if c == "~":
+    return -1
+  if not c or c.isdigit():
+    return 0
+  if c.isalpha():
+    return ord(c)
+  return ord(c) + 256
+
+
+def _compare_part(a: str, b: str) -> int:
+  # Compare the upstream versions (or revisions) of two versions, like dpkg
+  i = j = 0
+  while i < len(a) or j < len(b):
+    while (i < len(a) and not a[i].isdigit()) or (j < len(b) and not b[j].isdigit()):
+      diff = _order(a[i : i + 1]) - _order(b[j : j + 1])
+      if diff:
+        return diff
+      i += 1
+      j += 1
+    start_a, start_b = i, j
+    while i < len(a) and a[i].isdigit():
+      i += 1
+    while j < len(b) and b[j].isdigit():
+      j += 1
+    diff = int(a[start_a:i] or 0) - int(b[start_b:j] or 0)
+    if diff:
+      return diff
+  return 0
+
+
+def compare_versions(a: str, b: str) -> int:
+  # <0, 0, >0 if version `a` is older than, equal to, or newer than `b`
+  def split(version: str) -> tuple:
+    epoch, sep, rest = version.partition(":")
+    if not sep:
+      epoch, rest = "0", version
+    upstream, sep, revision = rest.rpartition("-")
+    if not sep:
+      upstream, revision = rest, ""
+    return int(epoch or 0), upstream, revision
+
+  epoch_a, upstream_a, revision_a = split(a)
+  epoch_b, upstream_b, revision_b = split(b)
+  if epoch_a != epoch_b:
+    return epoch_a - epoch_b
+  return _compare_part(upstream_a, upstream_b) or _compare_part(revision_a, revision_b)
+
+
+def format_paragraph(fields: dict) -> str:
+  return "".join(f"{name}: {value}\n" for name, value in fields.items())
+
+
+###############################################################################
+# Repository state
+###############################################################################
+class State:
+  def __init__(self, path: Path) -> None:
+    self.path = path
+    # Packages entries (fields), by pool path
+    self.packages = {}
+    # Size and hashes of the index files, by path (relative to the suite)
+    self.indexes = {}
+    # Hashes published under by-hash, by directory (newest first)
+    self.by_hash = {}
+    if path.is_file():
+      data = json.loads(path.read_text())
+      if data.get("version") == FORMAT_VERSION:
+        self.packages = data["packages"]
+        self.indexes = data["indexes"]
+        self.by_hash = data["by_hash"]
+
+  def save(self) -> None:
+    self.path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+    tmp.write_text(
+      json.dumps(
+        {
+          "version": FORMAT_VERSION,
+          "packages": self.packages,
+          "indexes": self.indexes,
+          "by_hash": self.by_hash,
+        },
+        indent=1,
+        sort_keys=True,
+      )
+    )
+    tmp.replace(self.path)
+
+  def architectures(self) -> set:
+    return {entry["Architecture"] for entry in self.packages.values()}
+
+
+def write_atomic(path: Path, content: bytes) -> None:
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+  tmp.write_bytes(content)
+  tmp.replace(path)
+
+
+def copy_atomic(src: Path, dest: Path) -> None:
+  # Renaming a hard link over another link to the same file does nothing
+  if dest.is_file() and os.path.samefile(src, dest):
+    return
+  dest.parent.mkdir(parents=True, exist_ok=True)
+  tmp = dest.with_name(f"{dest.name}.{os.getpid()}.tmp")
+  tmp.unlink(missing_ok=True)
+  try:
+    os.link(src, tmp)
+  except OSError:
+    shutil.copy2(src, tmp)
+  tmp.replace(dest)
+
+
+###############################################################################
+# Publishing
+###############################################################################
+class Publisher:
+  def __init__(
+    self,
+    repo_dir: Path,
+    suite: str,
+    component: str,
+    architectures: Iterable[str] = (),
+    origin: Optional[str] = None,
+    label: Optional[str] = None,
+    keep_by_hash: int = DEFAULT_KEEP_BY_HASH,
+  ) -> None:
+    self.repo_dir = repo_dir
+    self.suite = suite
+    self.component = component
+    self.origin = origin
+    self.label = label
+    self.keep_by_hash = max(1, keep_by_hash)
+    self.suite_dir = repo_dir / "dists" / suite
+    self.state = State(repo_dir / STATE_DIR / f"{suite}-{component}.json")
+    self.extra_architectures = set(architectures)
+    # Architectures whose indexes must be rewritten
+    self.changed = set()
+
+  def architectures(self) -> list:
+    archs = (self.state.architectures() | self.extra_architectures) - {"all"}
+    return sorted(archs)
+
+  def mark_changed(self, architecture: str) -> None:
+    if architecture == "all":
+      # Listed in the index of every architecture
+      self.changed.update(self.architectures())
+    else:
+      self.changed.add(architecture)
+
+  def add(self, deb_path: Path) -> str:
+    # Add a package to the pool and to the state: "added", "replaced", or
+    # "unchanged" (if the same file was already published)
+    deb = load_deb(deb_path)
+    filename = pool_path(deb, self.component)
+    entry = self.state.packages.get(filename)
+    if entry is not None and entry["SHA256"] == deb.sha256:
+      if not (self.repo_dir / filename).is_file():
+        copy_atomic(deb.path, self.repo_dir / filename)
+      return "unchanged"
+    copy_atomic(deb.path, self.repo_dir / filename)
+    fields = {k: v for k, v in deb.control.items() if k not in FILE_FIELDS}
+    fields.update(
+      {"Filename": filename, "Size": str(deb.size), "MD5sum": deb.md5, "SHA256": deb.sha256}
+    )
+    self.state.packages[filename] = fields
+    self.mark_changed(deb.architecture)
+    if entry is not None:
+      print(
+        f"WARNING {filename} replaced with a different file (same version)",
+        file=sys.stderr,
+      )
+      return "replaced"
+    return "added"
+
+  def verify(self) -> list:
+    # Drop the entries of packages which were removed from the pool
+    removed = []
+    for filename, entry in list(self.state.packages.items()):
+      pool_file = self.repo_dir / filename
+      if not pool_file.is_file() or pool_file.stat().st_size != int(entry["Size"]):
+        del self.state.packages[filename]
+        self.mark_changed(entry["Architecture"])
+        removed.append(filename)
+    return removed
+
+  def shared_files(self) -> set:
+    # Pool files referenced by the other suites (and components) of the
+    # repository, which share the pool
+    shared = set()
+    for path in sorted((self.repo_dir / STATE_DIR).glob("*.json")):
+      if path != self.state.path:
+        shared.update(State(path).packages)
+    return shared
+
+  def remove(self, filename: str, shared: set = frozenset()) -> None:
+    # Remove a package from the state, and its file from the pool (with its
+    # empty directories) unless another suite uses it
+    entry = self.state.packages.pop(filename)
+    self.mark_changed(entry["Architecture"])
+    if filename in shared:
+      return
+    pool_file = self.repo_dir / filename
+    pool_file.unlink(missing_ok=True)
+    pool_dir = self.repo_dir / "pool"
+    for parent in pool_file.parents:
+      if parent == pool_dir or pool_dir not in parent.parents:
+        break
+      try:
+        parent.rmdir()
+      except OSError:
+        break
+
+  def prune(self, keep_versions: int) -> list:
+    # Remove all but the newest `keep_versions` versions of every package
+    # and architecture (0 keeps every version)
+    if keep_versions <= 0:
+      return []
+    versions = {}
+    for filename, entry in self.state.packages.items():
+      key = (entry["Package"], entry["Architecture"])
+      versions.setdefault(key, []).append((entry["Version"], filename))
+    newest_first = functools.cmp_to_key(lambda a, b: compare_versions(b[0], a[0]))
+    shared = self.shared_files()
+    removed = []
+    for entries in versions.values():
+      for _, filename in sorted(entries, key=newest_first)[keep_versions:]:
+        self.remove(filename, shared)
+        removed.append(filename)
+    return sorted(removed)
+
+  def packages_index(self, architecture: str) -> bytes:
+    entries = [
+      e for e in self.state.packages.values() if e["Architecture"] in (architecture, "all")
+    ]
+    entries.sort(key=lambda e: (e["Package"], e["Version"], e["Architecture"]))
+    return "\n".join(format_paragraph(e) for e in entries).encode()
+
+  def publish_index(self, index_dir: str, name: str, content: bytes) -> bool:
+    # Write an index (and its by-hash copy), and return True if it changed
+    path = f"{index_dir}/{name}"
+    sha256 = hashlib.sha256(content).hexdigest()
+    previous = self.state.indexes.get(path)
+    target = self.suite_dir / path
+    if previous is not None and previous["sha256"] == sha256 and target.is_file():
+      return False
+    by_hash_dir = self.suite_dir / index_dir / "by-hash" / "SHA256"
+    write_atomic(by_hash_dir / sha256, content)
+    write_atomic(target, content)
+    self.state.indexes[path] = {
+      "size": len(content),
+      "md5": hashlib.md5(content).hexdigest(),
+      "sha256": sha256,
+    }
+    hashes = self.state.by_hash.setdefault(index_dir, [])
+    if sha256 in hashes:
+      hashes.remove(sha256)
+    hashes.insert(0, sha256)
+    return True
+
+  def prune_by_hash(self, index_dir: str, current: set) -> None:
+    # Keep the last `keep_by_hash` versions of every index (Packages and
+    # Packages.gz share the same directory)
+    hashes = self.state.by_hash.get(index_dir, [])
+    keep = set(hashes[: self.keep_by_hash * 2]) | current
+    self.state.by_hash[index_dir] = [h for h in hashes if h in keep]
+    by_hash_dir = self.suite_dir / index_dir / "by-hash" / "SHA256"
+    for f in by_hash_dir.iterdir() if by_hash_dir.is_dir() else []:
+      if f.name not in keep:
+        f.unlink()
+
+  def update_indexes(self) -> list:
+    updated = []
+    # Indexes are also written for new architectures without packages
+    missing = {
+      arch
+      for arch in self.architectures()
+      if f"{self.component}/binary-{arch}/Packages" not in self.state.indexes
+    }
+    for arch in sorted(self.changed | missing):
+      index_dir = f"{self.component}/binary-{arch}"
+      content = self.packages_index(arch)
+      # Reproducible compressed index (no timestamp)
+      compressed = gzip.compress(content, mtime=0)
+      for name, data in (("Packages", content), ("Packages.gz", compressed)):
+        if self.publish_index(index_dir, name, data):
+          updated.append(f"{index_dir}/{name}")
+      current = {
+        self.state.indexes[f"{index_dir}/{n}"]["sha256"] for n in ("Packages", "Packages.gz")
+      }
+      self.prune_by_hash(index_dir, current)
+    return updated
+
+  def release(self) -> bytes:
+    fields = {
+      "Origin": self.origin or self.suite,
+      "Label": self.label or self.origin or self.suite,
+      "Suite": self.suite,
+      "Codename": self.suite,
+      "Date": time.strftime("%a, %d %b %Y %H:%M:%S UTC", time.gmtime()),
+      "Architectures": " ".join(self.architectures()),
+      "Components": self.component,
+      "Acquire-By-Hash": "yes",
+    }
+    indexes = sorted(
+      (path, info)
+      for path, info in self.state.indexes.items()
+      if path.startswith(f"{self.component}/")
+    )
+    lines = [f"{name}: {value}" for name, value in fields.items()]
+    for title, key in (("MD5Sum", "md5"), ("SHA256", "sha256")):
+      lines.append(f"{title}:")
+      lines.extend(f" {info[key]} {info['size']:>16} {path}" for path, info in indexes)
+    return ("\n".join(lines) + "\n").encode()
+
+  def sign(self, key: Optional[str]) -> None:
+    release = self.suite_dir / "Release"
+    signatures = {
+      "InRelease": ["--clearsign"],
+      "Release.gpg": ["--detach-sign", "--armor"],
+    }
+    for name, options in signatures.items():
+      target = self.suite_dir / name
+      if key is None:
+        # Stale signatures would not match the new Release file
+        target.unlink(missing_ok=True)
+        continue
+      tmp = target.with_name(f"{name}.{os.getpid()}.tmp")
+      subprocess.run(
+        ["gpg", "--batch", "--yes", "--local-user", key, *options, "-o", str(tmp), str(release)],
+        check=True,
+      )
+      tmp.replace(target)
+
+  def publish(self, force_release: bool = False, sign_key: Optional[str] = None) -> list:
+    # Rewrite the changed indexes, then the Release file which refers to them
+    updated = self.update_indexes()
+    if updated or force_release or not (self.suite_dir / "Release").is_file():
+      write_atomic(self.suite_dir / "Release", self.release())
+      self.sign(sign_key)
+      updated.append("Release")
+    self.state.save()
+    return updated
+
+
+def find_debs(inputs: list) -> list:
+  debs = []
+  for path in inputs:
+    if path.is_dir():
+      debs.extend(sorted(path.glob("*.deb")))
+    else:
+      debs.append(path)
+  return debs
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Publish Debian packages to an apt repository")
+  parser.add_argument("inputs", nargs="*", type=Path, help=".deb files, or directories")
+  parser.add_argument("-r", "--repo-dir", type=Path, required=True, help="repository tree")
+  parser.add_argument("-s", "--suite", default=DEFAULT_SUITE)
+  parser.add_argument("-c", "--component", default=DEFAULT_COMPONENT)
+  parser.add_argument(
+    "-a",
+    "--arch",
+    action="append",
+    default=[],
+    help="architecture to index, even without packages (e.g. for `all` packages)",
+  )
+  parser.add_argument("--origin", default=None)
+  parser.add_argument("--label", default=None)
+  parser.add_argument("--sign", default=None, metavar="KEY", help="sign the Release with gpg")
+  parser.add_argument(
+    "--keep-by-hash",
+    type=int,
+    default=DEFAULT_KEEP_BY_HASH,
+    help="versions of every index kept under by-hash",
+  )
+  parser.add_argument(
+    "--keep-versions",
+    type=int,
+    default=DEFAULT_KEEP_VERSIONS,
+    help="newest versions of every package kept in the suite (default: all)",
+  )
+  parser.add_argument(
+    "--verify",
+    action="store_true",
+    help="drop the packages which were removed from the pool",
+  )
+  parser.add_argument(
+    "--force-release", action="store_true", help="rewrite the Release file even if unchanged"
+  )
+  args = parser.parse_args()
+
+  publisher = Publisher(
+    args.repo_dir,
+    args.suite,
+    args.component,
+    args.arch,
+    args.origin,
+    args.label,
+    args.keep_by_hash,
+  )
+  summary = {"added": [], "replaced": [], "unchanged": [], "removed": [], "pruned": []}
+  try:
+    if args.verify:
+      summary["removed"] = publisher.verify()
+    for deb in find_debs(args.inputs):
+      result = publisher.add(deb)
+      summary[result].append(deb.name)
+      print(f"{result:<10} {deb.name}", file=sys.stderr)
+    summary["pruned"] = publisher.prune(args.keep_versions)
+    for filename in summary["pruned"]:
+      print(f"{'pruned':<10} {Path(filename).name}", file=sys.stderr)
+    summary["updated"] = publisher.publish(args.force_release, args.sign)
+  except (OSError, ValueError, tarfile.TarError, subprocess.CalledProcessError) as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+
+  summary["packages"] = len(publisher.state.packages)
+  print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+  main()
@@ -7,12 +7,13 @@ BUILD_DIR=${2:-$(cd $(dirname $0)/../.. && pwd)}
 
 git config --global --add safe.directory ${BUILD_DIR}
 make -C ${BUILD_DIR} tarball
-(cd ${BUILD_DIR} && debuild)
+# Extra arguments for debuild (e.g. to preserve environment variables)
+(cd ${BUILD_DIR} && debuild ${DEBUILD_ARGS})
 mkdir -p ${BUILD_DIR}/debian-dist
 mv -v \
  ${BUILD_DIR}/../${PKG_NAME}*.deb \
  ${BUILD_DIR}/../${PKG_NAME}*.debian.tar.xz \
  ${BUILD_DIR}/../${PKG_NAME}*.dsc \
  ${BUILD_DIR}/../${PKG_NAME}*.changes \
- ${BUILD_DIR}/../${PKG_NAME}*.orig.tar.xz \
+ ${BUILD_DIR}/../${PKG_NAME}*.orig.tar.* \
  ${DEB_DIST_DIR}/
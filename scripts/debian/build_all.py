@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Build the Debian packages for every (base image, architecture) pair
+# concurrently, on a single host.
+#
+# The base images, the architectures, and the builder repository are read
+# from the project's configuration (pyconfig.json if available, otherwise
+# .pyconfig/settings.yml). Every build runs scripts/debian/build.sh in its
+# own builder container, on a private copy of the tracked files (since
+# debuild writes its outputs next to the source tree), sharing a single
+# upstream tarball. Up to --jobs builds run at the same time, and each one
+# gets an equal share of the available cores (DEB_BUILD_OPTIONS=parallel=N),
+# and a persistent ccache directory for its base image and architecture.
+#
+# The generated files are collected into DEB_DIST_DIR (default: debian-dist),
+# and the duration of every build is written as JSON (--timings), e.g.:
+#
+#   python3 scripts/debian/build_all.py -C . -j 2
+#
+# Foreign architectures require QEMU's binfmt handlers on the host.
+###############################################################################
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+
+import changelog
+import tarball as upstream_tarball
+
+# Image references are parsed like in the pyconfig hooks
+sys.path.insert(0, str(Path(__file__).resolve().parents[2] / ".pyconfig"))
+import image_ref  # noqa: E402
+
+DEFAULT_DIST_DIR = "debian-dist"
+DEFAULT_WORK_DIR = "build/debian"
+DEFAULT_CCACHE_DIR = Path.home() / ".cache" / "debian-ccache"
+LOG_TAIL = 40
+
+
+class Build(NamedTuple):
+  base_image: str
+  architecture: str
+  builder: str
+
+  @property
+  def name(self) -> str:
+    return f"{image_ref.label(self.base_image)}-{self.architecture}"
+
+
+class BuildResult(NamedTuple):
+  build: Build
+  returncode: int
+  duration: float
+  log: Path
+  outputs: list
+
+
+###############################################################################
+# Configuration
+###############################################################################
+def load_config(path: Path) -> dict:
+  # Return the `debian.builder` section of pyconfig.json or settings.yml
+  if path.suffix == ".json":
+    config = json.loads(path.read_text())
+  else:
+    import yaml
+
+    config = yaml.safe_load(path.read_text())
+  return config["debian"]["builder"]
+
+
+def builder_image(repo: str, base_image: str) -> str:
+  # Same tag as build_and_test_deb's DEB_BUILDER
+  return image_ref.tagged(repo, base_image)
+
+
+def source_version(repo_dir: Path) -> tuple:
+  # (source package, upstream version) from the latest changelog entry
+  entry = changelog.read_latest(repo_dir / "debian" / "changelog")
+  return entry.source, entry.upstream_version
+
+
+###############################################################################
+# Source trees
+###############################################################################
+def tracked_files(repo_dir: Path) -> list:
+  output = subprocess.run(
+    ["git", "-C", str(repo_dir), "ls-files", "--recurse-submodules", "-z"],
+    check=True,
+    stdout=subprocess.PIPE,
+  ).stdout.decode()
+  # Files deleted from the working tree are still listed by git
+  return [f for f in output.split("\0") if f and os.path.lexists(repo_dir / f)]
+
+
+def copy_tree(repo_dir: Path, files: list, dest: Path) -> None:
+  shutil.rmtree(dest, ignore_errors=True)
+  for f in files:
+    target = dest / f
+    target.parent.mkdir(parents=True, exist_ok=True)
+    shutil.copy2(repo_dir / f, target, follow_symlinks=False)
+
+
+###############################################################################
+# Builds
+###############################################################################
+def build_options(jobs_per_build: int) -> str:
+  # Preserve other options already set in the environment
+  options = [
+    o for o in os.environ.get("DEB_BUILD_OPTIONS", "").split() if not o.startswith("parallel=")
+  ]
+  return " ".join([*options, f"parallel={jobs_per_build}"])
+
+
+def run_build(
+  build: Build,
+  project: str,
+  files: list,
+  repo_dir: Path,
+  work_dir: Path,
+  tarball: Path,
+  ccache_dir: Path,
+  jobs_per_build: int,
+  update_changelog: bool,
+) -> BuildResult:
+  build_dir = work_dir / build.name
+  src_dir = build_dir / project
+  dist_dir = src_dir / DEFAULT_DIST_DIR
+  log = build_dir / "build.log"
+  start = time.monotonic()
+
+  shutil.rmtree(build_dir, ignore_errors=True)
+  copy_tree(repo_dir, files, src_dir)
+  # build.sh skips `make tarball` when the archive already exists
+  os.link(tarball, build_dir / tarball.name)
+  arch_ccache = ccache_dir / build.name
+  arch_ccache.mkdir(parents=True, exist_ok=True)
+
+  script = f"/build/{project}/scripts/debian/build.sh {project} /build/{project}"
+  if update_changelog:
+    try:
+      changelog.bump(src_dir / "debian" / "changelog", changelog.codename(build.base_image))
+    except ValueError:
+      # Unknown base image: read the codename inside the builder
+      script = f"cd /build/{project} && scripts/debian/update_changelog.sh && {script}"
+  cmd = [
+    "docker",
+    "run",
+    "--rm",
+    "--platform",
+    f"linux/{build.architecture}",
+    "-v",
+    f"{build_dir.resolve()}:/build",
+    "-v",
+    f"{arch_ccache.resolve()}:/ccache",
+    "-w",
+    f"/build/{project}",
+    "-e",
+    f"DEB_BUILD_OPTIONS={build_options(jobs_per_build)}",
+    "-e",
+    "CCACHE_DIR=/ccache",
+    # debuild sanitizes the environment: preserve the ccache configuration
+    "-e",
+    "DEBUILD_ARGS=--prepend-path=/usr/lib/ccache -eCCACHE_DIR",
+    "-e",
+    f"DEB_DIST_DIR=/build/{project}/{DEFAULT_DIST_DIR}",
+    build.builder,
+    "sh",
+    "-c",
+    script,
+  ]
+  with log.open("w") as output:
+    output.write(f"+ {' '.join(cmd)}\n")
+    output.flush()
+    result = subprocess.run(cmd, stdout=output, stderr=subprocess.STDOUT)
+  outputs = sorted(dist_dir.iterdir()) if dist_dir.is_dir() else []
+  return BuildResult(build, result.returncode, time.monotonic() - start, log, outputs)
+
+
+def collect(results: list, dist_dir: Path) -> list:
+  # Source files (.dsc, .orig.tar.xz, ...) are generated by every build of
+  # the same base image: keep the first copy.
+  dist_dir.mkdir(parents=True, exist_ok=True)
+  collected = {}
+  for result in results:
+    for f in result.outputs:
+      if f.name in collected:
+        continue
+      shutil.copy2(f, dist_dir / f.name)
+      collected[f.name] = result.build.name
+  return sorted(collected)
+
+
+def print_log_tail(log: Path) -> None:
+  lines = log.read_text(errors="replace").splitlines()
+  for line in lines[-LOG_TAIL:]:
+    print(f"  {line}", file=sys.stderr)
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Build Debian packages for all architectures")
+  parser.add_argument("-C", "--repo-dir", type=Path, default=Path.cwd())
+  parser.add_argument(
+    "-c",
+    "--config",
+    type=Path,
+    default=None,
+    help="pyconfig.json or settings.yml (default: pyconfig.json, if available)",
+  )
+  parser.add_argument("-p", "--project", default=None, help="source package name")
+  parser.add_argument(
+    "-a", "--arch", action="append", default=None, help="architecture (default: from config)"
+  )
+  parser.add_argument(
+    "-b", "--base-image", action="append", default=None, help="base image (default: from config)"
+  )
+  parser.add_argument(
+    "--builder", default=None, help="builder image for all builds (default: from config)"
+  )
+  parser.add_argument("-j", "--jobs", type=int, default=None, help="concurrent builds")
+  parser.add_argument(
+    "-d", "--dist-dir", type=Path, default=Path(os.environ.get("DEB_DIST_DIR", DEFAULT_DIST_DIR))
+  )
+  parser.add_argument("-w", "--work-dir", type=Path, default=Path(DEFAULT_WORK_DIR))
+  parser.add_argument(
+    "--ccache-dir",
+    type=Path,
+    default=Path(os.environ.get("DEB_CCACHE_DIR") or DEFAULT_CCACHE_DIR),
+  )
+  parser.add_argument("-t", "--timings", type=Path, default=None, help="timings file (JSON)")
+  parser.add_argument(
+    "--no-changelog",
+    action="store_true",
+    help="don't append the builder's codename to the package version",
+  )
+  args = parser.parse_args()
+
+  repo_dir = args.repo_dir.resolve()
+  config_file = args.config
+  if config_file is None:
+    config_file = Path("pyconfig.json")
+    if not config_file.is_file():
+      config_file = repo_dir / ".pyconfig" / "settings.yml"
+  config = load_config(config_file)
+
+  architectures = args.arch or config["architectures"]
+  base_images = args.base_image or config["base_images"]
+  builds = [
+    Build(
+      base_image=base_image,
+      architecture=arch,
+      builder=args.builder or builder_image(config["repo"], base_image),
+    )
+    for base_image in base_images
+    for arch in architectures
+  ]
+  if not builds:
+    parser.error("nothing to build")
+
+  cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+  jobs = max(1, min(args.jobs or len(builds), len(builds)))
+  jobs_per_build = max(1, (cpus or 1) // jobs)
+
+  source, upstream = source_version(repo_dir)
+  project = args.project or source
+  work_dir = args.work_dir if args.work_dir.is_absolute() else repo_dir / args.work_dir
+  dist_dir = args.dist_dir if args.dist_dir.is_absolute() else repo_dir / args.dist_dir
+  work_dir.mkdir(parents=True, exist_ok=True)
+
+  files = tracked_files(repo_dir)
+  # Shared by all builds, and only regenerated if the sources changed
+  tarball = work_dir / f"{source}_{upstream}.orig.tar.xz"
+  upstream_tarball.update(repo_dir, tarball)
+
+  print(
+    f"building {len(builds)} configurations, {jobs} at a time ({jobs_per_build} cores each)",
+    file=sys.stderr,
+  )
+  start = time.monotonic()
+  with ThreadPoolExecutor(max_workers=jobs) as pool:
+    futures = [
+      pool.submit(
+        run_build,
+        build,
+        project,
+        files,
+        repo_dir,
+        work_dir,
+        tarball,
+        args.ccache_dir,
+        jobs_per_build,
+        not args.no_changelog,
+      )
+      for build in builds
+    ]
+    results = []
+    for future in futures:
+      result = future.result()
+      results.append(result)
+      status = "ok" if result.returncode == 0 else f"FAILED ({result.returncode})"
+      print(f"{result.build.name:<40} {result.duration:8.1f}s {status}", file=sys.stderr)
+  elapsed = time.monotonic() - start
+
+  failed = [r for r in results if r.returncode != 0]
+  collected = collect([r for r in results if r.returncode == 0], dist_dir)
+
+  timings = {
+    "jobs": jobs,
+    "cores_per_build": jobs_per_build,
+    "elapsed": round(elapsed, 3),
+    "builds": [
+      {
+        "base_image": r.build.base_image,
+        "architecture": r.build.architecture,
+        "builder": r.build.builder,
+        "duration": round(r.duration, 3),
+        "returncode": r.returncode,
+        "log": str(r.log),
+        "outputs": [f.name for f in r.outputs],
+      }
+      for r in results
+    ],
+    "collected": collected,
+  }
+  timings_file = args.timings or work_dir / "build-times.json"
+  timings_file.parent.mkdir(parents=True, exist_ok=True)
+  timings_file.write_text(json.dumps(timings, indent=2))
+  serial = sum(r.duration for r in results)
+  print(
+    f"total {elapsed:.1f}s (serial: {serial:.1f}s), {len(collected)} files in {dist_dir}",
+    file=sys.stderr,
+  )
+
+  for r in failed:
+    print(f"ERROR build {r.build.name} failed, see {r.log}:", file=sys.stderr)
+    print_log_tail(r.log)
+  if failed:
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()
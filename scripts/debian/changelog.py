@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Read and update debian/changelog, without dpkg's tools.
+#
+#   make-vars  write the variables used by the Makefile (DSC_NAME,
+#              DEB_VERSION, UPSTREAM_VERSION) to a make include file, e.g.:
+#
+#                python3 scripts/debian/changelog.py make-vars -o build/debian-changelog.mk
+#
+#   show       print the fields of the latest entry (like dpkg-parsechangelog)
+#
+#   bump       add an entry appending the build's codename to the version
+#              (like scripts/debian/update_changelog.sh, which uses debchange)
+#
+# The codename is read from --codename, or DEB_CODENAME, or derived from the
+# base image of the build (--base-image, e.g. `ubuntu:22.04` -> `jammy`, or
+# the tag of a builder image, e.g. `ubuntu-22.04`), or else it is the one of
+# the host (/etc/os-release).
+#
+# Only the latest entry is parsed, so that the cost doesn't grow with the
+# length of the changelog.
+###############################################################################
+import argparse
+import os
+import re
+import sys
+from datetime import datetime, timezone
+from email.utils import format_datetime
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+DEFAULT_CHANGELOG = "debian/changelog"
+
+# Codenames of the releases of each distribution, by version (as used in
+# the tags of their Docker images)
+CODENAMES = {
+  "ubuntu": {
+    "18.04": "bionic",
+    "20.04": "focal",
+    "22.04": "jammy",
+    "23.10": "mantic",
+    "24.04": "noble",
+    "24.10": "oracular",
+    "25.04": "plucky",
+  },
+  "debian": {
+    "10": "buster",
+    "11": "bullseye",
+    "12": "bookworm",
+    "13": "trixie",
+    "14": "forky",
+    "unstable": "sid",
+  },
+}
+
+# <source> (<version>) <distributions>; <key>=<value>, ...
+_HEADER = re.compile(r"^(\S+) \(([^)\s]+)\) ([^;]+);(.*)$")
+# " -- <maintainer>  <date>"
+_TRAILER = re.compile(r"^ -- (.+?)  (.+)$")
+
+
+class Entry(NamedTuple):
+  source: str
+  version: str
+  distribution: str
+  urgency: str
+  changes: list
+  maintainer: str
+  date: str
+
+  @property
+  def upstream_version(self) -> str:
+    return upstream_version(self.version)
+
+
+def upstream_version(version: str) -> str:
+  # The upstream part of a Debian version (without epoch and revision)
+  if ":" in version:
+    version = version.split(":", 1)[1]
+  return version.rsplit("-", 1)[0] if "-" in version else version
+
+
+###############################################################################
+# Parsing
+###############################################################################
+def parse_latest(lines) -> Entry:
+  # Parse the first entry of a changelog (an iterable of lines)
+  header = None
+  changes = []
+  for line in lines:
+    line = line.rstrip("\n")
+    if header is None:
+      if not line.strip():
+        continue
+      header = _HEADER.match(line)
+      if header is None:
+        raise ValueError(f"invalid debian/changelog header: {line}")
+      continue
+    trailer = _TRAILER.match(line)
+    if trailer is not None:
+      source, version, distribution, options = header.groups()
+      options = dict(o.strip().split("=", 1) for o in options.split(",") if "=" in o)
+      # Drop the blank lines around the changes
+      while changes and not changes[0].strip():
+        changes.pop(0)
+      while changes and not changes[-1].strip():
+        changes.pop()
+      return Entry(
+        source=source,
+        version=version,
+        distribution=distribution.strip(),
+        urgency=options.get("urgency", ""),
+        changes=changes,
+        maintainer=trailer.group(1),
+        date=trailer.group(2),
+      )
+    changes.append(line)
+  raise ValueError("no complete entry in debian/changelog")
+
+
+def read_latest(path: Path) -> Entry:
+  with path.open() as lines:
+    return parse_latest(lines)
+
+
+###############################################################################
+# Editing
+###############################################################################
+def format_entry(entry: Entry) -> str:
+  changes = "\n".join(entry.changes)
+  return (
+    f"{entry.source} ({entry.version}) {entry.distribution}; urgency={entry.urgency}\n\n"
+    f"{changes}\n\n"
+    f" -- {entry.maintainer}  {entry.date}\n"
+  )
+
+
+def write_atomic(path: Path, content: str) -> None:
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+  tmp.write_text(content)
+  tmp.replace(path)
+
+
+def codename(base_image: Optional[str] = None) -> str:
+  if not base_image:
+    with open("/etc/os-release") as os_release:
+      for line in os_release:
+        key, _, value = line.strip().partition("=")
+        if key == "VERSION_CODENAME" and value:
+          return value.strip("\"'")
+    raise ValueError("VERSION_CODENAME not found in /etc/os-release")
+  # Ignore the registry and namespace (e.g. mirrors of the official images)
+  name, _, tag = base_image.rsplit("/", 1)[-1].partition(":")
+  if name not in CODENAMES:
+    # The tag of a builder image (e.g. `ubuntu-22.04`, or `REPO:ubuntu-22.04`)
+    name, _, tag = (tag or name).partition("-")
+  # Ignore variants (e.g. `bookworm-slim`, `12-slim`)
+  tag = tag.split("-", 1)[0]
+  releases = CODENAMES.get(name, {})
+  if tag in releases.values():
+    return tag
+  if name == "debian":
+    # Point releases (e.g. `12.5`)
+    tag = tag.split(".", 1)[0]
+  result = releases.get(tag)
+  if result is None:
+    raise ValueError(f"unknown codename for {base_image}, use --codename")
+  return result
+
+
+def bump(
+  path: Path,
+  build_codename: str,
+  version: Optional[str] = None,
+  message: Optional[str] = None,
+  preserve_timestamp: bool = False,
+) -> Entry:
+  # Add an UNRELEASED entry for `version` (default: the latest one) with the
+  # codename appended, signed by the maintainer of the latest entry
+  text = path.read_text()
+  stat = path.stat()
+  latest = parse_latest(text.splitlines())
+  entry = Entry(
+    source=latest.source,
+    version=f"{version or latest.version}{build_codename}",
+    distribution="UNRELEASED",
+    urgency="high",
+    changes=[f"  * {message or f'Package built on {build_codename}'}"],
+    maintainer=latest.maintainer,
+    date=format_datetime(datetime.now(timezone.utc)),
+  )
+  write_atomic(path, f"{format_entry(entry)}\n{text}")
+  if preserve_timestamp:
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+  return entry
+
+
+def make_vars(entry: Entry) -> str:
+  return (
+    "# Generated by scripts/debian/changelog.py from debian/changelog\n"
+    f"DSC_NAME := {entry.source}\n"
+    f"DEB_VERSION := {entry.version}\n"
+    f"UPSTREAM_VERSION := {entry.upstream_version}\n"
+  )
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Read and update debian/changelog")
+  parser.add_argument("-l", "--changelog", type=Path, default=Path(DEFAULT_CHANGELOG))
+  subparsers = parser.add_subparsers(dest="action", required=True)
+
+  parser_make_vars = subparsers.add_parser("make-vars", help="generate a make include file")
+  parser_make_vars.add_argument("-o", "--output", type=Path, default=None)
+
+  parser_show = subparsers.add_parser("show", help="print the latest entry")
+  parser_show.add_argument(
+    "-S", "--show-field", default=None, help="only print this field (e.g. Version)"
+  )
+
+  parser_bump = subparsers.add_parser("bump", help="append the build's codename to the version")
+  parser_bump.add_argument("version", nargs="?", default=None, help="default: latest version")
+  parser_bump.add_argument("-m", "--message", default=None)
+  parser_bump.add_argument(
+    "-c", "--codename", default=os.environ.get("DEB_CODENAME") or None, help="default: DEB_CODENAME"
+  )
+  parser_bump.add_argument(
+    "-b", "--base-image", default=None, help="derive the codename from the build's base image"
+  )
+  parser_bump.add_argument(
+    "--preserve-timestamp",
+    action="store_true",
+    default=bool(os.environ.get("PRESERVE_TIMESTAMP")),
+    help="keep the changelog's mtime (default: PRESERVE_TIMESTAMP)",
+  )
+  args = parser.parse_args()
+
+  try:
+    if args.action == "bump":
+      entry = bump(
+        args.changelog,
+        args.codename or codename(args.base_image),
+        args.version,
+        args.message,
+        args.preserve_timestamp,
+      )
+      print(f"{entry.source} ({entry.version})", file=sys.stderr)
+      return
+    entry = read_latest(args.changelog)
+  except (OSError, ValueError) as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+
+  if args.action == "make-vars":
+    content = make_vars(entry)
+    if args.output:
+      write_atomic(args.output, content)
+    else:
+      sys.stdout.write(content)
+    return
+
+  fields = {
+    "Source": entry.source,
+    "Version": entry.version,
+    "Upstream-Version": entry.upstream_version,
+    "Distribution": entry.distribution,
+    "Urgency": entry.urgency,
+    "Maintainer": entry.maintainer,
+    "Date": entry.date,
+  }
+  if args.show_field:
+    if args.show_field not in fields:
+      print(f"ERROR unknown field: {args.show_field}", file=sys.stderr)
+      sys.exit(1)
+    print(fields[args.show_field])
+  else:
+    for name, value in fields.items():
+      print(f"{name}: {value}")
+
+
+if __name__ == "__main__":
+  main()
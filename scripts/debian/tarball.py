@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Generate the upstream tarball (.orig.tar.xz) of the Debian source package
+# from the files tracked by git (including submodules).
+#
+# The archive is reproducible: entries are sorted by path, and have a fixed
+# owner (root), normalized permissions (0644/0755), and a fixed mtime
+# (SOURCE_DATE_EPOCH, or the timestamp of the HEAD commit). Compression uses
+# all cores (`xz -T0`, or `zstd -T0` with --compression zstd, which requires
+# a dpkg-source with zstd support), and falls back to Python's lzma module
+# if `xz` is not installed.
+#
+# The tarball is not regenerated if its inputs haven't changed: the state of
+# the tree (the blob ids in the index, and the stat data of every file in the
+# working tree) is hashed, and compared with the hash recorded in a sidecar
+# file (.<tarball>.treehash) when the tarball was last generated.
+#
+#   python3 scripts/debian/tarball.py -C . -o ../pkg_1.0.orig.tar.xz
+###############################################################################
+import argparse
+import hashlib
+import io
+import lzma
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tarfile
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+FORMAT_VERSION = 1
+# Fixed block size, so that xz's output doesn't depend on the number of threads
+XZ_BLOCK_SIZE = "24MiB"
+XZ_PRESET = "-6"
+ZSTD_LEVEL = "-19"
+
+
+class TrackedFile(NamedTuple):
+  path: str
+  mode: int
+  sha: str
+
+
+def git(repo_dir: Path, *args: str) -> bytes:
+  return subprocess.run(
+    ["git", "-C", str(repo_dir), *args], check=True, stdout=subprocess.PIPE
+  ).stdout
+
+
+def tracked_files(repo_dir: Path) -> list:
+  # Files of the repository and of its submodules, with paths relative to
+  # the repository's root, sorted (by their bytes) and without duplicates.
+  result = {}
+  for line in git(repo_dir, "ls-files", "--recurse-submodules", "--stage", "-z").split(b"\0"):
+    if not line:
+      continue
+    info, path = line.split(b"\t", 1)
+    mode, sha, _ = info.split(b" ")
+    path = os.fsdecode(path)
+    # Skip files deleted from the working tree
+    if os.path.lexists(repo_dir / path):
+      result[path] = TrackedFile(path, int(mode, 8), sha.decode())
+  return [result[p] for p in sorted(result, key=os.fsencode)]
+
+
+def source_date_epoch(repo_dir: Path) -> int:
+  epoch = os.environ.get("SOURCE_DATE_EPOCH")
+  if epoch:
+    return int(epoch)
+  try:
+    return int(git(repo_dir, "log", "-1", "--format=%ct").strip())
+  except (subprocess.CalledProcessError, ValueError):
+    return 0
+
+
+def tree_hash(repo_dir: Path, files: list, options: dict) -> str:
+  h = hashlib.sha256()
+  h.update(f"tarball:{FORMAT_VERSION}\0".encode())
+  h.update(repr(sorted(options.items())).encode())
+  for f in files:
+    st = (repo_dir / f.path).lstat()
+    h.update(f"\0{f.mode:o} {f.sha} {st.st_size} {st.st_mtime_ns} {st.st_mode:o} ".encode())
+    h.update(os.fsencode(f.path))
+  return h.hexdigest()
+
+
+def _tar_info(repo_dir: Path, path: str, prefix: str, mtime: int) -> tarfile.TarInfo:
+  st = (repo_dir / path).lstat()
+  info = tarfile.TarInfo(f"{prefix}{path}")
+  info.mtime = mtime
+  info.uid = info.gid = 0
+  info.uname = info.gname = "root"
+  if stat.S_ISLNK(st.st_mode):
+    info.type = tarfile.SYMTYPE
+    info.linkname = os.readlink(repo_dir / path)
+    info.mode = 0o777
+  else:
+    info.size = st.st_size
+    info.mode = 0o755 if st.st_mode & stat.S_IXUSR else 0o644
+  return info
+
+
+def write_tar(output: io.RawIOBase, repo_dir: Path, files: list, prefix: str, mtime: int) -> None:
+  with tarfile.open(fileobj=output, mode="w|", format=tarfile.GNU_FORMAT) as archive:
+    for f in files:
+      info = _tar_info(repo_dir, f.path, prefix, mtime)
+      if info.type == tarfile.SYMTYPE:
+        archive.addfile(info)
+      else:
+        with (repo_dir / f.path).open("rb") as content:
+          archive.addfile(info, content)
+
+
+def compressor(compression: str, threads: int) -> Optional[list]:
+  # Return the command used to compress the archive, or None to use lzma
+  if compression == "zstd":
+    if not shutil.which("zstd"):
+      raise RuntimeError("zstd compression requires the `zstd` command")
+    return ["zstd", ZSTD_LEVEL, f"-T{threads}", "-q", "-c"]
+  elif shutil.which("xz"):
+    # A single thread would select xz's single-threaded mode, which produces
+    # a different output: "+1" forces multi-threaded mode (xz >= 5.4)
+    xz_threads = "+1" if threads == 1 else str(threads)
+    return ["xz", XZ_PRESET, f"-T{xz_threads}", f"--block-size={XZ_BLOCK_SIZE}", "-q", "-c"]
+  return None
+
+
+def generate(
+  repo_dir: Path,
+  output: Path,
+  files: list,
+  compression: str = "xz",
+  prefix: str = "",
+  mtime: int = 0,
+  threads: int = 0,
+) -> None:
+  tmp = output.with_name(f".{output.name}.tmp")
+  cmd = compressor(compression, threads)
+  with tmp.open("wb") as out:
+    if cmd is None:
+      with lzma.open(out, "wb", preset=int(XZ_PRESET[1:])) as stream:
+        write_tar(stream, repo_dir, files, prefix, mtime)
+    else:
+      proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+      try:
+        write_tar(proc.stdin, repo_dir, files, prefix, mtime)
+      finally:
+        proc.stdin.close()
+        returncode = proc.wait()
+      if returncode != 0:
+        raise RuntimeError(f"{cmd[0]} failed with exit code {returncode}")
+  tmp.replace(output)
+
+
+def sidecar(output: Path) -> Path:
+  # Hidden, so that it isn't matched by the globs collecting the build's outputs
+  return output.with_name(f".{output.name}.treehash")
+
+
+def update(
+  repo_dir: Path,
+  output: Path,
+  compression: str = "xz",
+  prefix: str = "",
+  threads: int = 0,
+  force: bool = False,
+) -> bool:
+  # Generate the tarball if its inputs changed. Return True if it was.
+  files = tracked_files(repo_dir)
+  mtime = source_date_epoch(repo_dir)
+  options = {
+    "compression": compression,
+    "prefix": prefix,
+    "mtime": mtime,
+    # lzma and xz produce different (but equally valid) outputs
+    "compressor": (compressor(compression, threads) or ["lzma"])[0],
+  }
+  key = tree_hash(repo_dir, files, options)
+  hash_file = sidecar(output)
+  if (
+    not force and output.is_file() and hash_file.is_file() and hash_file.read_text().strip() == key
+  ):
+    return False
+  generate(repo_dir, output, files, compression, prefix, mtime, threads)
+  hash_file.write_text(f"{key}\n")
+  return True
+
+
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Generate a reproducible upstream tarball")
+  parser.add_argument("-C", "--repo-dir", type=Path, default=Path.cwd())
+  parser.add_argument("-o", "--output", type=Path, required=True)
+  parser.add_argument("-z", "--compression", choices=["xz", "zstd"], default="xz")
+  parser.add_argument("-p", "--prefix", default="", help="directory prefix for all entries")
+  parser.add_argument(
+    "-T", "--threads", type=int, default=0, help="compression threads (default: all cores)"
+  )
+  parser.add_argument("-f", "--force", action="store_true", help="always regenerate the tarball")
+  args = parser.parse_args()
+
+  repo_dir = args.repo_dir.resolve()
+  prefix = f"{args.prefix.rstrip('/')}/" if args.prefix else ""
+  if args.compression == "zstd" and args.output.suffix != ".zst":
+    parser.error("zstd-compressed tarballs must have a .zst extension")
+  if not (repo_dir / ".git").exists():
+    # e.g. a copy of the sources prepared by build_all.py
+    if args.output.is_file():
+      print(f"not a git repository, keeping {args.output}", file=sys.stderr)
+      return
+    parser.error(f"not a git repository: {repo_dir}")
+  try:
+    generated = update(repo_dir, args.output, args.compression, prefix, args.threads, args.force)
+  except (RuntimeError, subprocess.CalledProcessError) as e:
+    print(f"ERROR {e}", file=sys.stderr)
+    sys.exit(1)
+  print(f"{'generated' if generated else 'up to date'}: {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+###############################################################################
+# Copyright 2020-2024 Andrea Sorbini
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+###############################################################################
+# Compare the build times of the variants (stages) of docker/Dockerfile.
+#
+# Every variant is built for every (base image, platform) pair, in these
+# scenarios:
+#
+#   cold   without BuildKit's layer cache (--no-cache)
+#   warm   again, with nothing changed
+#   touch  after appending a comment to each file passed to --touch (e.g. a
+#          package list), which is restored afterwards
+#
+# Each build runs with `--progress=plain`, and its output is parsed to count
+# the steps which were executed, and the ones which were found in the cache,
+# so that the layers shared between variants (e.g. the base stage) can be
+# verified, e.g.:
+#
+#   python3 scripts/docker/build_times.py -C . -p linux/amd64 \
+#     --touch docker/packages/dev.txt -t build/build-times.json
+#
+# The timings of every build are written as JSON (--timings).
+###############################################################################
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+DEFAULT_DOCKERFILE = "docker/Dockerfile"
+DEFAULT_TARGETS = ("base", "tester", "dev", "release")
+DEFAULT_BASE_IMAGE = "ubuntu:22.04"
+LOG_TAIL = 40
+
+# Lines printed by BuildKit's plain progress output, e.g.:
+#   #7 [tester 2/3] RUN --mount=type=cache,...
+#   #7 CACHED
+_STEP = re.compile(r"^#(\d+) \[[^\]]*\d+/\d+\]")
+_CACHED = re.compile(r"^#(\d+) CACHED$")
+
+
+class Build(NamedTuple):
+  target: str
+  base_image: str
+  platform: Optional[str]
+
+  @property
+  def name(self) -> str:
+    name = f"{self.target}-{self.base_image.replace(':', '-').replace('/', '-')}"
+    if self.platform:
+      name = f"{name}-{self.platform.replace('/', '-')}"
+    return name
+
+
+class BuildResult(NamedTuple):
+  build: Build
+  scenario: str
+  returncode: int
+  duration: float
+  steps: int
+  cached: int
+  log: Path
+
+
+###############################################################################
+# Builds
+###############################################################################
+def parse_progress(output: str) -> tuple:
+  # (steps, cached steps) of a build's plain progress output
+  steps = set()
+  cached = set()
+  for line in output.splitlines():
+    m = _STEP.match(line)
+    if m:
+      steps.add(m.group(1))
+      continue
+    m = _CACHED.match(line)
+    if m:
+      cached.add(m.group(1))
+  return len(steps), len(cached & steps)
+
+
+def run_build(
+  build: Build, scenario: str, repo_dir: Path, dockerfile: Path, log_dir: Path
+) -> BuildResult:
+  log = log_dir / f"{build.name}-{scenario}.log"
+  cmd = [
+    "docker",
+    "buildx",
+    "build",
+    "--progress=plain",
+    "-f",
+    str(dockerfile),
+    "--target",
+    build.target,
+    "--build-arg",
+    f"BASE_IMAGE={build.base_image}",
+  ]
+  if build.platform:
+    cmd.extend(["--platform", build.platform])
+  if scenario == "cold":
+    cmd.append("--no-cache")
+  cmd.append(str(repo_dir))
+  start = time.monotonic()
+  result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+  duration = time.monotonic() - start
+  output = result.stdout.decode(errors="replace")
+  log.write_text(f"+ {' '.join(cmd)}\n{output}")
+  steps, cached = parse_progress(output)
+  return BuildResult(build, scenario, result.returncode, duration, steps, cached, log)
+
+
+def touch(files: list) -> dict:
+  # Append a comment to each file, and return their original contents
+  original = {}
+  for f in files:
+    original[f] = f.read_bytes()
+    with f.open("a") as output:
+      output.write(f"# build_times.py {time.time()}\n")
+  return original
+
+
+def restore(original: dict) -> None:
+  for f, content in original.items():
+    f.write_bytes(content)
+
+
+def print_log_tail(log: Path) -> None:
+  lines = log.read_text(errors="replace").splitlines()
+  for line in lines[-LOG_TAIL:]:
+    print(f"  {line}", file=sys.stderr)
+
+
+###############################################################################
+# Command-line interface
+###############################################################################
+def main() -> None:
+  parser = argparse.ArgumentParser(description="Compare the build times of the image variants")
+  parser.add_argument("-C", "--repo-dir", type=Path, default=Path.cwd())
+  parser.add_argument("-f", "--file", type=Path, default=Path(DEFAULT_DOCKERFILE))
+  parser.add_argument(
+    "-T",
+    "--target",
+    action="append",
+    default=None,
+    help=f"variant to build (default: {', '.join(DEFAULT_TARGETS)})",
+  )
+  parser.add_argument(
+    "-b", "--base-image", action="append", default=None, help=f"default: {DEFAULT_BASE_IMAGE}"
+  )
+  parser.add_argument(
+    "-p", "--platform", action="append", default=None, help="default: the host's platform"
+  )
+  parser.add_argument(
+    "--touch", type=Path, action="append", default=[], help="file modified by the touch scenario"
+  )
+  parser.add_argument(
+    "--no-cold", action="store_true", help="don't rebuild the variants without cache"
+  )
+  parser.add_argument("-l", "--log-dir", type=Path, default=Path("build/build-times"))
+  parser.add_argument("-t", "--timings", type=Path, default=None, help="timings file (JSON)")
+  args = parser.parse_args()
+
+  repo_dir = args.repo_dir.resolve()
+  dockerfile = args.file if args.file.is_absolute() else repo_dir / args.file
+  touched = [f if f.is_absolute() else repo_dir / f for f in args.touch]
+  for f in [dockerfile, *touched]:
+    if not f.is_file():
+      print(f"ERROR file not found: {f}", file=sys.stderr)
+      sys.exit(1)
+  args.log_dir.mkdir(parents=True, exist_ok=True)
+
+  builds = [
+    Build(target, base_image, platform)
+    for base_image in args.base_image or [DEFAULT_BASE_IMAGE]
+    for platform in args.platform or [None]
+    for target in args.target or DEFAULT_TARGETS
+  ]
+  scenarios = [*([] if args.no_cold else ["cold"]), "warm", *(["touch"] if touched else [])]
+
+  results = []
+  start = time.monotonic()
+  for scenario in scenarios:
+    original = touch(touched) if scenario == "touch" else {}
+    try:
+      for build in builds:
+        result = run_build(build, scenario, repo_dir, dockerfile, args.log_dir)
+        results.append(result)
+        status = "ok" if result.returncode == 0 else f"FAILED ({result.returncode})"
+        print(
+          f"{scenario:<6} {build.name:<48} {result.duration:8.1f}s"
+          f" {result.cached:3d}/{result.steps:<3d} cached {status}",
+          file=sys.stderr,
+        )
+        if result.returncode != 0:
+          print_log_tail(result.log)
+    finally:
+      restore(original)
+  elapsed = time.monotonic() - start
+
+  timings = {
+    "dockerfile": str(args.file),
+    "scenarios": scenarios,
+    "touched": [str(f) for f in args.touch],
+    "elapsed": round(elapsed, 3),
+    "builds": [
+      {
+        "target": r.build.target,
+        "base_image": r.build.base_image,
+        "platform": r.build.platform,
+        "scenario": r.scenario,
+        "duration": round(r.duration, 3),
+        "steps": r.steps,
+        "cached": r.cached,
+        "returncode": r.returncode,
+        "log": str(r.log),
+      }
+      for r in results
+    ],
+  }
+  if args.timings:
+    args.timings.parent.mkdir(parents=True, exist_ok=True)
+    args.timings.write_text(json.dumps(timings, indent=2))
+  else:
+    print(json.dumps(timings, indent=2))
+
+  if any(r.returncode != 0 for r in results):
+    sys.exit(1)
+
+
+if __name__ == "__main__":
+  main()